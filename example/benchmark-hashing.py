@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Measure how fast osfclient hashes local files.
+
+Usage: benchmark-hashing.py [size in MiB] [path]
+
+Writes a file of random data (256 MiB by default) and hashes it with
+`osfclient.utils.checksums_path`, once for md5 alone and once for md5 and
+sha256 in the same pass. The first round may read from disk, the others
+from the page cache. For comparison it also prints the speed of hashlib
+on data that is already in memory, which is the upper limit for a single
+core.
+"""
+import asyncio
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+from osfclient.utils import checksums_path
+
+
+async def measure(path, hash_types, rounds=3):
+    size = os.path.getsize(path)
+    for i in range(rounds):
+        start = time.perf_counter()
+        checksums = await checksums_path(path, hash_types)
+        elapsed = time.perf_counter() - start
+        print('{:<12} round {}: {:6.2f} GB/s'.format(
+            '+'.join(hash_types), i + 1, size / elapsed / 1e9))
+    return checksums
+
+
+def measure_hashlib(hash_types, size=256 * 1024 * 1024):
+    block = memoryview(os.urandom(1024 * 1024))
+    hashes = [hashlib.new(hash_type) for hash_type in hash_types]
+    start = time.perf_counter()
+    for _ in range(size // len(block)):
+        for hash_ in hashes:
+            hash_.update(block)
+    elapsed = time.perf_counter() - start
+    print('{:<12} hashlib: {:6.2f} GB/s'.format(
+        '+'.join(hash_types), size / elapsed / 1e9))
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    directory = sys.argv[2] if len(sys.argv) > 2 else None
+
+    fd, path = tempfile.mkstemp(prefix='osf-hash-', dir=directory)
+    try:
+        block = os.urandom(1024 * 1024)
+        reference = hashlib.md5()
+        with os.fdopen(fd, 'wb') as fp:
+            for _ in range(size):
+                fp.write(block)
+                reference.update(block)
+
+        print('hashing {} MiB in {}'.format(size, path))
+        measure_hashlib(('md5',))
+        checksums = asyncio.run(measure(path, ('md5',)))
+        assert checksums['md5'] == reference.hexdigest()
+        measure_hashlib(('md5', 'sha256'))
+        asyncio.run(measure(path, ('md5', 'sha256')))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
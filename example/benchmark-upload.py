@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Compare the CPU time osfclient spends uploading files.
+
+Usage: benchmark-upload.py [size in MiB] [path]
+
+Writes a file of random data (1024 MiB by default) and uploads it to a
+local HTTP server that discards what it receives, once reading the file
+into recycled buffers and once sending it from a memory map. The server
+runs in its own process, so the CPU time printed per GB is that of the
+uploading side only.
+"""
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import aiofiles
+import httpx
+
+from osfclient.models.utils import (chunked_bytes_iterator,
+                                    configure_upload_buffers)
+
+
+async def _discard(reader, writer):
+    # accept one chunked HTTP/1.1 request per connection
+    await reader.readuntil(b'\r\n\r\n')
+    while True:
+        size = int((await reader.readuntil(b'\r\n')).strip(), 16)
+        if size == 0:
+            await reader.readuntil(b'\r\n')
+            break
+        await reader.readexactly(size + 2)
+    writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+    await writer.drain()
+    writer.close()
+
+
+def serve(port):
+    async def main():
+        server = await asyncio.start_server(_discard, '127.0.0.1', 0)
+        port.value = server.sockets[0].getsockname()[1]
+        async with server:
+            await server.serve_forever()
+    asyncio.run(main())
+
+
+async def upload(url, path):
+    async with httpx.AsyncClient(timeout=None) as client:
+        async with aiofiles.open(path, 'rb') as fp:
+            response = await client.put(url,
+                                        content=chunked_bytes_iterator(fp))
+    response.raise_for_status()
+
+
+def measure(url, path, use_mmap, rounds=3):
+    configure_upload_buffers(use_mmap=use_mmap)
+    gigabytes = os.path.getsize(path) / 1e9
+    for i in range(rounds):
+        wall, cpu = time.perf_counter(), time.process_time()
+        asyncio.run(upload(url, path))
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        print('{:<8} round {}: {:5.2f} CPU s/GB, {:5.2f} GB/s'.format(
+            'mmap' if use_mmap else 'buffers', i + 1, cpu / gigabytes,
+            gigabytes / wall))
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    directory = sys.argv[2] if len(sys.argv) > 2 else None
+
+    port = multiprocessing.Value('i', 0)
+    server = multiprocessing.Process(target=serve, args=(port,), daemon=True)
+    server.start()
+    fd, path = tempfile.mkstemp(prefix='osf-upload-', dir=directory)
+    try:
+        block = os.urandom(1024 * 1024)
+        with os.fdopen(fd, 'wb') as fp:
+            for _ in range(size):
+                fp.write(block)
+        while not port.value:
+            time.sleep(0.01)
+        url = 'http://127.0.0.1:{}/'.format(port.value)
+
+        print('uploading {} MiB from {}'.format(size, path))
+        measure(url, path, use_mmap=False)
+        measure(url, path, use_mmap=True)
+    finally:
+        os.remove(path)
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,14 @@ import argparse
 from textwrap import dedent
 
 from .cli import clone, fetch, list_, makefolder, remove, move, upload, init
+from .cli import DEFAULT_JOBS, DEFAULT_MAX_IN_FLIGHT
+from .models.session import DEFAULT_DOWNLOAD_SEGMENTS
+from .models.utils import (DEFAULT_UPLOAD_BLOCK_SIZE,
+                           DEFAULT_UPLOAD_BUFFER_MEMORY)
+from .utils import ChecksumCache, parse_page_size, parse_rate_limits
+from .utils import parse_size
+from .utils import set_checksum_cache, set_rate_limits
+from .stats import run_stats
 from . import __version__
 
 
@@ -41,6 +49,52 @@ async def main():
                         version='%(prog)s {}'.format(__version__))
     parser.add_argument('--debug', action='store_true',
                         help='Print debug messages')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Adapt the number of concurrent requests to '
+                             'how fast the server answers, use with a '
+                             'high --jobs')
+    parser.add_argument('--http2', action='store_true',
+                        help='Use HTTP/2 where the server supports it, '
+                             'needs the h2 package')
+    parser.add_argument('--no-checksum-cache', action='store_true',
+                        help='Hash local files every time instead of '
+                             'remembering the hashes of unchanged files')
+    parser.add_argument('--limit-rate', type=parse_rate_limits,
+                        default=None, metavar='RATE[:UPLOAD_RATE]',
+                        help='Limit the downloads and the uploads of this '
+                             'command to RATE bytes per second each, e.g. '
+                             '200M, or downloads to RATE and uploads to '
+                             'UPLOAD_RATE')
+    parser.add_argument('--page-size', type=parse_page_size, default='max',
+                        metavar='ENTRIES',
+                        help='Entries per page of folder listings, max for '
+                             'the largest the server allows or default for '
+                             "the server's default (default max)")
+    parser.add_argument('--prefetch', type=int, default=1, metavar='PAGES',
+                        help='Request this many pages of folder listings '
+                             'ahead, 0 turns this off (default 1)')
+    parser.add_argument('--retries', type=int, default=None,
+                        help='Retry failed requests this many times, with '
+                             'increasing waits in between (default 5, '
+                             '3 for uploads)')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print request counts, latencies, throughput '
+                             'and the time spent listing, hashing, '
+                             'transferring and creating folders at the end')
+    parser.add_argument('--slow-requests', type=float, default=None,
+                        metavar='SECONDS',
+                        help='Log a warning for every request that takes '
+                             'SECONDS or longer')
+    parser.add_argument('--stream-listings', action='store_true',
+                        help='Parse folder listings in small steps while '
+                             'they arrive instead of each page at once, for '
+                             'folders with very many files; pages are not '
+                             'requested ahead')
+    parser.add_argument('--segments', type=int,
+                        default=DEFAULT_DOWNLOAD_SEGMENTS,
+                        help='Download files of 64M or more in this many '
+                             'parts at the same time, 1 turns this off '
+                             '(default %(default)s)')
     # dest=command stores the name of the command in a variable, this is
     # used later on to retrieve the correct sub-parser
     subparsers = parser.add_subparsers(dest='command')
@@ -55,6 +109,15 @@ async def main():
     clone_parser.add_argument('-U', '--update',
                                help='Overwrite only if local and remote files differ',
                                action='store_true')
+    clone_parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS,
+                              help='Number of files to download at the same '
+                                   'time (default %(default)s)')
+    clone_parser.add_argument('--max-in-flight', type=parse_size,
+                              default=DEFAULT_MAX_IN_FLIGHT, metavar='SIZE',
+                              help='Maximum total size of the files '
+                                   'downloaded at the same time, e.g. 512M, '
+                                   'a large file counts as its share per job '
+                                   '(default 1G)')
 
     def _add_subparser(name, description, aliases=[]):
         options = {
@@ -101,6 +164,23 @@ async def main():
     upload_parser.add_argument('-r', '--recursive',
                                help='Recursively upload entire directories',
                                action='store_true')
+    upload_parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS,
+                               help='Number of files to upload at the same '
+                                    'time with -r (default %(default)s)')
+    upload_parser.add_argument('--chunk-size', type=parse_size,
+                               default=DEFAULT_UPLOAD_BLOCK_SIZE,
+                               metavar='SIZE',
+                               help='Size of the chunks files are sent in '
+                                    '(default 8M)')
+    upload_parser.add_argument('--buffer-memory', type=parse_size,
+                               default=DEFAULT_UPLOAD_BUFFER_MEMORY,
+                               metavar='SIZE',
+                               help='Maximum memory used for the chunks of '
+                                    'all uploads together (default 256M)')
+    upload_parser.add_argument('--mmap', action='store_true',
+                               help='Send files from a memory map without '
+                                    'copying them, the files must not be '
+                                    'truncated during the upload')
     upload_parser.add_argument('source', help='Local file')
     upload_parser.add_argument('destination', help='Remote file path')
 
@@ -136,13 +216,27 @@ async def main():
         else:
             logging.basicConfig(level=logging.WARNING)
 
+        if not args.no_checksum_cache:
+            # opened when the first local file is hashed
+            set_checksum_cache(ChecksumCache(ChecksumCache.default_path()))
+        if args.limit_rate is not None:
+            set_rate_limits(*args.limit_rate)
+
         # give functions a chance to influence the exit code
         # this setup is so we can print usage for the sub command
         # even if there was an error further down
+        if args.stats:
+            run_stats()
         try:
             exit_code = await args.func(args)
         except SystemExit as e:
             exit_code = e.code
+        finally:
+            cache = set_checksum_cache(None)
+            if cache is not None:
+                cache.close()
+            if args.stats:
+                print(run_stats().report(), file=sys.stderr)
 
         if exit_code is not None:
             sub_parser = subparsers.choices[args.command]
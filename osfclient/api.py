@@ -1,6 +1,7 @@
 from .exceptions import OSFException
 from .models import OSFCore
 from .models import Project
+from .models.session import OSFSession
 
 
 class OSF(OSFCore):
@@ -9,9 +10,12 @@ class OSF(OSFCore):
     This is the main point of contact for interactions with the
     OSF. Use the methods of this class to find projects, login
     to the OSF, etc.
+
+    Set `http2=True` to use HTTP/2 where the server supports it, see
+    `OSFSession`.
     """
-    def __init__(self, token=None, base_url=None):
-        super(OSF, self).__init__({})
+    def __init__(self, token=None, base_url=None, http2=False):
+        super(OSF, self).__init__({}, OSFSession(http2=http2))
         if base_url is not None:
             self.session.set_endpoint(base_url)
         if token is not None:
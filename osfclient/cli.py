@@ -4,8 +4,10 @@ These functions implement the functionality of the command-line interface.
 """
 from __future__ import print_function
 
-from functools import wraps
+import asyncio
+from functools import partial, wraps
 import os
+import posixpath
 import sys
 
 import aiofiles
@@ -18,12 +20,25 @@ from tzlocal import get_localzone
 
 from .api import OSF
 from .exceptions import UnauthorizedException
+from .models.hooks import SlowRequestLogger
+from .models.session import default_limiters
+from .stats import run_stats
+from .models.utils import configure_upload_buffers
 from .utils import (
-    norm_remote_path, split_storage, makedirs, checksum_path,
-    is_folder, flatten, find_ancestral_folder, find_by_path, filter_by_path_pattern,
+    norm_remote_path, split_storage, makedirs, checksum_fp, checksum_path,
+    ByteBudget, is_folder, walk, find_ancestral_folder, find_by_path,
+    filter_by_path_pattern, path_index,
 )
 
 
+# number of files `osf clone` and `osf upload -r` transfer at the same time
+DEFAULT_JOBS = 4
+# total size of the files `osf clone` downloads at the same time
+DEFAULT_MAX_IN_FLIGHT = 1024 ** 3
+# number of files per job that may wait for a free job
+QUEUE_DEPTH = 16
+
+
 def config_from_file():
     if os.path.exists(".osfcli.config"):
         config_ = configparser.ConfigParser()
@@ -47,6 +62,10 @@ def config_from_env(config):
     if project is not None:
         config['project'] = project
 
+    http2 = os.getenv("OSF_HTTP2")
+    if http2 is not None:
+        config['http2'] = http2
+
     return config
 
 
@@ -62,6 +81,13 @@ def _get_token():
     return os.getenv('OSF_TOKEN')
 
 
+def _get_http2(args, config):
+    if args.http2:
+        return True
+    value = config.get('http2', '')
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
 def _setup_osf(args):
     # Command line options have precedence over environment variables,
     # which have precedence over the config file.
@@ -78,7 +104,28 @@ def _setup_osf(args):
     base_url = _get_base_url(args, config)
     token = _get_token()
 
-    return OSF(token=token, base_url=base_url)
+    osf = OSF(token=token, base_url=base_url,
+              http2=_get_http2(args, config))
+    if args.segments < 1:
+        sys.exit('--segments has to be at least 1.')
+    osf.session.download_segments = args.segments
+    osf.session.page_size = args.page_size
+    if args.prefetch < 0:
+        sys.exit('--prefetch can not be negative.')
+    osf.session.prefetch_pages = args.prefetch
+    osf.session.stream_listings = args.stream_listings
+    if args.retries is not None:
+        if args.retries < 0:
+            sys.exit('--retries can not be negative.')
+        for policy in osf.session.retry_policies.values():
+            policy.retries = args.retries
+    if args.adaptive:
+        osf.session.limiters = default_limiters()
+    if args.slow_requests is not None:
+        osf.session.add_hook(SlowRequestLogger(args.slow_requests))
+    if args.stats:
+        osf.session.add_hook(run_stats())
+    return osf
 
 
 def might_need_auth(f):
@@ -148,35 +195,81 @@ async def clone(args):
 
     If args.update is True, overwrite any existing local files only if local and
     remote files differ.
+
+    Interrupted downloads leave `.part` files behind, which are resumed the
+    next time the project is cloned.
+
+    Listing the project, comparing local files and downloading happen
+    concurrently. At most args.jobs files are downloaded at the same time
+    and their total size is limited to args.max_in_flight bytes, so that a
+    few large files do not hold up all the small ones.
     """
+    if args.jobs < 1:
+        sys.exit('The number of jobs has to be at least 1.')
+
     osf = _setup_osf(args)
     project = await osf.project(args.project)
     output_dir = args.project
     if args.output is not None:
         output_dir = args.output
 
+    jobs = asyncio.Semaphore(args.jobs)
+    # a large file takes at most its job's share of the budget, so that
+    # the small files keep flowing while it downloads
+    budget = ByteBudget(args.max_in_flight,
+                        max_reservation=args.max_in_flight // args.jobs)
+    # bounds the number of files that traversal runs ahead of downloads
+    queue = asyncio.Semaphore(args.jobs * QUEUE_DEPTH)
+    pending = set()
+    errors = []
+
+    def _done(task):
+        pending.discard(task)
+        queue.release()
+        if not task.cancelled() and task.exception() is not None:
+            errors.append(task.exception())
+
     with tqdm(unit='files') as pbar:
-        async for store in project.storages:
-            prefix = os.path.join(output_dir, store.name)
-
-            async for file_ in flatten(store):
-                if is_folder(file_):
-                    continue
-                path = file_.path
-                if path.startswith('/'):
-                    path = path[1:]
-
-                path = os.path.join(prefix, path)
-                if os.path.exists(path) and args.update:
-                    if await checksum_path(path) == file_.hashes.get('md5'):
+        try:
+            async for store in project.storages:
+                prefix = os.path.join(output_dir, store.name)
+
+                async for file_ in walk(store, ordered=False):
+                    if errors:
+                        raise errors[0]
+                    if is_folder(file_):
                         continue
-                directory, _ = os.path.split(path)
-                makedirs(directory, exist_ok=True)
+                    path = file_.path
+                    if path.startswith('/'):
+                        path = path[1:]
+
+                    path = os.path.join(prefix, path)
+                    await queue.acquire()
+                    task = asyncio.ensure_future(
+                        _clone_file(file_, path, args.update, jobs, budget,
+                                    pbar)
+                    )
+                    pending.add(task)
+                    task.add_done_callback(_done)
+
+            await asyncio.gather(*pending)
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def _clone_file(file_, path, update, jobs, budget, pbar):
+    if os.path.exists(path) and update:
+        if await checksum_path(path) == file_.hashes.get('md5'):
+            return
+    directory, _ = os.path.split(path)
+    makedirs(directory, exist_ok=True)
 
-                async with aiofiles.open(path, "wb") as f:
-                    await file_.write_to(f)
+    async with jobs, budget.reserve(file_.size):
+        await file_.download(path)
 
-                pbar.update()
+    pbar.update()
 
 
 @might_need_auth
@@ -194,6 +287,9 @@ async def fetch(args):
     If args.force is True, write local file even if that file already exists.
     If args.force is False but args.update is True, overwrite an existing local
     file only if local and remote files differ.
+
+    The file is downloaded to a `.part` file next to the local path first. If
+    the download is interrupted, running the command again resumes it.
     """
     storage, remote_path = split_storage(args.remote)
 
@@ -221,8 +317,7 @@ async def fetch(args):
         if file_.hashes.get('md5') == await checksum_path(local_path):
             print("Local file %s already matches remote." % local_path)
             return
-    async with aiofiles.open(local_path, 'wb') as fp:
-        await file_.write_to(fp)
+    await file_.download(local_path)
 
 
 @might_need_auth
@@ -294,10 +389,23 @@ async def upload(args):
     $ osf upload -r foo bar
     To place contents of local directory `foo` in remote directory `bar`:
     $ osf upload -r foo/ bar
+
+    In recursive mode args.jobs files are uploaded at the same time. A file
+    that fails to upload does not stop the others, a summary of the
+    uploaded, skipped and failed files is printed at the end. With
+    args.force or args.update the remote directory is listed once up front,
+    existing files are then updated directly.
+
+    Files are sent in chunks of args.chunk_size bytes, all uploads together
+    use at most args.buffer_memory bytes of buffers. With args.mmap files are
+    sent straight from a memory map instead; they must not be truncated
+    while they are uploaded.
     """
     osf = _setup_osf(args)
     if not osf.has_auth:
         sys.exit('To upload a file you need to provide a token.')
+    configure_upload_buffers(args.chunk_size, args.buffer_memory,
+                             use_mmap=args.mmap)
 
     project = await osf.project(args.project)
     storage, remote_path = split_storage(args.destination)
@@ -307,20 +415,75 @@ async def upload(args):
         if not os.path.isdir(args.source):
             raise RuntimeError("Expected source ({}) to be a directory when "
                                "using recursive mode.".format(args.source))
+        if args.jobs < 1:
+            sys.exit('The number of jobs has to be at least 1.')
 
         # local name of the directory that is being uploaded
         _, dir_name = os.path.split(args.source)
 
-        for root, _, files in os.walk(args.source):
-            subdir_path = os.path.relpath(root, args.source)
-            for fname in files:
-                local_path = os.path.join(root, fname)
-                async with aiofiles.open(local_path, 'rb') as fp:
-                    # build the remote path + fname
-                    name = os.path.join(remote_path, dir_name, subdir_path,
-                                        fname)
-                    await store.create_file(name, fp, force=args.force,
-                                            update=args.update)
+        jobs = asyncio.Semaphore(args.jobs)
+        # bounds the number of files that traversal runs ahead of uploads
+        queue = asyncio.Semaphore(args.jobs * QUEUE_DEPTH)
+        pending = set()
+        uploaded, skipped, failed, unauthorized = [], [], [], []
+        manifest = {}
+        if args.force or args.update:
+            # list the remote files once instead of finding out file by
+            # file which of them exist already
+            manifest = await _remote_manifest(
+                store, os.path.join(remote_path, dir_name))
+
+        def _done(local_path, task):
+            pending.discard(task)
+            queue.release()
+            if task.cancelled():
+                return
+            if isinstance(task.exception(), UnauthorizedException):
+                # no point in trying the other files
+                unauthorized.append(task.exception())
+            elif task.exception() is not None:
+                failed.append((local_path, task.exception()))
+            elif task.result() is False:
+                skipped.append(local_path)
+            else:
+                uploaded.append(local_path)
+            pbar.update()
+
+        with tqdm(unit='files') as pbar:
+            try:
+                for root, _, files in os.walk(args.source):
+                    subdir_path = os.path.relpath(root, args.source)
+                    for fname in files:
+                        if unauthorized:
+                            raise unauthorized[0]
+                        local_path = os.path.join(root, fname)
+                        # build the remote path + fname
+                        name = os.path.join(remote_path, dir_name,
+                                            subdir_path, fname)
+                        remote = manifest.get(norm_remote_path(name))
+                        await queue.acquire()
+                        task = asyncio.ensure_future(
+                            _upload_file(store, local_path, name, args.force,
+                                         args.update, jobs, remote)
+                        )
+                        pending.add(task)
+                        task.add_done_callback(partial(_done, local_path))
+
+                await asyncio.gather(*pending, return_exceptions=True)
+                if unauthorized:
+                    raise unauthorized[0]
+            finally:
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+
+        print('Uploaded {} files, skipped {} unchanged files, {} files '
+              'failed.'.format(len(uploaded), len(skipped), len(failed)))
+        if failed:
+            for local_path, error in failed:
+                print('{}: {}'.format(local_path, _describe_error(error)),
+                      file=sys.stderr)
+            sys.exit('{} files could not be uploaded.'.format(len(failed)))
 
     else:
         async with aiofiles.open(args.source, 'rb') as fp:
@@ -328,6 +491,67 @@ async def upload(args):
                                     update=args.update)
 
 
+async def _remote_manifest(store, remote_dir):
+    """Return the entries below `remote_dir` keyed by their normalized
+    path.
+
+    The listings are added to the path index of the session, so that
+    uploads into folders that exist already do not try to create them.
+    """
+    remote_dir = norm_remote_path(remote_dir)
+    if remote_dir in ('', '.'):
+        folder = store
+    else:
+        folder = await find_by_path(store, remote_dir)
+        if folder is None or not is_folder(folder):
+            return {}
+    manifest = {norm_remote_path(entry.path): entry
+                async for entry in walk(folder, ordered=False)}
+
+    index, key = path_index(folder)
+    if index is not None:
+        root, folder_path = key
+        listings = {folder_path: []}
+        listings.update((path, []) for path, entry in manifest.items()
+                        if is_folder(entry))
+        for path, entry in manifest.items():
+            listings[posixpath.dirname(path)].append(entry)
+        for path, entries in listings.items():
+            index.set_listing(root, path, entries)
+    return manifest
+
+
+async def _upload_file(store, local_path, name, force, update, jobs,
+                       remote=None):
+    """Upload `local_path` to `name`, `remote` is the existing remote file
+    at `name` if it is known."""
+    async with jobs:
+        async with aiofiles.open(local_path, 'rb') as fp:
+            if remote is None:
+                return await store.create_file(name, fp, force=force,
+                                               update=update)
+            return await _update_file(remote, local_path, fp, force)
+
+
+async def _update_file(file_, local_path, fp, force):
+    if is_folder(file_):
+        raise RuntimeError("Cannot update a folder.")
+    if not force:
+        # files of different size differ, no need to hash them
+        if (file_.size in (None, os.path.getsize(local_path)) and
+                await checksum_fp(fp) == file_.hashes.get('md5')):
+            return False
+        await fp.seek(0)
+    await file_.update(fp)
+    return True
+
+
+def _describe_error(error):
+    if isinstance(error, FileExistsError):
+        return 'already exists, use --force or --update to overwrite it'
+    return str(error) or type(error).__name__
+
+
 @might_need_auth
 async def makefolder(args):
     """Create a new folder in an existing project.
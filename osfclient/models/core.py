@@ -1,7 +1,14 @@
+import asyncio
+import logging
 import numbers
 from urllib.parse import urlencode, urlparse, parse_qs, urlunparse
 
-from .session import OSFSession
+from ..exceptions import UnauthorizedException
+from .session import MAX_PAGE_SIZE, OSFSession
+from .utils import ListingParser, decode_json
+
+
+logger = logging.getLogger(__name__)
 
 
 # Base class for all models and the user facing API object
@@ -54,30 +61,173 @@ class OSFCore(object):
 
         return value
 
-    def _json(self, response, status_code):
-        """Extract JSON from response if `status_code` matches."""
+    async def _json(self, response, status_code):
+        """Extract JSON from response if `status_code` matches.
+
+        Large responses are decoded in a worker thread, see the
+        `json_thread_threshold` setting of the session.
+        """
         if isinstance(status_code, numbers.Integral):
             status_code = (status_code,)
 
         if response.status_code in status_code:
-            return response.json()
+            return await decode_json(response,
+                                     self.session.json_thread_threshold)
         else:
             raise RuntimeError("Response has status "
                                "code {} not {}".format(response.status_code,
                                                        status_code))
 
-    async def _follow_next(self, url):
-        """Follow the 'next' link on paginated results."""
-        response = self._json(await self._get(url), 200)
+    async def _follow_next(self, url, prefetch=None, page_size=None):
+        """Follow the 'next' link on paginated results.
+
+        Up to `prefetch` pages are requested ahead of the consumer, defaults
+        to the `prefetch_pages` setting of the session. Pages requested ahead
+        are discarded when the consumer stops early.
+
+        Pages of `page_size` entries are requested, defaults to the
+        `page_size` setting of the session, see `OSFSession`.
+        """
+        if prefetch is None:
+            prefetch = self.session.prefetch_pages
+        url, response = await self._first_page(url, page_size)
+        if prefetch > 0:
+            async for data in self._follow_next_read_ahead(url, response,
+                                                           prefetch):
+                yield data
+            return
+
         yield response['data']
 
         next_token = response.get('next_token', None)
         while next_token is not None:
             next_url = self._ensure_query_string(url, next_token=next_token)
-            response = self._json(await self._get(next_url), 200)
+            response = await self._json(await self._get(next_url), 200)
             yield response['data']
             next_token = response.get('next_token', None)
 
+    async def _first_page(self, url, page_size=None):
+        """Request the first page of `url` with the page size, returns the
+        URL the other pages are requested with and the first page."""
+        sized_url = self._page_size_url(url, page_size)
+        response = await self._get(sized_url)
+        if sized_url != url and response.status_code == 400:
+            sized_url = url
+            response = await self._get(url)
+            if response.status_code == 200:
+                self._reject_page_size(url)
+        return sized_url, await self._json(response, 200)
+
+    def _reject_page_size(self, url):
+        # the server does not accept the page size but answers without it,
+        # use its default from now on
+        logger.info("%s does not accept a page size, using the default.",
+                    urlparse(url).netloc)
+        self.session.page_size_rejected.add(urlparse(url).netloc)
+
+    def _page_size_url(self, url, page_size=None):
+        if page_size is None:
+            page_size = self.session.page_size
+        if page_size is None or (urlparse(url).netloc in
+                                 self.session.page_size_rejected):
+            return url
+        if page_size == 'max':
+            page_size = MAX_PAGE_SIZE
+        return self._ensure_query_string(url, **{'page[size]': page_size})
+
+    async def _follow_next_read_ahead(self, url, first, prefetch):
+        if first.get('next_token', None) is None:
+            yield first['data']
+            return
+        pages = asyncio.Queue()
+        # one token per page that may be requested before it is consumed
+        tokens = asyncio.Semaphore(prefetch)
+        next_url = self._ensure_query_string(
+            url, next_token=first['next_token'])
+        task = asyncio.ensure_future(self._read_ahead(url, next_url, pages,
+                                                      tokens))
+        try:
+            yield first['data']
+            while True:
+                page = await pages.get()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                tokens.release()
+                yield page
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _read_ahead(self, url, next_url, pages, tokens):
+        """Put the pages of `url` from `next_url` on into `pages`, followed
+        by `None`."""
+        try:
+            while next_url is not None:
+                await tokens.acquire()
+                response = await self._json(await self._get(next_url), 200)
+                next_token = response.get('next_token', None)
+                if next_token is None:
+                    next_url = None
+                else:
+                    next_url = self._ensure_query_string(url,
+                                                         next_token=next_token)
+                await pages.put(response['data'])
+            await pages.put(None)
+        except Exception as e:
+            await pages.put(e)
+
+    async def _iter_entries(self, url, page_size=None, stream=None):
+        """Yield the entries of all pages of the listing at `url`.
+
+        With `stream=True`, by default the `stream_listings` setting of the
+        session, each page is parsed while it arrives and its entries are
+        yielded as soon as they are complete, so large pages are neither
+        decoded in one go nor held in memory as a whole, see
+        `ListingParser`. Streamed pages are not requested ahead. Otherwise
+        the pages are requested with `_follow_next`.
+        """
+        if stream is None:
+            stream = self.session.stream_listings
+        if not stream:
+            async for entries in self._follow_next(url, page_size=page_size):
+                for entry in entries:
+                    yield entry
+            return
+
+        sized_url = page_url = self._page_size_url(url, page_size)
+        # whether the first page was rejected with the page size
+        unsized = False
+        while page_url is not None:
+            parser = ListingParser()
+            async with self._stream('GET', page_url,
+                                    kind='metadata') as response:
+                if response.status_code == 401:
+                    raise UnauthorizedException()
+                if (page_url == sized_url != url and
+                        response.status_code == 400):
+                    sized_url = page_url = url
+                    unsized = True
+                    continue
+                if response.status_code != 200:
+                    raise RuntimeError("Response has status code {} not "
+                                       "(200,)".format(response.status_code))
+                if unsized:
+                    self._reject_page_size(url)
+                    unsized = False
+                async for chunk in response.aiter_bytes():
+                    for entry in parser.feed(chunk):
+                        yield entry
+            for entry in parser.close():
+                yield entry
+            next_token = parser.fields.get('next_token', None)
+            if next_token is None:
+                page_url = None
+            else:
+                page_url = self._ensure_query_string(sized_url,
+                                                     next_token=next_token)
+
     def _ensure_query_string(self, url: str, **kwargs) -> str:
         """Ensure that the URL has the query string parameters."""
         parsed = urlparse(url)
@@ -1,18 +1,33 @@
+import asyncio
+import hashlib
 import io
 import logging
+import os
+import posixpath
+import re
+
+import aiofiles
 from typing import Type, AsyncGenerator, TypeVar, Dict, Any
 from tqdm import tqdm
 from typing import AsyncGenerator, Dict, Type, TypeVar
 
 from .core import OSFCore
 from ..exceptions import FolderExistsException, UnauthorizedException
-from ..utils import file_empty
+from ..utils import DEFAULT_WALK_CONCURRENCY, checksum_path, file_empty, walk
+from ..utils import cache_checksums, norm_remote_path, path_index, throttle
+from ..utils import timed
 from .utils import chunked_bytes_iterator, merge_query_params
 
 
 logger = logging.getLogger(__name__)
 OSFCoreType = TypeVar('OSFCoreType', bound=OSFCore)
 DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# suffix of the file an unfinished download is written to
+PART_SUFFIX = '.part'
+# hashes downloads are checked against, others are not content hashes, like
+# the ETag of a multipart upload that some providers report as md5
+_HASH_FORMATS = {'md5': re.compile(r'^[0-9a-fA-F]{32}$'),
+                 'sha256': re.compile(r'^[0-9a-fA-F]{64}$')}
 
 
 class tqdm_indeterminate(tqdm):
@@ -46,6 +61,9 @@ async def copyfileobj(fsrc, fdst, total, length=16*1024):
 
 
 class File(OSFCore):
+    # the storage this file was found in, used to key the path index
+    _storage = None
+
     def _update_attributes(self, file):
         if not file:
             return
@@ -86,37 +104,286 @@ class File(OSFCore):
     def __str__(self):
         return '<File [{0}, {1}]>'.format(self.id, self.path)
 
+    def _index_key(self):
+        return _entry_index_key(self)
+
     async def write_to(self, fp):
         """Write contents of this file to a local file.
 
         Pass in a filepointer `fp` that has been opened for writing in
-        binary mode.
+        binary mode. Raises RuntimeError if the data written does not match
+        the hashes of this file.
         """
         if hasattr(fp, 'mode') and 'b' not in fp.mode:
             raise ValueError("File has to be opened in binary mode.")
 
+        hashers = self._hashers()
         try:
-            await self._write_to(fp, self._download_url)
+            await self._write_to(fp, self._download_url, hashers=hashers)
         except UnauthorizedException:
-            await self._write_to(fp, self._upload_url)
+            await self._write_to(fp, self._upload_url, hashers=hashers)
+        self._check_hashes(hashers)
 
-    async def _write_to(self, fp, url):
-        async with self._stream('GET', url) as response:
+    async def download(self, path, resume=True):
+        """Download the contents of this file to the local file `path`.
+
+        The data is written to `path` + '.part' first, which replaces `path`
+        once its size and hash match those of the remote file. With
+        `resume=True` the `.part` file of an interrupted download is
+        continued with a HTTP Range request instead of starting over.
+        """
+        part_path = path + PART_SUFFIX
+        offset = 0
+        if resume and os.path.exists(part_path):
+            offset = os.path.getsize(part_path)
+            if self.size is not None and offset > self.size:
+                offset = 0
+
+        # hashes of the data written by `_write_to`, segmented downloads
+        # are hashed after the fact
+        hashers = None
+        if self.size is None or offset < self.size:
+            downloaded = False
+            ranges = self._segment_ranges(offset)
+            if ranges is not None:
+                try:
+                    downloaded = await self._download_segments(
+                        part_path, ranges, self._download_url)
+                except UnauthorizedException:
+                    downloaded = await self._download_segments(
+                        part_path, ranges, self._upload_url)
+
+            if not downloaded:
+                hashers = self._hashers()
+                if offset:
+                    await _hash_file(part_path, hashers)
+                mode = 'ab' if offset else 'wb'
+                async with aiofiles.open(part_path, mode) as fp:
+                    try:
+                        await self._write_to(fp, self._download_url, offset,
+                                             hashers)
+                    except UnauthorizedException:
+                        await self._write_to(fp, self._upload_url, offset,
+                                             hashers)
+        elif not offset:
+            # an empty file, there is nothing to request
+            async with aiofiles.open(part_path, 'wb'):
+                pass
+
+        try:
+            verified = await self._verify(part_path, hashers)
+        except RuntimeError:
+            os.remove(part_path)
+            if not offset:
+                raise
+            # the data downloaded earlier might be from another version of
+            # the file, start over
+            logger.info("Resumed download of %s is corrupt, starting over.",
+                        self.path)
+            return await self.download(path, resume=False)
+
+        os.replace(part_path, path)
+        cache_checksums(path, {hash_type: self._expected_hash(hash_type)
+                               for hash_type in verified})
+
+    def _segment_ranges(self, offset):
+        """Split the bytes from `offset` on into ranges to download in
+        parallel, or return None if the file is too small for that or its
+        size is not known."""
+        segments = self.session.download_segments
+        if self.size is None:
+            return None
+        remaining = self.size - offset
+        if (segments < 2 or remaining < self.session.segment_threshold or
+                not hasattr(os, 'pwrite')):
+            return None
+        length = -(-remaining // segments)
+        return [(start, min(start + length, self.size) - 1)
+                for start in range(offset, self.size, length)]
+
+    async def _download_segments(self, path, ranges, url):
+        """Download `ranges` of this file into `path` in parallel.
+
+        Returns False without writing anything if the server does not
+        support range requests. If a segment fails, `path` is truncated
+        to the data that was downloaded without gaps, so that the download
+        can be resumed.
+        """
+        flags = os.O_WRONLY | os.O_CREAT
+        if ranges[0][0] == 0:
+            flags |= os.O_TRUNC
+        fd = os.open(path, flags, 0o666)
+        written = [0] * len(ranges)
+        # find out whether the server honours ranges before starting the
+        # other segments
+        probe = asyncio.get_event_loop().create_future()
+        tasks = [asyncio.ensure_future(
+            self._write_segment(fd, url, ranges, written, 0, probe)
+        )]
+        try:
+            await asyncio.wait([probe, tasks[0]],
+                               return_when=asyncio.FIRST_COMPLETED)
+            if not probe.done():
+                tasks[0].result()
+            if not probe.result():
+                await tasks[0]
+                return False
+
+            # preallocate the file, segments are written where they belong
+            os.ftruncate(fd, ranges[-1][1] + 1)
+            for i in range(1, len(ranges)):
+                tasks.append(asyncio.ensure_future(
+                    self._write_segment(fd, url, ranges, written, i)
+                ))
+            await asyncio.gather(*tasks)
+            return True
+
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            os.ftruncate(fd, _contiguous_end(ranges, written))
+            raise
+
+        finally:
+            os.close(fd)
+
+    async def _write_segment(self, fd, url, ranges, written, i, probe=None):
+        start, end = ranges[i]
+        headers = {'Range': 'bytes={}-{}'.format(start, end)}
+        loop = asyncio.get_event_loop()
+        async with self._stream('GET', url, headers=headers) as response:
             if response.status_code == 401:
                 raise UnauthorizedException()
-            if response.status_code == 200:
-                async for data in response.aiter_bytes():
-                    await fp.write(data)
-                await fp.flush()
+            if response.status_code == 200 and probe is not None:
+                probe.set_result(False)
+                return
+            if response.status_code != 206:
+                raise RuntimeError("Response has status "
+                                   "code {}.".format(response.status_code))
+            content_range = response.headers.get('content-range', '')
+            if not content_range.startswith('bytes {}-{}/'.format(start,
+                                                                  end)):
+                raise RuntimeError("Requested bytes {}-{} but got "
+                                   "{}.".format(start, end, content_range))
+            if probe is not None:
+                probe.set_result(True)
+
+            pos = start
+            async for data in response.aiter_bytes():
+                if pos + len(data) > end + 1:
+                    raise RuntimeError("Received more data than requested "
+                                       "for bytes {}-{}.".format(start, end))
+                await throttle('download', len(data))
+                await loop.run_in_executor(None, _pwrite_all, fd, data, pos)
+                pos += len(data)
+                written[i] += len(data)
+
+        if pos != end + 1:
+            raise RuntimeError("Received bytes {}-{} but requested "
+                               "{}-{}.".format(start, pos - 1, start, end))
+
+    def _expected_hash(self, hash_type):
+        """Return the `hash_type` hash the storage provides for this file,
+        or None if there is none or it is not a well-formed digest."""
+        hashes = getattr(self, 'hashes', None) or {}
+        expected = hashes.get(hash_type)
+        if not expected:
+            return None
+        if not _HASH_FORMATS[hash_type].match(expected):
+            logger.debug("Not checking the %s hash %r of %s, it is not a "
+                         "digest.", hash_type, expected, self.path)
+            return None
+        return expected.lower()
+
+    def _hashers(self):
+        """Return new hash objects for the hashes the storage provides."""
+        return {hash_type: hashlib.new(hash_type)
+                for hash_type in ('md5', 'sha256')
+                if self._expected_hash(hash_type)}
+
+    def _check_hashes(self, hashers):
+        for hash_type, hash_ in hashers.items():
+            if hash_.hexdigest() != self._expected_hash(hash_type):
+                raise RuntimeError("The {} hash of the downloaded {} does "
+                                   "not match.".format(hash_type, self.path))
+
+    async def _verify(self, path, hashers=None):
+        """Check that the local file `path` matches this file.
+
+        `hashers` are the hashes of the data written to `path` while it
+        was downloaded, without them `path` is read again. Returns the
+        types of the hashes that were checked.
+        """
+        size = os.path.getsize(path)
+        if self.size is not None and size != self.size:
+            raise RuntimeError("Downloaded {} bytes of {} but expected "
+                               "{}.".format(size, self.path, self.size))
+        if hashers is not None:
+            self._check_hashes(hashers)
+            return list(hashers)
+        for hash_type in ('md5', 'sha256'):
+            expected = self._expected_hash(hash_type)
+            if not expected:
+                continue
+            if await checksum_path(path, hash_type) != expected:
+                raise RuntimeError("The {} hash of the downloaded {} does "
+                                   "not match.".format(hash_type, self.path))
+            return [hash_type]
+        return []
+
+    async def _write_to(self, fp, url, offset=0, hashers=None):
+        """Stream the file from `url` into `fp`, starting at `offset`.
+
+        Each chunk written also updates the hash objects in `hashers`,
+        which have to contain the first `offset` bytes already.
+        """
+        kwargs = {}
+        if offset:
+            kwargs['headers'] = {'Range': 'bytes={}-'.format(offset)}
+        async with self._stream('GET', url, **kwargs) as response:
+            if response.status_code == 401:
+                raise UnauthorizedException()
+            if response.status_code == 416 and offset:
+                # the range does not fit the file (anymore)
+                restart = True
+            elif response.status_code == 206 and offset:
+                content_range = response.headers.get('content-range', '')
+                if not content_range.startswith('bytes {}-'.format(offset)):
+                    raise RuntimeError("Requested bytes from {} but got "
+                                       "{}.".format(offset, content_range))
+                restart = False
+            elif response.status_code == 200:
+                if offset:
+                    # the server ignored the range, start over
+                    await fp.seek(0)
+                    await fp.truncate()
+                    _reset_hashers(hashers)
+                restart = False
             else:
                 raise RuntimeError("Response has status "
                                 "code {}.".format(response.status_code))
+            if not restart:
+                async for data in response.aiter_bytes():
+                    await throttle('download', len(data))
+                    await fp.write(data)
+                    if hashers:
+                        for hash_ in hashers.values():
+                            hash_.update(data)
+                await fp.flush()
+
+        if restart:
+            await fp.seek(0)
+            await fp.truncate()
+            _reset_hashers(hashers)
+            await self._write_to(fp, url, hashers=hashers)
 
     async def remove(self):
         """Remove this file from the remote storage."""
         response = await self._delete(self._delete_url)
         if response.status_code != 204:
             raise RuntimeError('Could not delete {}.'.format(self.path))
+        _index_discard(self)
 
     async def update(self, fp):
         """Update the remote file from a local file.
@@ -145,6 +412,9 @@ class File(OSFCore):
             msg = ('Could not update {} (status '
                    'code: {}).'.format(self.path, response.status_code))
             raise RuntimeError(msg)
+        index, key = path_index(self)
+        if index is not None:
+            _index_uploaded(index, key[0], self._storage, key[1], response)
 
     async def move_to(self, storage, to_folder, to_filename=None, force=False):
         """Move this file to the remote storage."""
@@ -162,35 +432,133 @@ class File(OSFCore):
             raise RuntimeError('Could not move {} (status '
                                'code: {}).'.format(self.path,
                                                    response.status_code))
+        _index_moved(self, to_folder, body.get('rename'))
+
+
+def _reset_hashers(hashers):
+    if hashers:
+        for hash_type in hashers:
+            hashers[hash_type] = hashlib.new(hash_type)
+
+
+async def _hash_file(path, hashers, block_size=DOWNLOAD_CHUNK_SIZE):
+    with timed('hashing'):
+        async with aiofiles.open(path, 'rb') as fp:
+            while True:
+                block = await fp.read(block_size)
+                if not block:
+                    break
+                for hash_ in hashers.values():
+                    hash_.update(block)
+
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        n = os.pwrite(fd, view, offset)
+        view = view[n:]
+        offset += n
+
+
+def _contiguous_end(ranges, written):
+    """Return the end of the data written into `ranges` without gaps."""
+    end = ranges[0][0]
+    for (start, stop), n in zip(ranges, written):
+        end = start + n
+        if n < stop - start + 1:
+            break
+    return end
+
+
+def _entry_index_key(entry):
+    """Key of a file or folder in the path index of its storage."""
+    if entry._storage is None:
+        return None
+    storage_key = entry._storage._index_key()
+    if storage_key is None:
+        return None
+    return storage_key[0], norm_remote_path(entry.path)
+
+
+def _index_discard(entry):
+    """Remove `entry` from the path index after it was deleted."""
+    index, key = path_index(entry)
+    if index is not None:
+        index.discard(*key)
+
+
+def _index_moved(entry, to_folder, to_name=None):
+    """Update the path index after `entry` was moved into `to_folder`."""
+    _index_discard(entry)
+    index, key = path_index(to_folder)
+    if index is None:
+        return
+    root, path = key
+    # the moved entry may have replaced an existing one, list the target
+    # folder again the next time it is needed
+    index.discard(root, posixpath.join(path, to_name or entry.name))
+    index.invalidate(root, path)
+
+
+def _index_uploaded(index, root, storage, path, response):
+    """Put the file just uploaded to `path` into the path index."""
+    try:
+        data = response.json()['data']
+    except (ValueError, TypeError, KeyError):
+        # the server did not describe the new file, list its folder again
+        # the next time it is needed
+        index.invalidate(root, posixpath.dirname(path))
+        return
+    file_ = File(data, storage.session)
+    file_._storage = storage
+    index.add(root, file_)
 
 
 class ContainerMixin:
+    # the storage this folder was found in, used to key the path index
+    _storage = None
+
+    def _index_key(self):
+        return _entry_index_key(self)
+
+    def _child(self, klass, json):
+        child = klass(json, self.session)
+        child._storage = self._storage
+        return child
+
     async def _iter_children(
-        self, url: str, kind, klass: Type[OSFCoreType], recurse=None, target_filter=None
+        self, url: str, kind, klass: Type[OSFCoreType], recurse=None, target_filter=None,
+        page_size=None
     ) -> AsyncGenerator[OSFCoreType, None]:
         """Iterate over all children of `kind`
 
         Yield an instance of `klass` when a child is of type `kind`. Uses
         `recurse` as the path of attributes in the JSON returned from `url`
-        to find more children.
+        to find more children. Listings are requested in pages of
+        `page_size` entries, see `OSFCore._iter_entries`.
         """
-        async for children in self._follow_next(url):
-            for child in children:
-                if target_filter is not None and not target_filter(child):
-                    continue
-                kind_ = child['attributes']['kind']
-                if kind_ == kind:
-                    yield klass(child, self.session)
-                if kind_ != 'file' and recurse is not None:
-                    # recurse into a child and add entries to `children`
-                    url = self._get_attribute(child, *recurse)
-                    async for entry in self._iter_children(url, kind, klass,
-                                                           recurse=recurse,
-                                                           target_filter=target_filter):
-                        yield entry
+        # a streamed listing holds a slot of the limiter until it is read,
+        # so listings that recurse into their folders are not streamed
+        stream = False if recurse is not None else None
+        async for child in self._iter_entries(url, page_size=page_size,
+                                              stream=stream):
+            if target_filter is not None and not target_filter(child):
+                continue
+            kind_ = child['attributes']['kind']
+            if kind_ == kind:
+                yield self._child(klass, child)
+            if kind_ != 'file' and recurse is not None:
+                # recurse into a child and add entries to `children`
+                url = self._get_attribute(child, *recurse)
+                async for entry in self._iter_children(url, kind, klass,
+                                                       recurse=recurse,
+                                                       target_filter=target_filter,
+                                                       page_size=page_size):
+                    yield entry
 
     async def _iter_children_for_mixed_types(
-        self, url: str, klasses: Dict[str, Type], recurse=None, target_filter=None
+        self, url: str, klasses: Dict[str, Type], recurse=None, target_filter=None,
+        page_size=None
     ) -> AsyncGenerator[OSFCore, None]:
         """Iterate over all children
 
@@ -198,21 +566,25 @@ class ContainerMixin:
         that can handle multiple kinds of children. It takes a dictionary of
         `klasses` that maps kinds to classes.
         """
-        async for children in self._follow_next(url):
-            for child in children:
-                if target_filter is not None and not target_filter(child):
-                    continue
-                kind = child['attributes']['kind']
-                klass = klasses.get(kind)
-                if klass is not None:
-                    yield klass(child, self.session)
-                if kind != 'file' and recurse is not None:
-                    # recurse into a child and add entries to `children`
-                    url = self._get_attribute(child, *recurse)
-                    async for entry in self._iter_children_for_mixed_types(
-                        url, klasses, recurse=recurse, target_filter=target_filter
-                    ):
-                        yield entry
+        # a streamed listing holds a slot of the limiter until it is read,
+        # so listings that recurse into their folders are not streamed
+        stream = False if recurse is not None else None
+        async for child in self._iter_entries(url, page_size=page_size,
+                                              stream=stream):
+            if target_filter is not None and not target_filter(child):
+                continue
+            kind = child['attributes']['kind']
+            klass = klasses.get(kind)
+            if klass is not None:
+                yield self._child(klass, child)
+            if kind != 'file' and recurse is not None:
+                # recurse into a child and add entries to `children`
+                url = self._get_attribute(child, *recurse)
+                async for entry in self._iter_children_for_mixed_types(
+                    url, klasses, recurse=recurse, target_filter=target_filter,
+                    page_size=page_size
+                ):
+                    yield entry
 
     @property
     def files(self):
@@ -231,8 +603,26 @@ class ContainerMixin:
     @property
     def children(self):
         """Iterate over all children in this folder."""
+        return self.list_children()
+
+    def list_children(self, page_size=None):
+        """Iterate over all children in this folder, listed in pages of
+        `page_size` entries instead of the page size of the session."""
         return self._iter_children_for_mixed_types(self._files_url,
-                                                   {'file': File, 'folder': Folder})
+                                                   {'file': File, 'folder': Folder},
+                                                   page_size=page_size)
+
+    def walk(self, concurrency=DEFAULT_WALK_CONCURRENCY, ordered=True,
+             page_size=None):
+        """Iterate over all files and folders below this folder.
+
+        Up to `concurrency` folder listings are requested concurrently. Set
+        `ordered=False` to receive entries as soon as they are listed instead
+        of in depth-first order. Folders are listed in pages of `page_size`
+        entries, by default the page size of the session.
+        """
+        return walk(self, concurrency=concurrency, ordered=ordered,
+                    page_size=page_size)
 
     async def create_folder(self, name, exist_ok=False):
         url = self._new_folder_url
@@ -245,12 +635,23 @@ class ContainerMixin:
             raise FolderExistsException(name)
 
         elif response.status_code == 409 and exist_ok:
+            index, key = path_index(self)
+            if index is not None:
+                root, path = key
+                # the folder was created since this folder was listed
+                index.invalidate(root, path)
+                return await index.find(root, self, path,
+                                        posixpath.join(path, name))
             async for folder in self.folders:
                 if folder.name == name:
                     return folder
 
         elif response.status_code == 201:
-            return Folder(response.json()['data'], self.session)
+            folder = self._child(Folder, response.json()['data'])
+            index, key = path_index(folder)
+            if index is not None:
+                index.add(key[0], folder, listed=True)
+            return folder
 
         else:
             raise RuntimeError("Response has status code {} while creating "
@@ -304,6 +705,7 @@ class Folder(OSFCore, ContainerMixin):
         response = await self._delete(self._delete_url)
         if response.status_code != 204:
             raise RuntimeError('Could not delete {}.'.format(self.path))
+        _index_discard(self)
 
     async def move_to(self, storage, to_folder, to_foldername=None, force=False):
         """Move this file to the remote storage."""
@@ -321,4 +723,5 @@ class Folder(OSFCore, ContainerMixin):
             raise RuntimeError('Could not move {} (status '
                                'code: {}).'.format(self.path,
                                                    response.status_code))
+        _index_moved(self, to_folder, body.get('rename'))
 
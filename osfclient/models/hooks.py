@@ -0,0 +1,72 @@
+"""Observe the requests an `OSFSession` sends.
+
+Hooks are callables that `OSFSession.add_hook` registers. They are called
+with a `RequestEvent` once every request has finished, after any retries.
+"""
+import collections
+import logging
+import re
+from urllib.parse import urlsplit, urlunsplit
+
+
+logger = logging.getLogger(__name__)
+
+RequestEvent = collections.namedtuple('RequestEvent', [
+    'kind', 'method', 'url', 'url_template', 'status', 'bytes_in',
+    'bytes_out', 'ttfb', 'latency', 'retries', 'error',
+])
+RequestEvent.__doc__ = """A finished request.
+
+`kind` is the type of request, 'metadata', 'download' or 'upload'. `url`
+is the URL without its query string, `url_template` the URL with IDs
+replaced by `{id}`, for grouping requests. `status` is the status code of
+the last response, or None if there was none. `bytes_in` and `bytes_out`
+count the bytes received and sent, `ttfb` is the time in seconds until the
+headers of the last response arrived and `latency` the time until the
+request was finished, both counted from the first attempt. `retries` is
+the number of retries and `error` the exception the request failed with,
+or None.
+"""
+
+# path segments that are followed by an ID, other IDs contain a digit
+_ID_PARENTS = ('nodes', 'registrations', 'users', 'guids', 'resources')
+_LOOKS_LIKE_ID = re.compile(r'^(?=.*\d)[\w.-]{5,}$')
+
+
+def url_template(url):
+    """Return `url` without its query string and with the IDs in its
+    path replaced by `{id}`."""
+    parts = urlsplit(str(url))
+    segments = parts.path.split('/')
+    for i, segment in enumerate(segments):
+        if segment and (_LOOKS_LIKE_ID.match(segment) or
+                        (i > 0 and segments[i - 1] in _ID_PARENTS)):
+            segments[i] = '{id}'
+    return urlunsplit((parts.scheme, parts.netloc, '/'.join(segments),
+                       '', ''))
+
+
+def strip_query(url):
+    """Return `url` without its query string, which may hold secrets."""
+    parts = urlsplit(str(url))
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, '', ''))
+
+
+class SlowRequestLogger(object):
+    """Hook that logs a warning for every request that took `threshold`
+    seconds or longer."""
+    def __init__(self, threshold=10.0, log=logger):
+        self.threshold = threshold
+        self.log = log
+
+    def __call__(self, event):
+        if event.latency < self.threshold:
+            return
+        self.log.warning(
+            "Slow request: %s %s took %.1fs (first byte after %s, status "
+            "%s, %d retries, %d bytes in, %d bytes out%s).",
+            event.method, event.url, event.latency,
+            '-' if event.ttfb is None else '{:.1f}s'.format(event.ttfb),
+            event.status, event.retries, event.bytes_in, event.bytes_out,
+            '' if event.error is None else ', failed: {!r}'.format(
+                event.error))
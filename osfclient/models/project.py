@@ -1,8 +1,22 @@
+import asyncio
+import time
+
 from .core import OSFCore
 from .storage import Storage
 
 
+# seconds for which the list of storages of a project is reused
+DEFAULT_STORAGES_TTL = 300
+
+
 class Project(OSFCore):
+    # how long the list of storages is reused, None reuses it until it is
+    # refreshed explicitly and 0 disables reuse
+    storages_ttl = DEFAULT_STORAGES_TTL
+    _storages = None
+    _storages_expire = 0
+    _storages_lock = None
+
     def _update_attributes(self, project):
         """Update attributes from JSON response.
 
@@ -36,14 +50,15 @@ class Project(OSFCore):
     def __str__(self):
         return '<Project [{0}]>'.format(self.id)
 
-    async def storage(self, provider='osfstorage'):
-        """Return storage `provider`."""
-        stores = self._json(await self._get(self._storages_url), 200)
-        stores = stores['data']
-        for store in stores:
-            provides = self._get_attribute(store, 'attributes', 'provider')
-            if provides == provider:
-                return Storage(store, self.session)
+    async def storage(self, provider='osfstorage', refresh=False):
+        """Return storage `provider`.
+
+        The list of storages is fetched once and reused for `storages_ttl`
+        seconds. Pass `refresh=True` to fetch it again.
+        """
+        for store in await self._get_storages(refresh=refresh):
+            if store.provider == provider:
+                return store
 
         raise RuntimeError("Project has no storage "
                            "provider '{}'".format(provider))
@@ -51,7 +66,41 @@ class Project(OSFCore):
     @property
     async def storages(self):
         """Iterate over all storages for this projects."""
-        stores = self._json(await self._get(self._storages_url), 200)
-        stores = stores['data']
-        for store in stores:
-            yield Storage(store, self.session)
+        for store in await self._get_storages():
+            yield store
+
+    async def refresh_storages(self):
+        """Fetch the list of storages again and return it."""
+        return await self._get_storages(refresh=True)
+
+    async def _get_storages(self, refresh=False):
+        if self._storages_lock is None:
+            self._storages_lock = asyncio.Lock()
+        # concurrent callers wait for a single request
+        async with self._storages_lock:
+            if refresh or self._storages_expired():
+                await self._fetch_storages()
+            return list(self._storages)
+
+    def _storages_expired(self):
+        if self._storages is None:
+            return True
+        if self.storages_ttl is None:
+            return False
+        return time.monotonic() >= self._storages_expire
+
+    async def _fetch_storages(self):
+        stores = await self._json(await self._get(self._storages_url), 200)
+        # reuse the Storage instances of earlier requests
+        known = dict((store.id, store) for store in self._storages or [])
+        storages = []
+        for json in stores['data']:
+            store = known.get(self._get_attribute(json, 'id'))
+            if store is None:
+                store = Storage(json, self.session)
+            else:
+                store._update_attributes(json)
+            storages.append(store)
+        self._storages = storages
+        if self.storages_ttl is not None:
+            self._storages_expire = time.monotonic() + self.storages_ttl
@@ -1,9 +1,26 @@
+import asyncio
+import collections
+import email.utils
+import http.cookiejar
+import logging
 import os
-from contextlib import asynccontextmanager
+import random
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
 
 import httpx
 
 from ..exceptions import UnauthorizedException
+from ..utils import PathIndex
+from .hooks import RequestEvent, strip_query, url_template
+
+try:
+    import h2
+except ImportError:  # pragma: no cover
+    h2 = None
+
+
+logger = logging.getLogger(__name__)
 
 
 def _parse_timeout(timeout, default):
@@ -20,11 +37,265 @@ DEFAULT_TIMEOUT = httpx.Timeout(
     read=None
 )
 
+# Listing pages are requested one after another by default, see
+# `OSFCore._follow_next`.
+DEFAULT_PREFETCH_PAGES = 0
+# Listings are requested in pages of the server's default size, set
+# `page_size` to 'max' for the largest size the server allows, see
+# `OSFCore._follow_next`. Servers limit the page size they send, 'max'
+# asks for MAX_PAGE_SIZE entries.
+DEFAULT_PAGE_SIZE = None
+MAX_PAGE_SIZE = 1000
+# JSON responses larger than this are decoded in a worker thread, see
+# `OSFCore._json`.
+DEFAULT_JSON_THREAD_THRESHOLD = 1024 * 1024
+# Files of at least DEFAULT_SEGMENT_THRESHOLD bytes are downloaded in
+# DEFAULT_DOWNLOAD_SEGMENTS parts at the same time, see `File.download`.
+DEFAULT_DOWNLOAD_SEGMENTS = 4
+DEFAULT_SEGMENT_THRESHOLD = 64 * 1024 * 1024
+# connections to the storage backends downloads are redirected to, see
+# `OSFSession._follow_redirect`
+DEFAULT_REDIRECT_LIMITS = httpx.Limits(max_connections=64,
+                                       max_keepalive_connections=32)
+
+# responses and errors that are worth trying again a little later
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+RETRY_EXCEPTIONS = (httpx.TimeoutException, httpx.NetworkError,
+                    httpx.RemoteProtocolError)
+# errors raised before any of the request was sent, the only ones uploads
+# are retried after, as the server may have stored what it received
+CONNECT_EXCEPTIONS = (httpx.ConnectError, httpx.ConnectTimeout,
+                      httpx.PoolTimeout)
+
+
+class RetryPolicy(object):
+    """Retry requests that failed transiently up to `retries` times.
+
+    Before retry `n` (counting from 0) the request waits for as long as
+    the `Retry-After` header of the response asks, or else for a random
+    time between 0 and `backoff * 2 ** n` seconds, but at most `max_delay`
+    seconds. If `Retry-After` asks for longer than `max_delay`, the
+    response is returned instead of waiting.
+    """
+    def __init__(self, retries=5, backoff=0.5, max_delay=60.0):
+        if retries < 0:
+            raise ValueError("retries can not be negative, "
+                             "not {}.".format(retries))
+        self.retries = retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+
+    def delay(self, retry, response=None):
+        """Return how long to wait before retry number `retry`, or None if
+        the request should not be retried."""
+        if retry >= self.retries:
+            return None
+        retry_after = _retry_after(response)
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_delay else None
+        return random.uniform(0, min(self.max_delay,
+                                     self.backoff * 2 ** retry))
+
+
+def _retry_after(response):
+    """Return the seconds the `Retry-After` header of `response` asks to
+    wait, or None."""
+    if response is None:
+        return None
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class AdaptiveLimiter(object):
+    """Limit the number of concurrent requests, adapting the limit to how
+    the server copes with them.
+
+    The limit starts at `initial` requests. Every response that is neither
+    an error nor much slower than usual raises it by `1 / limit`, that is by
+    about one request per round of requests. A 429 or 5xx response, a
+    connection error or a response that took more than `latency_factor`
+    times the usual time multiplies it by `decrease`. Requests that were
+    sent before the last decrease do not decrease it again. The usual time
+    is the moving average of the time until the response headers arrive.
+    With `latency_factor=None` slow responses do not decrease the limit,
+    for requests whose time depends on the amount of data they send.
+    """
+    def __init__(self, initial=4, min_limit=1, max_limit=64, decrease=0.5,
+                 latency_factor=2.0, smoothing=0.1):
+        if not 1 <= min_limit <= initial <= max_limit:
+            raise ValueError("Limits have to be 1 <= min_limit <= initial "
+                             "<= max_limit.")
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.smoothing = smoothing
+        self.in_flight = 0
+        self.latency = None
+        self._decreased_at = float('-inf')
+        self._waiters = collections.deque()
+
+    @asynccontextmanager
+    async def slot(self):
+        """Wait for a free slot and hold it for one request.
+
+        Report the response with `slot.response(status_code)` or a
+        failure with `slot.error()`, connection errors raised in the block
+        are reported automatically.
+        """
+        await self._acquire()
+        slot = _Slot(self)
+        try:
+            yield slot
+        except RETRY_EXCEPTIONS:
+            slot.error()
+            raise
+        finally:
+            self.in_flight -= 1
+            self._wake()
+
+    async def _acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # pass on the wake-up this waiter can not use
+                    self._wake()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.in_flight += 1
+
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def _record(self, slot, latency, failed):
+        if (not failed and self.latency is not None and
+                self.latency_factor is not None):
+            failed = latency > self.latency_factor * self.latency
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.smoothing * (latency - self.latency)
+        if not failed:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._wake()
+        elif slot.started >= self._decreased_at:
+            self.limit = max(self.min_limit, self.limit * self.decrease)
+            self._decreased_at = time.monotonic()
+            logger.debug("Server is struggling, allowing %d concurrent "
+                         "requests.", int(self.limit))
+
+
+class _Slot(object):
+    def __init__(self, limiter=None):
+        self._limiter = limiter
+        self.started = time.monotonic()
+        self._reported = False
+
+    def response(self, status_code):
+        if self._limiter is not None:
+            failed = status_code in RETRY_STATUS_CODES or status_code >= 500
+            self._report(time.monotonic() - self.started, failed)
+
+    def error(self):
+        if self._limiter is not None:
+            self._report(None, True)
+
+    def _report(self, latency, failed):
+        if not self._reported:
+            self._reported = True
+            self._limiter._record(self, latency, failed)
+
+
+@asynccontextmanager
+async def _unlimited():
+    yield _Slot()
+
+
+def default_limiters():
+    """Return separate limiters for listings and other metadata requests,
+    and for downloads and uploads, see `OSFSession.limiters`.
+
+    An upload takes as long as its file needs to be sent, so only errors
+    decrease the limit of transfers, not slow responses.
+    """
+    return {'metadata': AdaptiveLimiter(initial=4, max_limit=32),
+            'transfer': AdaptiveLimiter(initial=2, max_limit=32,
+                                        latency_factor=None)}
+
+
+def _default_retry_policies():
+    # requests for listings and other metadata, downloads, and uploads,
+    # which send the whole file again
+    return {'metadata': RetryPolicy(),
+            'download': RetryPolicy(),
+            'upload': RetryPolicy(retries=3)}
+
 
 class OSFSession(httpx.AsyncClient):
-    def __init__(self, timeout=DEFAULT_TIMEOUT):
-        """Handle HTTP session related work."""
-        super(OSFSession, self).__init__(timeout=timeout)
+    def __init__(self, timeout=DEFAULT_TIMEOUT, http2=False,
+                 redirect_limits=DEFAULT_REDIRECT_LIMITS,
+                 prefetch_pages=DEFAULT_PREFETCH_PAGES):
+        """Handle HTTP session related work.
+
+        Listings request up to `prefetch_pages` pages ahead of the
+        consumer, see `OSFCore._follow_next`.
+
+        With `http2=True` concurrent requests share HTTP/2 connections to
+        servers that negotiate it, others are still talked to with
+        HTTP/1.1. HTTP/2 needs the h2 package (`pip install
+        osfclient[http2]`), without it HTTP/1.1 is used.
+
+        Redirected downloads are fetched with a second client that keeps
+        its connections, limited by `redirect_limits`, open until the
+        session is closed.
+
+        GET requests, downloads and uploads whose content can be sent
+        again are retried if they fail with one of `RETRY_STATUS_CODES` or
+        `RETRY_EXCEPTIONS`, as set by the `RetryPolicy` for `'metadata'`,
+        `'download'` and `'upload'` in `retry_policies`. Uploads are only
+        retried after errors that happened before anything was sent,
+        `CONNECT_EXCEPTIONS`, other PUT requests are not retried.
+
+        Set `limiters` to `default_limiters()` to adapt the number of
+        concurrent metadata requests and transfers to the server, see
+        `AdaptiveLimiter`.
+
+        Hooks added with `add_hook` are called with a `RequestEvent` for
+        every finished request.
+        """
+        if http2 and h2 is None:
+            logger.warning("HTTP/2 needs the h2 package, install it with "
+                           "`pip install osfclient[http2]`. Using HTTP/1.1.")
+            http2 = False
+        super(OSFSession, self).__init__(
+            timeout=timeout, http2=http2,
+            event_hooks={'response': [_mark_headers_received]})
+        self.http2 = http2
+        self._redirect_limits = redirect_limits
+        self._redirect_client = None
         self.headers.update({
             # Only accept JSON responses
             'Accept': 'application/vnd.api+json',
@@ -36,6 +307,64 @@ class OSFSession(httpx.AsyncClient):
             'User-Agent': 'osfclient v0.0.1',
             })
         self.base_url = 'https://api.osf.io/v2/'
+        # number of listing pages to request ahead of the consumer
+        self.prefetch_pages = prefetch_pages
+        # entries per listing page, 'max' or None for the server's default
+        self.page_size = DEFAULT_PAGE_SIZE
+        # hosts that answered a page size with 400 Bad Request
+        self.page_size_rejected = set()
+        # decode larger JSON responses in a worker thread
+        self.json_thread_threshold = DEFAULT_JSON_THREAD_THRESHOLD
+        # parse listing pages while they arrive, see `OSFCore._iter_entries`
+        self.stream_listings = False
+        # folder listings seen so far, set to None to always list folders
+        self.path_index = PathIndex()
+        # parallel range requests used to download a single large file
+        self.download_segments = DEFAULT_DOWNLOAD_SEGMENTS
+        self.segment_threshold = DEFAULT_SEGMENT_THRESHOLD
+        # how often each type of request is retried, see `RetryPolicy`
+        self.retry_policies = _default_retry_policies()
+        # AdaptiveLimiter for 'metadata' and 'transfer' requests, if any
+        self.limiters = {}
+        # called with a RequestEvent for every request, see `add_hook`
+        self.hooks = []
+
+    def add_hook(self, hook):
+        """Call `hook` with a `RequestEvent` after every request.
+
+        Hooks are called on the event loop, so they should return quickly.
+        Exceptions raised by hooks are logged and otherwise ignored.
+        """
+        self.hooks.append(hook)
+
+    def _emit(self, request, response, error):
+        if not self.hooks:
+            return
+        now = time.monotonic()
+        bytes_in = bytes_out = 0
+        ttfb = None
+        if isinstance(response, httpx.Response):
+            bytes_in = response.num_bytes_downloaded
+            bytes_out = int(response.request.headers.get('Content-Length')
+                            or 0)
+            headers_received = response.extensions.get(_HEADERS_RECEIVED)
+            if headers_received is not None:
+                ttfb = headers_received - request.started
+        if request.counter is not None:
+            bytes_out = request.counter.sent
+        event = RequestEvent(
+            kind=request.kind, method=request.method,
+            url=strip_query(request.url),
+            url_template=url_template(request.url),
+            status=getattr(response, 'status_code', None),
+            bytes_in=bytes_in, bytes_out=bytes_out, ttfb=ttfb,
+            latency=now - request.started, retries=request.retries,
+            error=error)
+        for hook in self.hooks:
+            try:
+                hook(event)
+            except Exception:
+                logger.exception("Request hook %r failed.", hook)
 
     def set_endpoint(self, base_url):
         self.base_url = base_url
@@ -53,22 +382,154 @@ class OSFSession(httpx.AsyncClient):
 
     async def put(self, url, *args, **kwargs):
         kwargs_ = self.modify_kwargs(kwargs)
-        response = await super(OSFSession, self).put(url, *args, **kwargs_)
+        content = kwargs_.get('content')
+        request = _Request('metadata' if content is None else 'upload',
+                           'PUT', url)
+        # creating a folder is not idempotent, so PUTs without content
+        # are not sent again
+        request.retry = (content is not None and _can_send_again(content)
+                         and not (kwargs_.get('data') or kwargs_.get('files')))
+        request.retry_errors = CONNECT_EXCEPTIONS
+        if self.hooks and hasattr(content, '__aiter__'):
+            # count what is sent of streamed uploads
+            content = request.counter = _CountingChunks(content)
+            kwargs_ = dict(kwargs_, content=content)
+        rewind = getattr(content, 'rewind', None)
+        response = await self._retry(
+            request,
+            lambda: super(OSFSession, self).put(url, *args, **kwargs_),
+            rewind=rewind,
+            limit='metadata' if content is None else 'transfer')
         if response.status_code == 401:
             raise UnauthorizedException()
         return response
 
-    def stream(self, method, url, *args, **kwargs):
+    async def post(self, url, *args, **kwargs):
+        request = _Request('metadata', 'POST', url)
+        request.retry = False
+        return await self._retry(
+            request, lambda: super(OSFSession, self).post(url, *args, **kwargs))
+
+    async def delete(self, url, *args, **kwargs):
+        request = _Request('metadata', 'DELETE', url)
+        request.retry = False
+        return await self._retry(
+            request,
+            lambda: super(OSFSession, self).delete(url, *args, **kwargs))
+
+    def _retry_delay(self, kind, retry, response=None):
+        policy = self.retry_policies.get(kind) if kind else None
+        if policy is None:
+            return None
+        delay = policy.delay(retry, response)
+        if delay is not None:
+            reason = (response.status_code if response is not None
+                      else 'connection error')
+            logger.info("Retrying %s request after %s in %.1fs.",
+                        kind, reason, delay)
+        return delay
+
+    def _slot(self, limit):
+        limiter = self.limiters.get(limit) if limit else None
+        if limiter is None:
+            return _unlimited()
+        return limiter.slot()
+
+    async def _retry(self, request, send, rewind=None, limit=None):
+        """Send `request` with `send` and retry it according to the retry
+        policy for its kind, calling `rewind` before each retry.
+
+        Each attempt waits for a slot of the `limit` limiter.
+        """
+        kind = request.kind if request.retry else None
+        response = error = None
+        try:
+            while True:
+                async with self._slot(limit) as slot:
+                    try:
+                        response = await send()
+                    except RETRY_EXCEPTIONS as e:
+                        slot.error()
+                        delay = None
+                        if isinstance(e, request.retry_errors):
+                            delay = self._retry_delay(kind, request.retries)
+                        if delay is None:
+                            raise
+                    else:
+                        slot.response(response.status_code)
+                        delay = None
+                        if response.status_code in RETRY_STATUS_CODES:
+                            delay = self._retry_delay(kind, request.retries,
+                                                      response)
+                        if delay is None:
+                            return response
+                        await response.aclose()
+                await asyncio.sleep(delay)
+                request.retries += 1
+                if rewind is not None:
+                    await rewind()
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._emit(request, response, error)
+
+    @asynccontextmanager
+    async def _retry_stream(self, request, open_stream, limit='transfer'):
+        """Like `_retry` for streaming requests, opened with `open_stream`.
+
+        Only opening the stream is retried, errors while the body is read
+        are left to the caller. The slot of the `limit` limiter is held
+        until the body has been read.
+        """
+        kind = request.kind if request.retry else None
+        response = error = None
+        try:
+            while True:
+                async with self._slot(limit) as slot, \
+                        AsyncExitStack() as stack:
+                    try:
+                        response = await stack.enter_async_context(
+                            open_stream())
+                    except RETRY_EXCEPTIONS:
+                        slot.error()
+                        delay = self._retry_delay(kind, request.retries)
+                        if delay is None:
+                            raise
+                    else:
+                        slot.response(response.status_code)
+                        delay = None
+                        if response.status_code in RETRY_STATUS_CODES:
+                            delay = self._retry_delay(kind, request.retries,
+                                                      response)
+                        if delay is None:
+                            yield response
+                            return
+                await asyncio.sleep(delay)
+                request.retries += 1
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._emit(request, response, error)
+
+    def stream(self, method, url, *args, kind='download', **kwargs):
         """Stream with safe redirect handling.
 
         When WaterButler returns a redirect to S3 (or other external storage),
         we must not forward Content-Type and Accept headers because they would
         break S3's presigned URL signature validation.
+
+        `kind` is 'download' for files, which are limited by the 'transfer'
+        limiter, or 'metadata' for listings, limited by the 'metadata'
+        limiter.
         """
-        return self._stream_with_safe_redirect(method, url, *args, **kwargs)
+        return self._stream_with_safe_redirect(method, url, *args, kind=kind,
+                                               **kwargs)
 
     @asynccontextmanager
-    async def _stream_with_safe_redirect(self, method, url, *args, **kwargs):
+    async def _stream_with_safe_redirect(self, method, url, *args,
+                                         kind='download', **kwargs):
         """Stream with redirect handling that strips API headers.
 
         - 301, 302, 303: Follow as GET with minimal headers
@@ -76,10 +537,14 @@ class OSFSession(httpx.AsyncClient):
         """
         kwargs_no_redirect = kwargs.copy()
         kwargs_no_redirect.update(dict(follow_redirects=False))
+        request = _Request(kind, method.upper(), url)
+        request.retry = request.method in ('GET', 'HEAD')
 
         redirect_location = None
-        async with super(OSFSession, self).stream(
-            method, url, *args, **kwargs_no_redirect
+        async with self._retry_stream(
+            request, lambda: super(OSFSession, self).stream(
+                method, url, *args, **kwargs_no_redirect),
+            limit='transfer' if kind == 'download' else 'metadata'
         ) as response:
             if response.status_code in (301, 302, 303):
                 if response.headers.get('location'):
@@ -95,11 +560,14 @@ class OSFSession(httpx.AsyncClient):
                 yield response
                 return
 
-        async with self._follow_redirect(redirect_location) as redirected_response:
+        # a range request has to be repeated against the new location
+        range_ = httpx.Headers(kwargs.get('headers') or {}).get('Range')
+        async with self._follow_redirect(redirect_location,
+                                         range_=range_) as redirected_response:
             yield redirected_response
 
     @asynccontextmanager
-    async def _follow_redirect(self, url: str):
+    async def _follow_redirect(self, url: str, range_=None):
         """Follow a redirect with minimal headers.
 
         Only sends headers that won't interfere with presigned URL signatures.
@@ -108,14 +576,42 @@ class OSFSession(httpx.AsyncClient):
             'User-Agent': self.headers.get('User-Agent', 'osfclient v0.0.1'),
             'Accept-Charset': self.headers.get('Accept-Charset', 'utf-8'),
         }
+        if range_ is not None:
+            clean_headers['Range'] = range_
 
-        async with httpx.AsyncClient(timeout=self._timeout) as clean_client:
-            async with clean_client.stream('GET', url, headers=clean_headers) as response:
-                yield response
+        clean_client = self._clean_client()
+        async with self._retry_stream(
+            _Request('download', 'GET', url),
+            lambda: clean_client.stream('GET', url, headers=clean_headers)
+        ) as response:
+            yield response
+
+    def _clean_client(self):
+        """Return the client redirects are followed with.
+
+        It is created on first use and shared by all redirects of this
+        session, so that downloads reuse its connections. It never sends
+        cookies, so requests stay as clean as with a new client.
+        """
+        if self._redirect_client is None:
+            self._redirect_client = httpx.AsyncClient(
+                timeout=self._timeout, http2=self.http2,
+                limits=self._redirect_limits, cookies=_no_cookies(),
+                event_hooks={'response': [_mark_headers_received]})
+        return self._redirect_client
+
+    async def aclose(self):
+        if self._redirect_client is not None:
+            await self._redirect_client.aclose()
+            self._redirect_client = None
+        await super(OSFSession, self).aclose()
 
     async def get(self, url, *args, **kwargs):
         kwargs_ = self.modify_kwargs(kwargs)
-        response = await super(OSFSession, self).get(url, *args, **kwargs_)
+        response = await self._retry(
+            _Request('metadata', 'GET', url),
+            lambda: super(OSFSession, self).get(url, *args, **kwargs_),
+            limit='metadata')
         if response.status_code == 401:
             raise UnauthorizedException()
         return response
@@ -126,3 +622,57 @@ class OSFSession(httpx.AsyncClient):
         r = kwargs.copy()
         r.update(dict(follow_redirects=True))
         return r
+
+
+class _Request(object):
+    """What `OSFSession` tracks of a request across its retries."""
+    def __init__(self, kind, method, url):
+        self.kind = kind
+        self.method = method
+        self.url = url
+        # whether the request may be sent again, and after which errors
+        self.retry = True
+        self.retry_errors = RETRY_EXCEPTIONS
+        self.retries = 0
+        self.started = time.monotonic()
+        self.counter = None
+
+
+class _CountingChunks(object):
+    """Count the bytes of an upload while they are sent."""
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self.sent = 0
+
+    @property
+    def rewindable(self):
+        return getattr(self._chunks, 'rewindable', False)
+
+    async def rewind(self):
+        await self._chunks.rewind()
+        self.sent = 0
+
+    async def __aiter__(self):
+        async for chunk in self._chunks:
+            self.sent += len(chunk)
+            yield chunk
+
+
+_HEADERS_RECEIVED = 'osfclient.headers_received'
+
+
+async def _mark_headers_received(response):
+    response.extensions[_HEADERS_RECEIVED] = time.monotonic()
+
+
+def _can_send_again(content):
+    """Whether a request body can be sent once more."""
+    if isinstance(content, (bytes, str)):
+        return True
+    return getattr(content, 'rewindable', False)
+
+
+def _no_cookies():
+    """Return a cookie jar that does not store any cookies."""
+    return http.cookiejar.CookieJar(
+        http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
@@ -9,15 +9,15 @@ from .core import OSFCore
 from .file import ContainerMixin
 from .file import File
 from .file import Folder
+from .file import _index_uploaded
 from ..utils import file_empty
 from ..utils import get_local_file_size
 from ..utils import norm_remote_path
 from ..utils import find_by_path
 from ..utils import is_folder
 from ..utils import checksum_fp
-from ..utils import norm_remote_path
-from ..utils import find_by_path
-from .utils import chunked_bytes_iterator, merge_query_params
+from ..utils import path_index
+from .utils import HashingChunks, chunked_bytes_iterator, merge_query_params
 
 
 logger = logging.getLogger(__name__)
@@ -54,6 +54,16 @@ class Storage(OSFCore, ContainerMixin):
     def __str__(self):
         return '<Storage [{0}]>'.format(self.id)
 
+    @property
+    def _storage(self):
+        return self
+
+    def _index_key(self):
+        files_url = getattr(self, '_files_url', None)
+        if files_url is None:
+            return None
+        return files_url, ''
+
     @property
     def files(self):
         """Iterate over all files in this storage."""
@@ -79,6 +89,9 @@ class Storage(OSFCore, ContainerMixin):
 
         To force overwrite of an existing file, set `force=True`.
         To overwrite an existing file only if the files differ, set `update=True`
+
+        Returns False if the file was not uploaded because an identical
+        file already exists, True otherwise.
         """
         if hasattr(fp, 'mode') and 'b' not in fp.mode:
             raise ValueError("File has to be opened in binary mode.")
@@ -87,19 +100,26 @@ class Storage(OSFCore, ContainerMixin):
         path = norm_remote_path(path)
 
         directory, fname = os.path.split(path)
-        directories = directory.split(os.path.sep)
-        # navigate to the right parent object for our file
-        parent = self
-        for directory in directories:
-            # skip empty directory names
-            if directory:
-                parent = await parent.create_folder(directory, exist_ok=True)
+        index, key = path_index(self)
+        if index is not None:
+            # folders resolved for earlier uploads are not created again
+            parent = await index.folder(key[0], self, key[1], directory)
+        else:
+            directories = directory.split(os.path.sep)
+            # navigate to the right parent object for our file
+            parent = self
+            for directory in directories:
+                # skip empty directory names
+                if directory:
+                    parent = await parent.create_folder(directory,
+                                                        exist_ok=True)
 
         url = parent._new_file_url
 
         # When uploading a large file (>a few MB) that already exists
         # we sometimes get a HTTPError instead of a status == 409.
         connection_error = False
+        hashed = None
 
         # peek at the file to check if it is an empty file which needs special
         # handling in requests. If we pass a file like object to data that
@@ -115,16 +135,26 @@ class Storage(OSFCore, ContainerMixin):
 
         else:
             logger.info("Uploading file: %s", path)
+            content = chunked_bytes_iterator(fp) if hasattr(fp, 'read') else fp
+            if update and not force and hasattr(fp, 'read'):
+                # if the file exists already, compare it by the hash of the
+                # data sent instead of reading it again
+                content = hashed = HashingChunks(content)
             try:
                 response = await self._put(
                     url,
                     params=merge_query_params(url, {'name': fname}),
-                    content=chunked_bytes_iterator(fp) if hasattr(fp, 'read') else fp,
+                    content=content,
                 )
             except HTTPError:
                 connection_error = True
                 logger.info("Connection error while uploading file: %s", path)
 
+        if not connection_error and response.status_code == 201:
+            index, key = path_index(parent)
+            if index is not None:
+                _index_uploaded(index, key[0], self, path, response)
+
         if connection_error or response.status_code == 409:
             if not force and not update:
                 # one-liner to get file size from file pointer from
@@ -142,7 +172,11 @@ class Storage(OSFCore, ContainerMixin):
                     # note in case of connection error, we are making an inference here
                     raise FileExistsError(path)
             else:
-                # find the upload URL for the file we are trying to update
+                # find the upload URL for the file we are trying to update,
+                # it may have been created since its folder was listed
+                index, key = path_index(parent)
+                if index is not None:
+                    index.invalidate(*key)
                 file_ = await find_by_path(self, path)
                 if file_ is None:
                     raise RuntimeError("Could not create a new file at "
@@ -150,15 +184,21 @@ class Storage(OSFCore, ContainerMixin):
                 if is_folder(file_):
                     raise RuntimeError("Cannot update a folder.")
                 if not force:
-                    if await checksum_fp(fp) == file_.hashes.get('md5'):
+                    checksum = None
+                    if hashed is not None:
+                        checksum = hashed.hexdigest()
+                    if checksum is None:
+                        checksum = await checksum_fp(fp)
+                    if checksum == file_.hashes.get('md5'):
                         # If the hashes are equal and force is False,
                         # we're done here
                         logger.info("File already exists and hashes match, "
                                     "skipping upload. local: %s, remote: %s" %
-                                    (await checksum_fp(fp), file_.hashes.get('md5')))
-                        return
+                                    (checksum, file_.hashes.get('md5')))
+                        return False
                 # in the process of attempting to upload the file we
                 # moved through it -> reset read position to beginning
                 # of the file
                 await fp.seek(0)
                 await file_.update(fp)
+        return True
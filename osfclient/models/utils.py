@@ -1,22 +1,424 @@
+import asyncio
+import codecs
+import collections
+import hashlib
+import json
+import mmap
+import os
+import stat
 from typing import Any, AsyncIterable, Dict
 from urllib.parse import urlparse, parse_qs
 
+from ..utils import throttle
 
-DEFAULT_UPLOAD_BLOCK_SIZE = 1024 * 1024 * 128  # 128 MB
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
-async def chunked_bytes_iterator(
+DEFAULT_UPLOAD_BLOCK_SIZE = 1024 * 1024 * 8  # 8 MB
+# total size of the buffers that all uploads of the process read into
+DEFAULT_UPLOAD_BUFFER_MEMORY = 1024 * 1024 * 256  # 256 MB
+
+
+class BufferPool(object):
+    """Recycle the buffers that uploads read files into.
+
+    At most `max_memory` bytes of buffers of `buffer_size` bytes each exist
+    at the same time, but always at least one. `acquire` waits until a
+    buffer is released if all of them are in use.
+    """
+    def __init__(self, buffer_size=DEFAULT_UPLOAD_BLOCK_SIZE,
+                 max_memory=DEFAULT_UPLOAD_BUFFER_MEMORY):
+        if buffer_size < 1:
+            raise ValueError("buffer_size has to be at least 1 byte, "
+                             "not {}.".format(buffer_size))
+        self.buffer_size = buffer_size
+        self.max_buffers = max(1, max_memory // buffer_size)
+        self.allocated = 0
+        self._free = []
+        self._waiters = collections.deque()
+
+    async def acquire(self):
+        while not self._free and self.allocated >= self.max_buffers:
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # pass on the wake-up this waiter can not use
+                    self._wake()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        if self._free:
+            return self._free.pop()
+        self.allocated += 1
+        return bytearray(self.buffer_size)
+
+    def release(self, buf):
+        self._free.append(buf)
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+
+_upload_buffers = BufferPool()
+# send regular files straight from a memory map, see `configure_upload_buffers`
+_mmap_uploads = False
+
+
+def configure_upload_buffers(chunk_size=DEFAULT_UPLOAD_BLOCK_SIZE,
+                             max_memory=DEFAULT_UPLOAD_BUFFER_MEMORY,
+                             use_mmap=False):
+    """Set the size of the chunks uploads are sent in and the total memory
+    of the buffers used for them by the whole process.
+
+    With `use_mmap=True` regular files are memory-mapped and sent without
+    copying them into buffers first. A file that is truncated while it is
+    uploaded then crashes the process with SIGBUS, so only use this if the
+    files do not change during the upload.
+    """
+    global _upload_buffers, _mmap_uploads
+    _upload_buffers = BufferPool(chunk_size, max_memory)
+    _mmap_uploads = use_mmap
+
+
+def chunked_bytes_iterator(
     content: Any,
-    chunk_size=DEFAULT_UPLOAD_BLOCK_SIZE
+    chunk_size=None
 ) -> AsyncIterable[bytes]:
-    """Yield chunks of bytes from an asynchronous file-like object."""
+    """Yield chunks of bytes from an asynchronous file-like object.
+
+    File objects that support `readinto` are read into a buffer from the
+    upload buffer pool, see `configure_upload_buffers`. The chunks are
+    views of that buffer, which is reused for the next chunk, so each chunk
+    has to be consumed before the next one is requested. If memory-mapped
+    uploads are enabled, the chunks of regular files are views of the map.
+    Each chunk waits for the upload rate limit, see
+    `osfclient.utils.set_rate_limits`.
+
+    The chunks can be iterated over again after `rewind`, see
+    `ChunkedBytes`.
+    """
     if not hasattr(content, 'read'):
         raise ValueError('content must have a read method')
-    while True:
-        chunk = await content.read(chunk_size)
-        if len(chunk) == 0:
-            break
-        yield chunk
+    return ChunkedBytes(content, chunk_size)
+
+
+class ChunkedBytes(object):
+    """The chunks of `content` returned by `chunked_bytes_iterator`.
+
+    `rewind` seeks `content` back to where the first iteration started, so
+    that a failed upload can be sent again. `rewindable` is False if that
+    is not possible.
+    """
+    def __init__(self, content, chunk_size=None):
+        self._content = content
+        self._chunk_size = chunk_size
+        self._started = False
+        self._start = None
+
+    @property
+    def rewindable(self):
+        return not self._started or self._start is not None
+
+    async def rewind(self):
+        if not self.rewindable:
+            raise ValueError("Can not seek back to the start of the chunks.")
+        if self._start is not None:
+            await self._content.seek(self._start)
+
+    async def __aiter__(self):
+        if not self._started:
+            self._started = True
+            try:
+                self._start = await self._content.tell()
+            except (AttributeError, OSError, ValueError):
+                # pipes and other streams can only be sent once
+                self._start = None
+        async for chunk in _chunks(self._content, self._chunk_size):
+            yield chunk
+
+
+async def _chunks(content, chunk_size=None):
+    pool = _upload_buffers
+    if _mmap_uploads and chunk_size is None:
+        mapped = await _map_file(content)
+        if mapped is not None:
+            async for chunk in _mapped_chunks(*mapped, pool.buffer_size):
+                await throttle('upload', len(chunk))
+                yield chunk
+            return
+    if not hasattr(content, 'readinto') or (
+            chunk_size is not None and chunk_size != pool.buffer_size):
+        chunk_size = chunk_size or pool.buffer_size
+        while True:
+            chunk = await content.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            await throttle('upload', len(chunk))
+            yield chunk
+        return
+
+    buf = await pool.acquire()
+    try:
+        view = memoryview(buf)
+        while True:
+            n = await content.readinto(buf)
+            if not n:
+                break
+            await throttle('upload', n)
+            yield view[:n]
+    finally:
+        pool.release(buf)
+
+
+async def _map_file(content):
+    """Memory-map the regular file `content` is reading from, returns the
+    map and the current position of `content`, or None."""
+    try:
+        fd = content.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+    if not isinstance(fd, int):
+        return None
+    st = os.fstat(fd)
+    if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+        return None
+    mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    if hasattr(mapped, 'madvise'):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    return mapped, await content.tell()
+
+
+async def _mapped_chunks(mapped, start, chunk_size):
+    view = memoryview(mapped)
+    try:
+        for pos in range(start, len(mapped), chunk_size):
+            chunk = view[pos:pos + chunk_size]
+            yield chunk
+            chunk.release()
+    finally:
+        view.release()
+        try:
+            mapped.close()
+        except BufferError:
+            # a consumer still holds a chunk, the map is closed once that
+            # is garbage collected
+            pass
+
+
+class HashingChunks(object):
+    """Hash the chunks of an upload while they are sent.
+
+    Iterate over this instead of `chunks`. Once all chunks have been sent
+    `hexdigest` returns the hash of the data, before that it returns None.
+    The hashes are updated in a worker thread, so that large chunks do not
+    hold up the event loop.
+    """
+    def __init__(self, chunks, hash_types=('md5',)):
+        self._chunks = chunks
+        self._hashes = dict((hash_type, hashlib.new(hash_type))
+                            for hash_type in hash_types)
+        self.complete = False
+
+    async def __aiter__(self):
+        loop = asyncio.get_event_loop()
+        async for chunk in self._chunks:
+            for hash_ in self._hashes.values():
+                await loop.run_in_executor(None, hash_.update, chunk)
+            yield chunk
+        self.complete = True
+
+    @property
+    def rewindable(self):
+        return getattr(self._chunks, 'rewindable', False)
+
+    async def rewind(self):
+        """Start over, with new hashes."""
+        await self._chunks.rewind()
+        self._hashes = dict((hash_type, hashlib.new(hash_type))
+                            for hash_type in self._hashes)
+        self.complete = False
+
+    def hexdigest(self, hash_type='md5'):
+        if not self.complete:
+            return None
+        return self._hashes[hash_type].hexdigest()
+
+
+def loads(data):
+    """Decode the JSON document `data`, with orjson if it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+async def decode_json(response, thread_threshold=None):
+    """Return the decoded JSON body of `response`.
+
+    Bodies larger than `thread_threshold` bytes are decoded in a worker
+    thread, so that they do not hold up the other requests on the event
+    loop.
+    """
+    content = getattr(response, 'content', None)
+    if not isinstance(content, bytes):
+        return response.json()
+    if thread_threshold is None or len(content) <= thread_threshold:
+        return loads(content)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, loads, content)
+
+
+# returned by `ListingParser._decode` when a value is not complete yet
+_INCOMPLETE = object()
+
+
+class ListingParser(object):
+    """Parse a JSON object while it arrives and return the entries of its
+    `key` array as soon as they are complete.
+
+    `feed` takes the next bytes of the document and returns the entries
+    that were completed by them, `close` ends the document. The other
+    members of the object are collected in `fields`, e.g. the
+    `next_token` of a listing page, and are complete after `close`.
+    Invalid JSON, or a single value larger than `max_value_size`
+    characters, raises ValueError.
+
+    A value that is not complete yet is only decoded again once twice as
+    much of it has arrived, so that a large value arriving in many small
+    chunks is not decoded over and over.
+    """
+    def __init__(self, key='data', max_value_size=64 * 1024 * 1024):
+        self.key = key
+        self.max_value_size = max_value_size
+        self.fields = {}
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        # text that arrived after `_buf`, joined when it is parsed
+        self._pending = []
+        self._pending_size = 0
+        # characters to wait for before decoding an incomplete value again
+        self._wait_for = 0
+        self._state = 'start'
+        self._member = None
+        self._closed = False
+
+    def feed(self, data):
+        text = self._text.decode(bytes(data))
+        self._pending.append(text)
+        self._pending_size += len(text)
+        if len(self._buf) - self._pos + self._pending_size < self._wait_for:
+            return []
+        return self._parse()
+
+    def close(self):
+        self._pending.append(self._text.decode(b'', final=True))
+        self._closed = True
+        entries = self._parse()
+        if self._state != 'done':
+            raise ValueError("The JSON document ended early.")
+        return entries
+
+    def _parse(self):
+        self._buf = self._buf[self._pos:] + ''.join(self._pending)
+        self._pos = 0
+        self._pending = []
+        self._pending_size = 0
+        entries = []
+        while True:
+            while (self._pos < len(self._buf) and
+                   self._buf[self._pos] in ' \t\n\r'):
+                self._pos += 1
+            if self._pos == len(self._buf):
+                break
+            char = self._buf[self._pos]
+            state = self._state
+            if state == 'start':
+                self._expect(char, '{', 'first member')
+            elif state in ('first member', 'member'):
+                if state == 'first member' and char == '}':
+                    self._expect(char, '}', 'done')
+                    continue
+                member = self._decode()
+                if member is _INCOMPLETE:
+                    break
+                if not isinstance(member, str):
+                    raise ValueError("Expected a member name at "
+                                     "{}.".format(self._pos))
+                self._member = member
+                self._state = 'colon'
+            elif state == 'colon':
+                self._expect(char, ':', 'value')
+            elif state == 'value':
+                if self._member == self.key and char == '[':
+                    self._expect(char, '[', 'first entry')
+                    continue
+                value = self._decode()
+                if value is _INCOMPLETE:
+                    break
+                self.fields[self._member] = value
+                self._state = 'next member'
+            elif state == 'next member':
+                self._expect(char, ',}', 'member', 'done')
+            elif state in ('first entry', 'entry'):
+                if state == 'first entry' and char == ']':
+                    self._expect(char, ']', 'next member')
+                    continue
+                entry = self._decode()
+                if entry is _INCOMPLETE:
+                    break
+                entries.append(entry)
+                self._state = 'next entry'
+            elif state == 'next entry':
+                self._expect(char, ',]', 'entry', 'next member')
+            else:
+                raise ValueError("Extra data after the JSON document at "
+                                 "{}.".format(self._pos))
+        return entries
+
+    def _expect(self, char, expected, *states):
+        if char not in expected:
+            raise ValueError("Expected {!r} at {}, not {!r}.".format(
+                expected, self._pos, char))
+        self._state = states[expected.index(char)]
+        self._pos += 1
+
+    def _decode(self):
+        try:
+            value, end = self._decoder.raw_decode(self._buf, self._pos)
+        except ValueError:
+            if self._closed:
+                raise
+            return self._incomplete()
+        if (not self._closed and isinstance(value, (int, float)) and
+                not isinstance(value, bool) and
+                self._buf[end:end + 1] in ('', '.', 'e', 'E', '+', '-')):
+            # the rest of the number may not have arrived yet
+            return self._incomplete()
+        self._pos = end
+        self._wait_for = 0
+        return value
+
+    def _incomplete(self):
+        size = len(self._buf) - self._pos
+        if size > self.max_value_size:
+            raise ValueError("A JSON value is larger than {} "
+                             "characters.".format(self.max_value_size))
+        self._wait_for = 2 * size
+        return _INCOMPLETE
+
 
 def merge_query_params(url: str, params: Dict[str, str]) -> Dict[str, str]:
     """Merge query parameters into a new dictionary with the existing query parameters of a URL."""
@@ -0,0 +1,131 @@
+"""Summarize where a command spent its time, see `RunStats`."""
+import collections
+import math
+import time
+
+from .utils import set_phase_recorder
+
+
+# phases of a command, in the order they are reported
+PHASES = ('traversal', 'hashing', 'transfer', 'folder creation')
+
+
+def _phase(event):
+    if event.kind in ('download', 'upload'):
+        return 'transfer'
+    if event.method == 'GET':
+        return 'traversal'
+    if event.method == 'PUT':
+        return 'folder creation'
+    return None
+
+
+def percentile(values, p):
+    """Return the `p`th percentile of the sorted `values` by the nearest
+    rank method."""
+    if not values:
+        return None
+    rank = max(1, int(math.ceil(p / 100.0 * len(values))))
+    return values[rank - 1]
+
+
+def busy_time(intervals):
+    """Return the time covered by at least one of the `(start, end)`
+    intervals."""
+    total = 0.0
+    end = None
+    for start, stop in sorted(intervals):
+        if end is None or start > end:
+            total += stop - start
+            end = stop
+        elif stop > end:
+            total += stop - end
+            end = stop
+    return total
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1000:
+            break
+        size /= 1000.0
+    else:
+        unit = 'TB'
+    return ('{:.0f} {}' if unit == 'B' else '{:.1f} {}').format(size, unit)
+
+
+class RunStats(object):
+    """Collect the requests and the phases of a command.
+
+    Add an instance as a hook to the `OSFSession` to count the requests.
+    Listings are counted as traversal, creating folders as folder creation
+    and downloads and uploads as transfer. `record` is the phase recorder
+    for the local work, like hashing, see `osfclient.utils.timed`.
+
+    Phases overlap when transfers run concurrently, so `report` shows how
+    much of the wall time each phase was busy, not a breakdown that adds
+    up to the wall time.
+    """
+    def __init__(self):
+        self.started = time.monotonic()
+        self.latencies = collections.defaultdict(list)
+        self.retries = collections.Counter()
+        self.failures = collections.Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.intervals = collections.defaultdict(list)
+
+    def __call__(self, event):
+        end = time.monotonic()
+        operation = '{} {}'.format(event.kind, event.method)
+        self.latencies[operation].append(event.latency)
+        self.retries[operation] += event.retries
+        if event.error is not None or (event.status or 0) >= 400:
+            self.failures[operation] += 1
+        self.bytes_in += event.bytes_in
+        self.bytes_out += event.bytes_out
+        phase = _phase(event)
+        if phase is not None:
+            self.record(phase, end - event.latency, end)
+
+    def record(self, phase, start, end):
+        self.intervals[phase].append((start, end))
+
+    def report(self):
+        """Return the summary as text."""
+        wall = time.monotonic() - self.started
+        lines = ['HTTP requests:']
+        for operation in sorted(self.latencies):
+            latencies = sorted(self.latencies[operation])
+            lines.append(
+                '  {:<16} {:>7}  p50 {:.3f}s  p95 {:.3f}s  p99 {:.3f}s  '
+                '({} retries, {} failed)'.format(
+                    operation, len(latencies), percentile(latencies, 50),
+                    percentile(latencies, 95), percentile(latencies, 99),
+                    self.retries[operation], self.failures[operation]))
+        if not self.latencies:
+            lines.append('  none')
+        transfer = busy_time(self.intervals['transfer'])
+        transferred = self.bytes_in + self.bytes_out
+        lines.append('Received {}, sent {}, {}/s while transferring.'.format(
+            format_size(self.bytes_in), format_size(self.bytes_out),
+            format_size(transferred / transfer if transfer else 0)))
+        lines.append('Wall time {:.1f}s, of which busy with:'.format(wall))
+        for phase in PHASES:
+            busy = busy_time(self.intervals[phase])
+            lines.append('  {:<16} {:7.1f}s  {:3.0f}%'.format(
+                phase, busy, 100.0 * busy / wall if wall else 0))
+        return '\n'.join(lines)
+
+
+_run_stats = None
+
+
+def run_stats():
+    """Return the `RunStats` of this process, collecting phases from the
+    first call on."""
+    global _run_stats
+    if _run_stats is None:
+        _run_stats = RunStats()
+        set_phase_recorder(_run_stats.record)
+    return _run_stats
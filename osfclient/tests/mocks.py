@@ -13,8 +13,8 @@ def FutureWrapper(value=None):
 # When using a PropertyMock store it as an attribute
 # of the mock it belongs to so that later on a caller
 # can assert whether or not it has been accessed
-def MockFile(name):
-    mock = MagicMock(name='File-%s' % name, path=name)
+def MockFile(name, size=None):
+    mock = MagicMock(name='File-%s' % name, path=name, size=size)
     path = PropertyMock(return_value=name)
     type(mock).path = path
     mock._path_mock = path
@@ -23,6 +23,7 @@ def MockFile(name):
     type(mock).hashes = hashes
     mock._hashes_mock = hashes
     mock.write_to = MagicMock(return_value=FutureWrapper())
+    mock.download = MagicMock(side_effect=lambda path: FutureWrapper())
     mock.move_to = MagicMock(return_value=FutureWrapper())
     mock.remove = MagicMock(return_value=FutureWrapper())
     return mock
@@ -112,11 +113,20 @@ def MockProject(name):
 def MockArgs(output=None, project=None,
              source=None, destination=None, local=None, remote=None,
              target=None, force=False, update=False, recursive=False,
-             base_url=None, long_format=False, base_path=None):
+             base_url=None, long_format=False, base_path=None,
+             jobs=4, max_in_flight=1024 ** 3, segments=4,
+             chunk_size=8 * 1024 ** 2, buffer_memory=256 * 1024 ** 2,
+             mmap=False, http2=False, retries=None, adaptive=False,
+             slow_requests=None, stats=False, page_size=None,
+             stream_listings=False, prefetch=0):
     args = MagicMock(spec=['output', 'project',
                            'source', 'destination', 'target', 'force',
                            'recursive', 'base_url', 'long_format',
-                           'base_path'])
+                           'base_path', 'jobs', 'max_in_flight',
+                           'segments', 'chunk_size', 'buffer_memory',
+                           'mmap', 'http2', 'retries', 'adaptive',
+                           'slow_requests', 'stats', 'page_size',
+                           'stream_listings', 'prefetch'])
     args._output_mock = PropertyMock(return_value=output)
     type(args).output = args._output_mock
     args._project_mock = PropertyMock(return_value=project)
@@ -150,6 +160,35 @@ def MockArgs(output=None, project=None,
     args._recursive_mock = PropertyMock(return_value=recursive)
     type(args).recursive = args._recursive_mock
 
+    args._jobs_mock = PropertyMock(return_value=jobs)
+    type(args).jobs = args._jobs_mock
+    args._max_in_flight_mock = PropertyMock(return_value=max_in_flight)
+    type(args).max_in_flight = args._max_in_flight_mock
+    args._segments_mock = PropertyMock(return_value=segments)
+    type(args).segments = args._segments_mock
+    args._chunk_size_mock = PropertyMock(return_value=chunk_size)
+    type(args).chunk_size = args._chunk_size_mock
+    args._buffer_memory_mock = PropertyMock(return_value=buffer_memory)
+    type(args).buffer_memory = args._buffer_memory_mock
+    args._mmap_mock = PropertyMock(return_value=mmap)
+    type(args).mmap = args._mmap_mock
+    args._http2_mock = PropertyMock(return_value=http2)
+    type(args).http2 = args._http2_mock
+    args._retries_mock = PropertyMock(return_value=retries)
+    type(args).retries = args._retries_mock
+    args._adaptive_mock = PropertyMock(return_value=adaptive)
+    type(args).adaptive = args._adaptive_mock
+    args._slow_requests_mock = PropertyMock(return_value=slow_requests)
+    type(args).slow_requests = args._slow_requests_mock
+    args._stats_mock = PropertyMock(return_value=stats)
+    type(args).stats = args._stats_mock
+    args._page_size_mock = PropertyMock(return_value=page_size)
+    type(args).page_size = args._page_size_mock
+    args._stream_listings_mock = PropertyMock(return_value=stream_listings)
+    type(args).stream_listings = args._stream_listings_mock
+    args._prefetch_mock = PropertyMock(return_value=prefetch)
+    type(args).prefetch = args._prefetch_mock
+
     return args
 
 
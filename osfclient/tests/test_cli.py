@@ -82,6 +82,75 @@ def test_config_project():
     assert expected in e.value.args[0]
 
 
+@patch('osfclient.cli.config_from_env', return_value={})
+def test_setup_osf_segments(config_from_env):
+    args = MockArgs(project='pj', segments=2)
+
+    osf = cli._setup_osf(args)
+
+    assert osf.session.download_segments == 2
+
+
+@patch('osfclient.cli.config_from_env', return_value={})
+def test_setup_osf_retries(config_from_env):
+    args = MockArgs(project='pj', retries=1)
+
+    osf = cli._setup_osf(args)
+
+    assert all(policy.retries == 1
+               for policy in osf.session.retry_policies.values())
+
+
+@patch('osfclient.cli.config_from_env', return_value={})
+def test_setup_osf_adaptive(config_from_env):
+    osf = cli._setup_osf(MockArgs(project='pj'))
+    assert osf.session.limiters == {}
+
+    osf = cli._setup_osf(MockArgs(project='pj', adaptive=True))
+    assert sorted(osf.session.limiters) == ['metadata', 'transfer']
+
+
+@patch('osfclient.cli.config_from_env', return_value={})
+def test_setup_osf_prefetch(config_from_env):
+    osf = cli._setup_osf(MockArgs(project='pj', prefetch=2))
+
+    assert osf.session.prefetch_pages == 2
+
+    with pytest.raises(SystemExit):
+        cli._setup_osf(MockArgs(project='pj', prefetch=-1))
+
+
+@patch('osfclient.cli.config_from_env', return_value={})
+def test_setup_osf_stream_listings(config_from_env):
+    osf = cli._setup_osf(MockArgs(project='pj', stream_listings=True))
+
+    assert osf.session.stream_listings
+
+
+@patch('osfclient.cli.config_from_env', return_value={})
+def test_setup_osf_slow_requests(config_from_env):
+    osf = cli._setup_osf(MockArgs(project='pj', slow_requests=2.5))
+
+    assert len(osf.session.hooks) == 1
+    assert osf.session.hooks[0].threshold == 2.5
+
+
+@patch('osfclient.cli.run_stats')
+@patch('osfclient.cli.config_from_env', return_value={})
+def test_setup_osf_stats(config_from_env, run_stats):
+    osf = cli._setup_osf(MockArgs(project='pj', stats=True))
+
+    assert osf.session.hooks == [run_stats.return_value]
+
+
+@patch('osfclient.cli.OSF')
+@patch('osfclient.cli.config_from_env', return_value={'http2': 'true'})
+def test_setup_osf_http2_from_config(config_from_env, MockOSF):
+    cli._setup_osf(MockArgs(project='pj'))
+
+    assert MockOSF.call_args[1]['http2'] is True
+
+
 @patch('osfclient.cli.config_from_file', return_value={'username': 'tu2',
                                                        'project': 'pj2'})
 def test_init(config_from_file):
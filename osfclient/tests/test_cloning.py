@@ -1,14 +1,16 @@
 """Test `osf clone` command."""
 
+import asyncio
 import os
 import pytest
-from mock import patch, mock_open, call
+from mock import patch, mock_open, call, MagicMock
 
 from osfclient import OSF
 from osfclient.cli import clone
 
 from osfclient.tests.mocks import (
     MockProject, MockArgs, is_folder_mock, mock_async_open, FutureWrapper,
+    MockFile,
 )
 
 @pytest.mark.asyncio
@@ -126,3 +128,63 @@ async def test_clone_project_update_file_exists_and_differs(OSF_project, checksu
                                      fname)
 
             assert call(full_path, 'wb') in mock_open_func.mock_calls
+
+
+@pytest.mark.asyncio
+@patch.object(OSF, 'project', return_value=MockProject('1234'))
+async def test_clone_project_concurrent_downloads(OSF_project):
+    # check that `osf clone --jobs 2` downloads two files at the same time
+    args = MockArgs(project='1234', jobs=2)
+
+    in_flight = []
+    max_in_flight = []
+
+    async def slow_download(path):
+        in_flight.append(path)
+        max_in_flight.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.remove(path)
+
+    async for store in OSF_project.return_value.storages:
+        async for folder in store.children:
+            async for subfolder in folder.folders:
+                async for f in subfolder.files:
+                    f.download = MagicMock(side_effect=slow_download)
+
+    with patch('osfclient.cli.aiofiles.open', mock_async_open()):
+        with patch('osfclient.cli.makedirs'):
+            with patch('osfclient.cli.os.getenv', side_effect='SECRET'):
+                with patch('osfclient.cli.is_folder', side_effect=is_folder_mock):
+                    await clone(args)
+
+    # two storages with two files each
+    assert len(max_in_flight) == 4
+    assert max(max_in_flight) == 2
+
+
+@pytest.mark.asyncio
+@patch.object(OSF, 'project', return_value=MockProject('1234'))
+async def test_clone_project_download_fails(OSF_project):
+    # check that a failing download aborts `osf clone`
+    args = MockArgs(project='1234')
+
+    async for store in OSF_project.return_value.storages:
+        async for folder in store.children:
+            async for subfolder in folder.folders:
+                async for f in subfolder.files:
+                    f.download = MagicMock(side_effect=RuntimeError('failed'))
+
+    with patch('osfclient.cli.aiofiles.open', mock_async_open()):
+        with patch('osfclient.cli.makedirs'):
+            with patch('osfclient.cli.os.getenv', side_effect='SECRET'):
+                with patch('osfclient.cli.is_folder', side_effect=is_folder_mock):
+                    with pytest.raises(RuntimeError):
+                        await clone(args)
+
+
+@pytest.mark.asyncio
+async def test_clone_project_invalid_jobs():
+    args = MockArgs(project='1234', jobs=0)
+
+    with pytest.raises(SystemExit):
+        await clone(args)
@@ -15,6 +15,12 @@ from osfclient.tests.mocks import (
 )
 
 
+async def _download_calls(OSF_project, remote_path):
+    store = await OSF_project.return_value._storage_mock.return_value
+    file_ = await find_by_path(store, remote_path)
+    return file_.download.mock_calls
+
+
 async def _pick_element_by_index(iterable, index):
     count = 0
     async for element in iterable:
@@ -44,7 +50,7 @@ async def test_fetch_file(OSF_project, os_path_exists, os_makedirs):
 
     # should create a file in the same directory when no local
     # filename is specified
-    assert mock.call('a', 'wb') in mock_open_func.mock_calls
+    assert mock.call('a') in await _download_calls(OSF_project, 'a/a/a')
 
 
 @pytest.mark.asyncio
@@ -72,16 +78,13 @@ async def test_fetch_file_local_name_specified(OSF_project, os_path_exists,
     store = await project._storage_mock.return_value
     assert store._name_mock.return_value == 'osfstorage'
 
-    expected = [call._path_mock(), call.write_to(mock_stream), call._path_mock()]
+    expected = [call._path_mock(), call.download('foobar.txt'), call._path_mock()]
     file = await find_by_path(store, 'a/a/a')
     assert expected == file.mock_calls
     # second file should not have been looked at
     file = await find_by_path(store, 'b/b/b')
     assert [call._path_mock()] == file.mock_calls
 
-    # should create a file in the same directory when no local
-    # filename is specified
-    assert mock.call('foobar.txt', 'wb') in mock_open_func.mock_calls
     assert not os_makedirs.called
 
 
@@ -107,8 +110,8 @@ async def test_fetch_file_local_dir_specified(OSF_project, os_path_exists,
     store = await _pick_element_by_index(OSF_project.return_value.storages, 0)
     assert store._name_mock.return_value == 'osfstorage'
 
-    assert (mock.call('subdir/foobar.txt', 'wb') in
-            mock_open_func.mock_calls)
+    assert (mock.call('subdir/foobar.txt') in
+            await _download_calls(OSF_project, 'a/a/a'))
     assert mock.call('subdir', exist_ok=True) in os_makedirs.mock_calls
 
 
@@ -161,7 +164,7 @@ async def test_fetch_local_file_exists_force(OSF_project, os_makedirs):
 
     # should create a file in the same directory when no local
     # filename is specified
-    assert mock.call('a', 'wb') in mock_open_func.mock_calls
+    assert mock.call('a') in await _download_calls(OSF_project, 'a/a/a')
 
 
 @pytest.mark.asyncio
@@ -196,7 +199,7 @@ async def test_fetch_local_file_exists_update_files_differ(OSF_project, os_maked
 
     # should create a file in the same directory when no local
     # filename is specified
-    assert mock.call('a', 'wb') in mock_open_func.mock_calls
+    assert mock.call('a') in await _download_calls(OSF_project, 'a/a/a')
 
 
 @pytest.mark.asyncio
@@ -231,7 +234,7 @@ async def test_fetch_local_file_exists_update_files_match(OSF_project, os_makedi
 
     # should create a file in the same directory when no local
     # filename is specified
-    assert mock.call('a', 'wb') not in mock_open_func.mock_calls
+    assert mock.call('a') not in await _download_calls(OSF_project, 'a/a/a')
 
 
 @pytest.mark.asyncio
@@ -269,7 +272,7 @@ async def test_fetch_local_file_exists_force_overrides_update(OSF_project, os_ma
     # filename is specified.
     # file should be created even though local matches remote and update is
     # True, because force overrides update
-    assert mock.call('a', 'wb') in mock_open_func.mock_calls
+    assert mock.call('a') in await _download_calls(OSF_project, 'a/a/a')
 
 
 @pytest.mark.asyncio
@@ -293,7 +296,7 @@ async def test_fetch_last_file(OSF_project, os_path_exists, os_makedirs):
 
     # should create a file in the same directory when no local
     # filename is specified
-    assert mock.call('b', 'wb') in mock_open_func.mock_calls
+    assert mock.call('b') in await _download_calls(OSF_project, 'b/b/b')
     for f in store.files:
         assert f._path_mock.called
 
@@ -320,7 +323,7 @@ async def test_fetch_file_with_base_path(OSF_project, os_path_exists, os_makedir
 
     # should create a file in the same directory when no local
     # filename is specified
-    assert mock.call('b', 'wb') in mock_open_func.mock_calls
+    assert mock.call('b') in await _download_calls(OSF_project, 'b/b/b')
     for f in store.files[:-1]:
         assert not f._path_mock.called
     for f in store.files[-1:]:
@@ -1,5 +1,8 @@
 import asyncio
+import hashlib
 import io
+import os
+from mock import AsyncMock
 from mock import call
 from mock import patch
 from mock import MagicMock
@@ -11,6 +14,7 @@ from osfclient.models import OSFCore
 from osfclient.models import File
 from osfclient.models import Folder
 from osfclient.exceptions import FolderExistsException, UnauthorizedException
+from osfclient.utils import ChecksumCache, set_checksum_cache
 
 from osfclient.tests import fake_responses
 from osfclient.tests.mocks import (
@@ -444,3 +448,336 @@ async def test_move_file_failed():
     assert f._post.called
 
     assert 'Could not move' in e.value.args[0]
+
+
+def _fake_range_stream(content, honour_range=True, calls=None):
+    # fake `File._stream` serving `content`, optionally honouring Range
+    def fake_stream(method, url, headers=None):
+        if calls is not None:
+            calls.append(headers)
+        resp = MagicMock()
+        resp.headers = {}
+        range_ = (headers or {}).get('Range')
+        if range_ is not None and honour_range:
+            start, _, end = range_[len('bytes='):].partition('-')
+            start = int(start)
+            end = int(end) if end else len(content) - 1
+            resp.status_code = 206
+            resp.headers['content-range'] = 'bytes {}-{}/{}'.format(
+                start, end, len(content))
+            body = content[start:end + 1]
+        else:
+            resp.status_code = 200
+            body = content
+        resp.aiter_bytes = lambda: AsyncIterator([body])
+        stream = MagicMock()
+        stream.__aenter__ = AsyncMock(return_value=resp)
+        stream.__aexit__ = AsyncMock(return_value=None)
+        return stream
+    return fake_stream
+
+
+def _remote_file(content):
+    f = File({})
+    f.path = '/hello.txt'
+    f._download_url = 'http://example.com/download_url/'
+    f.size = len(content)
+    f.hashes = {'md5': hashlib.md5(content).hexdigest()}
+    return f
+
+
+@pytest.mark.asyncio
+async def test_download_file(tmp_path):
+    content = b'hello world'
+    path = str(tmp_path / 'hello.txt')
+    calls = []
+
+    f = _remote_file(content)
+    with patch.object(File, '_stream',
+                      side_effect=_fake_range_stream(content, calls=calls)):
+        await f.download(path)
+
+    with open(path, 'rb') as fp:
+        assert fp.read() == content
+    assert not os.path.exists(path + '.part')
+    assert calls == [None]
+
+
+@pytest.mark.asyncio
+async def test_download_empty_file(tmp_path):
+    path = str(tmp_path / 'empty.txt')
+    calls = []
+
+    f = _remote_file(b'')
+    with patch.object(File, '_stream',
+                      side_effect=_fake_range_stream(b'', calls=calls)):
+        await f.download(path)
+
+    with open(path, 'rb') as fp:
+        assert fp.read() == b''
+    assert not os.path.exists(path + '.part')
+
+
+@pytest.mark.asyncio
+async def test_download_file_multipart_etag(tmp_path):
+    # an md5 that is not a digest, like the ETag of a multipart upload,
+    # is not checked
+    content = b'hello world'
+    path = str(tmp_path / 'hello.txt')
+
+    f = _remote_file(content)
+    f.hashes = {'md5': 'd41d8cd98f00b204e9800998ecf8427e-3'}
+    with patch.object(File, '_stream',
+                      side_effect=_fake_range_stream(content)):
+        await f.download(path)
+
+    with open(path, 'rb') as fp:
+        assert fp.read() == content
+
+
+@pytest.mark.asyncio
+async def test_download_file_resume(tmp_path):
+    content = b'hello world'
+    path = str(tmp_path / 'hello.txt')
+    with open(path + '.part', 'wb') as fp:
+        fp.write(content[:5])
+    calls = []
+
+    f = _remote_file(content)
+    with patch.object(File, '_stream',
+                      side_effect=_fake_range_stream(content, calls=calls)):
+        await f.download(path)
+
+    with open(path, 'rb') as fp:
+        assert fp.read() == content
+    assert not os.path.exists(path + '.part')
+    assert calls == [{'Range': 'bytes=5-'}]
+
+
+@pytest.mark.asyncio
+async def test_download_file_resume_range_ignored(tmp_path):
+    content = b'hello world'
+    path = str(tmp_path / 'hello.txt')
+    with open(path + '.part', 'wb') as fp:
+        fp.write(content[:5])
+
+    f = _remote_file(content)
+    with patch.object(File, '_stream',
+                      side_effect=_fake_range_stream(content,
+                                                     honour_range=False)):
+        await f.download(path)
+
+    with open(path, 'rb') as fp:
+        assert fp.read() == content
+
+
+@pytest.mark.asyncio
+async def test_download_file_resume_corrupt(tmp_path):
+    # data from an earlier version of the file is discarded
+    content = b'hello world'
+    path = str(tmp_path / 'hello.txt')
+    with open(path + '.part', 'wb') as fp:
+        fp.write(b'HELLO')
+    calls = []
+
+    f = _remote_file(content)
+    with patch.object(File, '_stream',
+                      side_effect=_fake_range_stream(content, calls=calls)):
+        await f.download(path)
+
+    with open(path, 'rb') as fp:
+        assert fp.read() == content
+    assert calls == [{'Range': 'bytes=5-'}, None]
+
+
+@pytest.mark.asyncio
+async def test_download_file_hash_mismatch(tmp_path):
+    content = b'hello world'
+    path = str(tmp_path / 'hello.txt')
+
+    f = _remote_file(content)
+    f.hashes = {'md5': '0' * 32}
+    with patch.object(File, '_stream',
+                      side_effect=_fake_range_stream(content)):
+        with pytest.raises(RuntimeError):
+            await f.download(path)
+
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.part')
+
+
+@pytest.mark.asyncio
+async def test_download_file_hashes_while_streaming(tmp_path):
+    # the downloaded file is not read again to check its hashes
+    content = b'hello world'
+    path = str(tmp_path / 'hello.txt')
+
+    f = _remote_file(content)
+    f.hashes['sha256'] = hashlib.sha256(content).hexdigest()
+    with patch.object(File, '_stream',
+                      side_effect=_fake_range_stream(content)):
+        with patch('osfclient.models.file.checksum_path') as checksum:
+            await f.download(path)
+
+    assert not checksum.called
+    with open(path, 'rb') as fp:
+        assert fp.read() == content
+
+
+@pytest.mark.asyncio
+async def test_download_file_caches_checksums(tmp_path):
+    content = b'hello world'
+    path = str(tmp_path / 'hello.txt')
+    cache = ChecksumCache(':memory:')
+
+    f = _remote_file(content)
+    previous = set_checksum_cache(cache)
+    try:
+        with patch.object(File, '_stream',
+                          side_effect=_fake_range_stream(content)):
+            await f.download(path)
+    finally:
+        set_checksum_cache(previous)
+
+    assert cache.get(os.stat(path), 'md5') == f.hashes['md5']
+
+
+@pytest.mark.asyncio
+async def test_download_file_resume_hashes_prefix(tmp_path):
+    content = b'hello world'
+    path = str(tmp_path / 'hello.txt')
+    with open(path + '.part', 'wb') as fp:
+        fp.write(content[:5])
+
+    f = _remote_file(content)
+    f.hashes['sha256'] = hashlib.sha256(content).hexdigest()
+    with patch.object(File, '_stream',
+                      side_effect=_fake_range_stream(content)):
+        with patch('osfclient.models.file.checksum_path') as checksum:
+            await f.download(path)
+
+    assert not checksum.called
+    with open(path, 'rb') as fp:
+        assert fp.read() == content
+
+
+@pytest.mark.asyncio
+async def test_write_to_hash_mismatch():
+    fp = io.BytesIO(b"")
+    fp.mode = "b"
+    content = b'hello world'
+
+    f = _remote_file(content)
+    f.hashes['sha256'] = '0' * 64
+    with patch.object(File, '_stream',
+                      side_effect=_fake_range_stream(content)):
+        with pytest.raises(RuntimeError) as e:
+            await f.write_to(MockAsyncWriter(fp))
+
+    assert 'sha256' in str(e.value)
+
+
+@pytest.mark.asyncio
+async def test_write_to_rate_limit():
+    fp = io.BytesIO(b"")
+    fp.mode = "b"
+    content = b'hello world'
+
+    f = _remote_file(content)
+    with patch.object(File, '_stream',
+                      side_effect=_fake_range_stream(content)):
+        with patch('osfclient.models.file.throttle') as mock_throttle:
+            await f.write_to(MockAsyncWriter(fp))
+
+    assert fp.getvalue() == content
+    received = sum(c[0][1] for c in mock_throttle.call_args_list
+                   if c[0][0] == 'download')
+    assert received == len(content)
+
+
+@pytest.mark.asyncio
+async def test_download_file_segments(tmp_path):
+    content = b'hello world, hello segments'
+    path = str(tmp_path / 'hello.txt')
+    calls = []
+
+    f = _remote_file(content)
+    f.session.download_segments = 4
+    f.session.segment_threshold = 10
+    with patch.object(File, '_stream',
+                      side_effect=_fake_range_stream(content, calls=calls)):
+        await f.download(path)
+
+    with open(path, 'rb') as fp:
+        assert fp.read() == content
+    assert not os.path.exists(path + '.part')
+    assert calls == [{'Range': 'bytes=0-6'}, {'Range': 'bytes=7-13'},
+                     {'Range': 'bytes=14-20'}, {'Range': 'bytes=21-26'}]
+
+
+@pytest.mark.asyncio
+async def test_download_file_without_size(tmp_path):
+    # files without a reported size are downloaded in a single request
+    content = b'hello world, hello segments'
+    path = str(tmp_path / 'hello.txt')
+    calls = []
+
+    f = _remote_file(content)
+    f.size = None
+    f.session.download_segments = 4
+    f.session.segment_threshold = 10
+    with patch.object(File, '_stream',
+                      side_effect=_fake_range_stream(content, calls=calls)):
+        await f.download(path)
+
+    with open(path, 'rb') as fp:
+        assert fp.read() == content
+    assert calls == [None]
+
+
+@pytest.mark.asyncio
+async def test_download_file_segments_range_ignored(tmp_path):
+    # the server does not support ranges, fall back to a single request
+    content = b'hello world, hello segments'
+    path = str(tmp_path / 'hello.txt')
+    calls = []
+
+    f = _remote_file(content)
+    f.session.download_segments = 4
+    f.session.segment_threshold = 10
+    with patch.object(File, '_stream',
+                      side_effect=_fake_range_stream(content,
+                                                     honour_range=False,
+                                                     calls=calls)):
+        await f.download(path)
+
+    with open(path, 'rb') as fp:
+        assert fp.read() == content
+    assert calls == [{'Range': 'bytes=0-6'}, None]
+
+
+@pytest.mark.asyncio
+async def test_download_file_segment_fails(tmp_path):
+    # a failed segment keeps the data before it for resuming
+    content = b'hello world, hello segments'
+    path = str(tmp_path / 'hello.txt')
+    fake_stream = _fake_range_stream(content)
+
+    def failing_stream(method, url, headers=None):
+        if headers['Range'] == 'bytes=14-20':
+            raise RuntimeError('connection lost')
+        return fake_stream(method, url, headers)
+
+    f = _remote_file(content)
+    f.session.download_segments = 4
+    f.session.segment_threshold = 10
+    with patch.object(File, '_stream', side_effect=failing_stream):
+        with pytest.raises(RuntimeError):
+            await f.download(path)
+
+    assert not os.path.exists(path)
+    # how far the other segments got depends on scheduling
+    with open(path + '.part', 'rb') as fp:
+        data = fp.read()
+    assert len(data) <= 14
+    assert content.startswith(data)
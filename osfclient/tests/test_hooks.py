@@ -0,0 +1,39 @@
+from mock import MagicMock
+
+from osfclient.models.hooks import RequestEvent, SlowRequestLogger
+from osfclient.models.hooks import url_template
+
+
+def _event(**kwargs):
+    fields = dict(kind='metadata', method='GET',
+                  url='https://api.osf.io/v2/nodes/f3szh/files/',
+                  url_template='https://api.osf.io/v2/nodes/{id}/files/',
+                  status=200, bytes_in=10, bytes_out=0, ttfb=0.5,
+                  latency=1.0, retries=0, error=None)
+    fields.update(kwargs)
+    return RequestEvent(**fields)
+
+
+def test_url_template():
+    assert (url_template('https://api.osf.io/v2/nodes/abcde/files/'
+                         'osfstorage/?page=2') ==
+            'https://api.osf.io/v2/nodes/{id}/files/osfstorage/')
+    assert (url_template('https://files.osf.io/v1/resources/f3szh/'
+                         'providers/osfstorage/5a3bc12ef/?kind=file') ==
+            'https://files.osf.io/v1/resources/{id}/providers/osfstorage/'
+            '{id}/')
+
+
+def test_slow_request_logger():
+    log = MagicMock()
+    hook = SlowRequestLogger(threshold=5, log=log)
+
+    hook(_event(latency=4.9))
+    assert not log.warning.called
+
+    hook(_event(latency=12.0, retries=2))
+    message = log.warning.call_args[0][0] % log.warning.call_args[0][1:]
+    assert message.startswith('Slow request: GET '
+                              'https://api.osf.io/v2/nodes/f3szh/files/ '
+                              'took 12.0s')
+    assert '2 retries' in message
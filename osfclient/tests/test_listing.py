@@ -35,7 +35,8 @@ async def test_anonymous_doesnt_use_token(MockOSFClass):
 
     # We should not try to obtain a token
     assert call('OSF_TOKEN') in mock_getenv.mock_calls
-    MockOSFClass.assert_called_once_with(token=None, base_url=None)
+    MockOSFClass.assert_called_once_with(token=None, base_url=None,
+                                         http2=False)
 
 
 @pytest.mark.asyncio
@@ -56,7 +57,7 @@ async def test_token(MockOSFClass):
         await list_(args)
 
     MockOSFClass.assert_called_once_with(token='secret',
-                                         base_url=None)
+                                         base_url=None, http2=False)
     mock_getenv.assert_called_with('OSF_TOKEN')
 
 
@@ -78,7 +79,8 @@ async def test_base_url(MockOSFClass):
         await list_(args)
 
     MockOSFClass.assert_called_once_with(token='secret',
-                                         base_url='https://api.test.osf.io/v2/')
+                                         base_url='https://api.test.osf.io/v2/',
+                                         http2=False)
     mock_getenv.assert_called_with('OSF_TOKEN')
 
 
@@ -0,0 +1,225 @@
+import asyncio
+import hashlib
+import json
+
+import aiofiles
+import pytest
+from mock import MagicMock, call, patch
+
+from osfclient.models import utils
+from osfclient.models.utils import BufferPool, HashingChunks, ListingParser
+from osfclient.models.utils import chunked_bytes_iterator
+
+
+@pytest.fixture
+def upload_buffers():
+    previous = utils._upload_buffers
+    utils.configure_upload_buffers(chunk_size=4, max_memory=8)
+    yield utils._upload_buffers
+    utils._upload_buffers = previous
+
+
+@pytest.mark.asyncio
+async def test_chunked_bytes_iterator_reuses_buffers(tmp_path,
+                                                     upload_buffers):
+    path = tmp_path / 'file.txt'
+    path.write_bytes(b'hello world')
+
+    for _ in range(2):
+        async with aiofiles.open(str(path), 'rb') as fp:
+            chunks = [bytes(chunk)
+                      async for chunk in chunked_bytes_iterator(fp)]
+        assert chunks == [b'hell', b'o wo', b'rld']
+
+    assert upload_buffers.allocated == 1
+
+
+@pytest.mark.asyncio
+async def test_chunked_bytes_iterator_without_readinto(upload_buffers):
+    class Reader(object):
+        def __init__(self, data):
+            self.data = data
+
+        async def read(self, size):
+            chunk, self.data = self.data[:size], self.data[size:]
+            return chunk
+
+    chunks = [chunk
+              async for chunk in chunked_bytes_iterator(Reader(b'hello'))]
+
+    assert chunks == [b'hell', b'o']
+    assert upload_buffers.allocated == 0
+
+
+@pytest.mark.asyncio
+async def test_buffer_pool_limits_memory():
+    pool = BufferPool(buffer_size=4, max_memory=8)
+    first = await pool.acquire()
+    second = await pool.acquire()
+
+    third = asyncio.ensure_future(pool.acquire())
+    await asyncio.sleep(0)
+    assert not third.done()
+
+    pool.release(first)
+    assert await third is first
+    assert pool.allocated == 2
+    pool.release(second)
+    pool.release(first)
+
+
+@pytest.mark.asyncio
+async def test_buffer_pool_cancelled_waiter():
+    # a cancelled waiter passes its buffer on to the next one
+    pool = BufferPool(buffer_size=4, max_memory=4)
+    buf = await pool.acquire()
+    first = asyncio.ensure_future(pool.acquire())
+    second = asyncio.ensure_future(pool.acquire())
+    await asyncio.sleep(0)
+
+    pool.release(buf)
+    first.cancel()
+
+    assert await second is buf
+    assert first.cancelled()
+
+
+@pytest.mark.asyncio
+async def test_chunked_bytes_iterator_mmap(tmp_path):
+    previous = utils._upload_buffers, utils._mmap_uploads
+    utils.configure_upload_buffers(chunk_size=4, max_memory=8, use_mmap=True)
+    path = tmp_path / 'file.txt'
+    path.write_bytes(b'hello world')
+    try:
+        async with aiofiles.open(str(path), 'rb') as fp:
+            await fp.seek(2)
+            chunks = [bytes(chunk)
+                      async for chunk in chunked_bytes_iterator(fp)]
+        pool = utils._upload_buffers
+    finally:
+        utils._upload_buffers, utils._mmap_uploads = previous
+
+    # sent from the current position without any buffer
+    assert chunks == [b'llo ', b'worl', b'd']
+    assert pool.allocated == 0
+
+
+@pytest.mark.asyncio
+async def test_chunked_bytes_iterator_rate_limit(tmp_path, upload_buffers):
+    path = tmp_path / 'file.txt'
+    path.write_bytes(b'hello world')
+
+    with patch('osfclient.models.utils.throttle') as mock_throttle:
+        async with aiofiles.open(str(path), 'rb') as fp:
+            async for _ in chunked_bytes_iterator(fp):
+                pass
+
+    assert mock_throttle.call_args_list == [call('upload', 4),
+                                            call('upload', 4),
+                                            call('upload', 3)]
+
+
+@pytest.mark.asyncio
+async def test_chunked_bytes_iterator_rewind(tmp_path, upload_buffers):
+    path = tmp_path / 'file.txt'
+    path.write_bytes(b'hello world')
+
+    async with aiofiles.open(str(path), 'rb') as fp:
+        await fp.seek(6)
+        chunks = chunked_bytes_iterator(fp)
+        first = [bytes(chunk) async for chunk in chunks]
+        assert chunks.rewindable
+        await chunks.rewind()
+        second = [bytes(chunk) async for chunk in chunks]
+
+    assert first == second == [b'worl', b'd']
+
+
+def test_buffer_pool_invalid_size():
+    with pytest.raises(ValueError):
+        BufferPool(buffer_size=0)
+
+
+@pytest.mark.asyncio
+async def test_hashing_chunks():
+    async def chunks():
+        yield b'hello '
+        yield memoryview(b'world')
+
+    hashed = HashingChunks(chunks(), hash_types=('md5', 'sha256'))
+    iterator = hashed.__aiter__()
+    assert await iterator.__anext__() == b'hello '
+    # not everything has been sent yet
+    assert hashed.hexdigest() is None
+
+    async for _ in iterator:
+        pass
+
+    assert hashed.hexdigest() == hashlib.md5(b'hello world').hexdigest()
+    assert (hashed.hexdigest('sha256') ==
+            hashlib.sha256(b'hello world').hexdigest())
+
+
+@pytest.mark.asyncio
+async def test_decode_json():
+    class Response(object):
+        content = b'{"data": [1, 2]}'
+
+    assert await utils.decode_json(Response()) == {'data': [1, 2]}
+    with patch.object(asyncio.get_event_loop(), 'run_in_executor',
+                      wraps=asyncio.get_event_loop().run_in_executor) as mock_run:
+        # large responses are decoded in a worker thread
+        assert await utils.decode_json(Response(),
+                                       thread_threshold=8) == {'data': [1, 2]}
+    mock_run.assert_called_once_with(None, utils.loads, Response.content)
+
+
+def test_listing_parser():
+    document = {'data': [{'id': 'é', 'n': 12}, [], 3.5, True, None],
+                'links': {'next': None}, 'next_token': 'abc'}
+    data = json.dumps(document, ensure_ascii=False).encode('utf-8')
+    parser = ListingParser()
+
+    entries = []
+    for i in range(len(data)):
+        entries += parser.feed(data[i:i + 1])
+        if i < len(data) - 1:
+            # numbers at the end of the data may not be complete yet
+            assert entries == document['data'][:len(entries)]
+    entries += parser.close()
+
+    assert entries == document['data']
+    assert parser.fields == {'links': {'next': None}, 'next_token': 'abc'}
+
+
+def test_listing_parser_large_entry():
+    # an entry much larger than a read, arriving in many small chunks
+    entry = {'id': 'x' * 1000000, 'attributes': {'n': list(range(1000))}}
+    data = json.dumps({'data': [entry, 1]}).encode('utf-8')
+    parser = ListingParser()
+    decoder = parser._decoder = MagicMock(wraps=parser._decoder)
+
+    entries = []
+    for i in range(0, len(data), 1000):
+        entries += parser.feed(data[i:i + 1000])
+    entries += parser.close()
+
+    assert entries == [entry, 1]
+    # not decoded again for every chunk
+    assert decoder.raw_decode.call_count < 50
+
+
+def test_listing_parser_value_too_large():
+    parser = ListingParser(max_value_size=100)
+    with pytest.raises(ValueError):
+        for i in range(100):
+            parser.feed(b'{"data": ["' if i == 0 else b'xxxxxxxxxx')
+
+
+@pytest.mark.parametrize('data', [b'[]', b'{"data": [1,]}', b'{"data": [1]',
+                                  b'{"data": []} {}', b'{1: 2}'])
+def test_listing_parser_invalid(data):
+    parser = ListingParser()
+    with pytest.raises(ValueError):
+        parser.feed(data)
+        parser.close()
@@ -93,3 +93,53 @@ async def test_pass_down_session_to_storages(OSFCore_get):
 
     async for store in project.storages:
         assert store.session == project.session
+
+
+@pytest.mark.asyncio
+@patch.object(OSFCore, '_get')
+async def test_storages_are_reused(OSFCore_get):
+    project = Project({})
+    project._storages_url = 'https://api.osf.io/v2/nodes/f3szh/files/'
+
+    store_json = fake_responses.storage_node('f3szh',
+                                             ['osfstorage', 'github'])
+    OSFCore_get.return_value = FakeResponse(200, store_json)
+
+    osfstorage = await project.storage('osfstorage')
+    github = await project.storage('github')
+    stores = [s async for s in project.storages]
+
+    OSFCore_get.assert_called_once_with(
+        'https://api.osf.io/v2/nodes/f3szh/files/')
+    assert stores == [osfstorage, github]
+
+    # refreshing fetches the list again but keeps the Storage instances
+    assert await project.refresh_storages() == [osfstorage, github]
+    assert await project.storage('github', refresh=True) is github
+    assert OSFCore_get.call_count == 3
+
+
+@pytest.mark.asyncio
+@patch.object(OSFCore, '_get')
+async def test_storages_ttl(OSFCore_get):
+    project = Project({})
+    project._storages_url = 'https://api.osf.io/v2/nodes/f3szh/files/'
+    project.storages_ttl = 10
+
+    response = FakeResponse(200, fake_responses.storage_node('f3szh'))
+    OSFCore_get.return_value = response
+
+    with patch('osfclient.models.project.time.monotonic', return_value=100):
+        await project.storage('osfstorage')
+    with patch('osfclient.models.project.time.monotonic', return_value=109):
+        await project.storage('osfstorage')
+    assert OSFCore_get.call_count == 1
+
+    with patch('osfclient.models.project.time.monotonic', return_value=110):
+        await project.storage('osfstorage')
+    assert OSFCore_get.call_count == 2
+
+    project.storages_ttl = 0
+    await project.storage('osfstorage')
+    await project.storage('osfstorage')
+    assert OSFCore_get.call_count == 4
@@ -1,9 +1,13 @@
 import asyncio
-from mock import patch, MagicMock, AsyncMock
+from mock import call, patch, MagicMock, AsyncMock
 
 import pytest
 
+import httpx
+
 from osfclient.models import OSFSession
+from osfclient.models.session import AdaptiveLimiter, RetryPolicy
+from osfclient.models.session import default_limiters
 from osfclient.exceptions import UnauthorizedException
 
 
@@ -13,6 +17,13 @@ def test_token_auth():
     assert session.headers['Authorization'] == 'Bearer 0123456789abcd'
 
 
+@patch('osfclient.models.session.h2', None)
+def test_http2_without_h2():
+    # falls back to HTTP/1.1 instead of failing
+    session = OSFSession(http2=True)
+    assert session.http2 is False
+
+
 def test_basic_build_url():
     session = OSFSession()
     url = session.build_url("some", "path")
@@ -199,3 +210,360 @@ async def test_stream_redirect_headers_not_forwarded(mock_parent_stream, mock_cl
     assert 'Content-Type' not in headers
     assert 'Accept' not in headers
     assert 'Authorization' not in headers
+
+
+@pytest.mark.asyncio
+@patch('osfclient.models.session.httpx.AsyncClient')
+@patch('osfclient.models.session.httpx.AsyncClient.stream')
+async def test_stream_redirect_forwards_range(mock_parent_stream, mock_client_class):
+    """A Range header is repeated against the redirect location."""
+    mock_initial_response = MagicMock()
+    mock_initial_response.status_code = 302
+    mock_initial_response.headers = {'location': 'https://s3.amazonaws.com/bucket/file'}
+
+    mock_parent_stream.return_value.__aenter__ = AsyncMock(return_value=mock_initial_response)
+    mock_parent_stream.return_value.__aexit__ = AsyncMock(return_value=None)
+
+    mock_redirect_response = MagicMock()
+    mock_redirect_response.status_code = 206
+
+    mock_redirect_stream = MagicMock()
+    mock_redirect_stream.return_value.__aenter__ = AsyncMock(return_value=mock_redirect_response)
+    mock_redirect_stream.return_value.__aexit__ = AsyncMock(return_value=None)
+
+    mock_client_instance = MagicMock()
+    mock_client_instance.stream = mock_redirect_stream
+    mock_client_instance.__aenter__ = AsyncMock(return_value=mock_client_instance)
+    mock_client_instance.__aexit__ = AsyncMock(return_value=None)
+    mock_client_class.return_value = mock_client_instance
+
+    session = OSFSession()
+    async with session.stream('GET', 'http://localhost:7777/download',
+                              headers={'Range': 'bytes=100-'}) as response:
+        assert response.status_code == 206
+
+    headers = mock_redirect_stream.call_args.kwargs.get('headers', {})
+    assert headers['Range'] == 'bytes=100-'
+    assert 'Accept' not in headers
+
+
+@pytest.mark.asyncio
+@patch('osfclient.models.session.httpx.AsyncClient')
+@patch('osfclient.models.session.httpx.AsyncClient.stream')
+async def test_stream_redirects_share_client(mock_parent_stream, mock_client_class):
+    """All redirects of a session reuse one client, closed with the session."""
+    mock_initial_response = MagicMock()
+    mock_initial_response.status_code = 302
+    mock_initial_response.headers = {'location': 'https://s3.amazonaws.com/bucket/file'}
+
+    mock_parent_stream.return_value.__aenter__ = AsyncMock(return_value=mock_initial_response)
+    mock_parent_stream.return_value.__aexit__ = AsyncMock(return_value=None)
+
+    mock_redirect_stream = MagicMock()
+    mock_redirect_stream.return_value.__aenter__ = AsyncMock(return_value=MagicMock())
+    mock_redirect_stream.return_value.__aexit__ = AsyncMock(return_value=None)
+
+    mock_client_instance = MagicMock()
+    mock_client_instance.stream = mock_redirect_stream
+    mock_client_instance.aclose = AsyncMock()
+    mock_client_class.return_value = mock_client_instance
+
+    session = OSFSession()
+    for _ in range(2):
+        async with session.stream('GET', 'http://localhost:7777/download'):
+            pass
+
+    assert mock_client_class.call_count == 1
+    assert mock_redirect_stream.call_count == 2
+
+    await session.aclose()
+    mock_client_instance.aclose.assert_awaited_once_with()
+
+
+def _response(status_code, headers=None):
+    response = MagicMock()
+    response.status_code = status_code
+    response.headers = headers or {}
+    response.aclose = AsyncMock()
+    return response
+
+
+@pytest.mark.asyncio
+@patch('osfclient.models.session.asyncio.sleep')
+@patch('osfclient.models.session.httpx.AsyncClient.get')
+async def test_get_retries_with_retry_after(mock_get, mock_sleep):
+    ok = _response(200)
+    mock_get.side_effect = [_response(503, {'Retry-After': '7'}),
+                            httpx.ConnectError('refused'), ok]
+
+    session = OSFSession()
+    response = await session.get('http://example.com/foo')
+
+    assert response is ok
+    assert mock_get.call_count == 3
+    # the server asked for 7 seconds, then the backoff is at most 1 second
+    assert mock_sleep.call_args_list[0] == call(7.0)
+    assert 0 <= mock_sleep.call_args_list[1][0][0] <= 1.0
+
+
+@pytest.mark.asyncio
+@patch('osfclient.models.session.asyncio.sleep')
+@patch('osfclient.models.session.httpx.AsyncClient.get')
+async def test_get_gives_up_after_retries(mock_get, mock_sleep):
+    mock_get.return_value = _response(502)
+
+    session = OSFSession()
+    session.retry_policies['metadata'] = RetryPolicy(retries=2)
+    response = await session.get('http://example.com/foo')
+
+    assert response.status_code == 502
+    assert mock_get.call_count == 3
+
+
+@pytest.mark.asyncio
+@patch('osfclient.models.session.asyncio.sleep')
+@patch('osfclient.models.session.httpx.AsyncClient.put')
+async def test_put_rewinds_content(mock_put, mock_sleep):
+    content = MagicMock()
+    content.rewindable = True
+    content.rewind = AsyncMock()
+    mock_put.side_effect = [_response(503), httpx.ConnectError('refused'),
+                            _response(201)]
+
+    session = OSFSession()
+    response = await session.put('http://example.com/foo', content=content)
+
+    assert response.status_code == 201
+    assert mock_put.call_count == 3
+    assert content.rewind.await_count == 2
+
+
+@pytest.mark.asyncio
+@patch('osfclient.models.session.asyncio.sleep')
+@patch('osfclient.models.session.httpx.AsyncClient.put')
+async def test_put_does_not_retry_after_sending(mock_put, mock_sleep):
+    # the server may have stored the upload before the connection broke
+    mock_put.side_effect = httpx.WriteError('reset')
+
+    session = OSFSession()
+    with pytest.raises(httpx.WriteError):
+        await session.put('http://example.com/foo', content=b'data')
+
+    assert mock_put.call_count == 1
+
+
+@pytest.mark.asyncio
+@patch('osfclient.models.session.asyncio.sleep')
+@patch('osfclient.models.session.httpx.AsyncClient.put')
+async def test_put_without_content_not_retried(mock_put, mock_sleep):
+    # creating a folder twice fails with 409
+    mock_put.return_value = _response(503)
+
+    session = OSFSession()
+    response = await session.put('http://example.com/foo?kind=folder')
+
+    assert response.status_code == 503
+    assert mock_put.call_count == 1
+
+
+@pytest.mark.asyncio
+@patch('osfclient.models.session.asyncio.sleep')
+@patch('osfclient.models.session.httpx.AsyncClient.put')
+async def test_put_does_not_retry_stream(mock_put, mock_sleep):
+    async def chunks():
+        yield b'data'
+
+    mock_put.side_effect = httpx.WriteError('reset')
+
+    session = OSFSession()
+    with pytest.raises(httpx.WriteError):
+        await session.put('http://example.com/foo', content=chunks())
+
+    assert mock_put.call_count == 1
+
+
+@pytest.mark.asyncio
+@patch('osfclient.models.session.asyncio.sleep')
+@patch('osfclient.models.session.httpx.AsyncClient.stream')
+async def test_stream_retries(mock_stream, mock_sleep):
+    responses = [_response(429), _response(200)]
+    mock_stream.return_value.__aenter__ = AsyncMock(side_effect=responses)
+    mock_stream.return_value.__aexit__ = AsyncMock(return_value=None)
+
+    session = OSFSession()
+    async with session.stream('GET', 'http://localhost:7777/download') as response:
+        assert response.status_code == 200
+
+    assert mock_stream.call_count == 2
+    assert mock_sleep.call_count == 1
+
+
+def test_retry_policy_delay():
+    policy = RetryPolicy(retries=3, backoff=1, max_delay=5)
+
+    with patch('osfclient.models.session.random.uniform',
+               side_effect=lambda a, b: b):
+        assert [policy.delay(n) for n in range(4)] == [1, 2, 4, None]
+        assert RetryPolicy(retries=10, max_delay=5).delay(8) == 5
+    # waiting longer than max_delay is not worth it
+    assert policy.delay(0, _response(503, {'Retry-After': '60'})) is None
+
+
+@pytest.mark.asyncio
+async def test_adaptive_limiter_grows_and_backs_off():
+    limiter = AdaptiveLimiter(initial=2, max_limit=4)
+    # responses take no time, so none of them is a latency spike
+    clock = MagicMock(return_value=0.0)
+
+    with patch('osfclient.models.session.time.monotonic', clock):
+        for _ in range(4):
+            async with limiter.slot() as slot:
+                slot.response(200)
+        # additive increase, about one request per round
+        assert 3 <= limiter.limit < 4
+
+        async with limiter.slot() as slot:
+            slot.response(503)
+        assert 1.5 <= limiter.limit < 2
+
+        with pytest.raises(httpx.ConnectError):
+            async with limiter.slot():
+                raise httpx.ConnectError('refused')
+    assert limiter.limit == 1
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_adaptive_limiter_ignores_older_requests():
+    # requests sent before a decrease do not decrease the limit again
+    limiter = AdaptiveLimiter(initial=4)
+    async with limiter.slot() as first, limiter.slot() as second:
+        first.response(429)
+        second.response(429)
+
+    assert limiter.limit == 2
+
+
+@pytest.mark.asyncio
+async def test_adaptive_limiter_latency_spike():
+    limiter = AdaptiveLimiter(initial=4)
+    clock = MagicMock(return_value=0.0)
+    with patch('osfclient.models.session.time.monotonic', clock):
+        async with limiter.slot() as slot:
+            clock.return_value = 1.0
+            slot.response(200)
+        assert limiter.latency == 1.0
+        limit = limiter.limit
+
+        async with limiter.slot() as slot:
+            clock.return_value = 4.0
+            slot.response(200)
+
+    assert limiter.limit == limit / 2
+
+
+@pytest.mark.asyncio
+@patch('osfclient.models.session.httpx.AsyncClient.put')
+async def test_adaptive_transfers_ignore_large_uploads(mock_put):
+    # one large file among small ones takes long to send, which does not
+    # mean that the server is struggling
+    clock = MagicMock(return_value=0.0)
+
+    async def put(url, content=None, **kwargs):
+        clock.return_value += len(content) / 1000.0
+        return _response(201)
+    mock_put.side_effect = put
+
+    session = OSFSession()
+    session.limiters = default_limiters()
+    limits = []
+    with patch('osfclient.models.session.time.monotonic', clock):
+        for size in [10] * 20 + [100000] + [10] * 20:
+            await session.put('http://example.com/upload',
+                              content=b'x' * size)
+            limits.append(session.limiters['transfer'].limit)
+
+    assert limits == sorted(limits)
+    assert limits[-1] > limits[0]
+
+
+@pytest.mark.asyncio
+async def test_adaptive_limiter_waits_for_slot():
+    limiter = AdaptiveLimiter(initial=1)
+    entered = []
+
+    async def request(name):
+        async with limiter.slot() as slot:
+            entered.append(name)
+            await asyncio.sleep(0)
+            slot.response(200)
+
+    await asyncio.gather(request('a'), request('b'), request('c'))
+
+    assert entered == ['a', 'b', 'c']
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+@patch('osfclient.models.session.asyncio.sleep')
+@patch('osfclient.models.session.httpx.AsyncClient.get')
+async def test_get_reports_to_limiter(mock_get, mock_sleep):
+    mock_get.side_effect = [_response(503), _response(200)]
+
+    session = OSFSession()
+    limiter = AdaptiveLimiter(initial=4)
+    session.limiters = {'metadata': limiter}
+    await session.get('http://example.com/foo')
+
+    assert 2 <= limiter.limit < 3
+
+
+@pytest.mark.asyncio
+@patch('osfclient.models.session.asyncio.sleep')
+async def test_hooks_receive_request_events(mock_sleep):
+    responses = [httpx.Response(503),
+                 httpx.Response(200, stream=httpx.ByteStream(b'{}'))]
+
+    session = OSFSession()
+    session._transport = httpx.MockTransport(lambda request: responses.pop(0))
+    events = []
+    session.add_hook(events.append)
+
+    def broken_hook(event):
+        raise ValueError('broken')
+    # a broken hook does not break requests
+    session.add_hook(broken_hook)
+
+    await session.get('https://api.osf.io/v2/nodes/f3szh/?page=2')
+
+    event, = events
+    assert event.kind == 'metadata'
+    assert event.method == 'GET'
+    assert event.url == 'https://api.osf.io/v2/nodes/f3szh/'
+    assert event.url_template == 'https://api.osf.io/v2/nodes/{id}/'
+    assert event.status == 200
+    assert event.retries == 1
+    assert event.bytes_in == 2
+    assert 0 <= event.ttfb <= event.latency
+    assert event.error is None
+
+
+@pytest.mark.asyncio
+async def test_hooks_count_uploaded_bytes():
+    async def chunks():
+        yield b'hello '
+        yield b'world'
+
+    async def handler(request):
+        await request.aread()
+        return httpx.Response(201)
+
+    session = OSFSession()
+    session._transport = httpx.MockTransport(handler)
+    events = []
+    session.add_hook(events.append)
+
+    await session.put('https://files.osf.io/v1/resources/f3szh/', content=chunks())
+
+    assert events[0].kind == 'upload'
+    assert events[0].bytes_out == 11
@@ -0,0 +1,73 @@
+from mock import patch
+
+from osfclient.models.hooks import RequestEvent
+from osfclient.stats import RunStats, busy_time, format_size, percentile
+from osfclient import utils
+
+
+def _event(kind='metadata', method='GET', latency=1.0, **kwargs):
+    fields = dict(kind=kind, method=method, url='', url_template='',
+                  status=200, bytes_in=0, bytes_out=0, ttfb=None,
+                  latency=latency, retries=0, error=None)
+    fields.update(kwargs)
+    return RequestEvent(**fields)
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile([3], 99) == 3
+    assert percentile([], 50) is None
+
+
+def test_busy_time():
+    # overlapping intervals count once
+    assert busy_time([(0, 2), (1, 3), (5, 6), (5.5, 5.7)]) == 4
+    assert busy_time([]) == 0
+
+
+def test_format_size():
+    assert format_size(12) == '12 B'
+    assert format_size(1500000) == '1.5 MB'
+
+
+def test_run_stats_report():
+    clock = [100.0]
+    with patch('osfclient.stats.time.monotonic', lambda: clock[0]):
+        stats = RunStats()
+        clock[0] = 102.0
+        stats(_event(latency=1.0))
+        stats(_event(latency=0.5, retries=2))
+        stats(_event('metadata', 'PUT', latency=0.5))
+        clock[0] = 110.0
+        stats(_event('download', 'GET', latency=8.0, bytes_in=8000000))
+        stats(_event('download', 'GET', latency=4.0, status=404))
+        stats.record('hashing', 100.0, 101.0)
+        report = stats.report()
+
+    assert 'metadata GET           2  p50 0.500s' in report
+    assert '(2 retries, 0 failed)' in report
+    assert 'download GET           2' in report
+    assert '(0 retries, 1 failed)' in report
+    assert 'Received 8.0 MB, sent 0 B, 1.0 MB/s while transferring.' in report
+    assert 'Wall time 10.0s' in report
+    assert 'transfer             8.0s   80%' in report
+    assert 'hashing              1.0s   10%' in report
+    assert 'folder creation      0.5s    5%' in report
+
+
+def test_timed_reports_to_recorder():
+    recorded = []
+    previous = utils.set_phase_recorder(
+        lambda *args: recorded.append(args))
+    try:
+        with utils.timed('hashing'):
+            pass
+    finally:
+        utils.set_phase_recorder(previous)
+
+    (phase, start, end), = recorded
+    assert phase == 'hashing'
+    assert start <= end
@@ -1,15 +1,21 @@
+import asyncio
+import hashlib
 from mock import patch, MagicMock, call
 
 import os
+import aiofiles
 import pytest
 import six
 
+import httpx
 from httpx import HTTPError
 
 from osfclient.models import OSFCore
 from osfclient.models import Storage
 from osfclient.models import File
 from osfclient.models import Folder
+from osfclient.models.session import AdaptiveLimiter
+from osfclient.utils import find_ancestral_folder, find_by_path
 
 from osfclient.tests import fake_responses
 from osfclient.tests.mocks import FakeResponse, FutureFakeResponse, MockStream
@@ -274,8 +280,10 @@ async def test_update_existing_file_files_match():
                           side_effect=simple_OSFCore_get) as fake_get:
             with patch('osfclient.models.storage.checksum_fp',
                        side_effect=simple_checksum_fp):
-                await store.create_file('foo.txt', fake_fp, update=True)
+                uploaded = await store.create_file('foo.txt', fake_fp,
+                                                   update=True)
 
+    assert uploaded is False
     assert fake_fp.call_count == 0
     # should have made one PUT requests, first attempt at uploading, and no
     # attempt to update the file since they match
@@ -565,3 +573,423 @@ async def test_update_existing_file_overrides_connection_error():
     assert fake_put.call_count == 2
     # should have made one GET request to list files
     assert fake_get.call_count == 1
+
+
+def _paged_responses(files_url, n_pages):
+    # one file per page, every page but the last points to the next one
+    pages = {}
+    for page in range(n_pages):
+        json = fake_responses.files_node('f3szh', 'osfstorage',
+                                         file_names=['page%d.txt' % page])
+        url = files_url
+        if page > 0:
+            url += '?next_token=token%d' % page
+        if page + 1 < n_pages:
+            json['next_token'] = 'token%d' % (page + 1)
+        pages[url] = FakeResponse(200, json)
+    return pages
+
+
+@pytest.mark.asyncio
+async def test_iterate_files_page_size():
+    store = Storage({})
+    store._files_url = 'https://api.osf.io/v2/nodes/f3szh/files/osfstorage'
+    store.session.page_size = 'max'
+    json = fake_responses.files_node('f3szh', 'osfstorage',
+                                     file_names=['page0.txt'])
+    json['next_token'] = 'token1'
+    last = fake_responses.files_node('f3szh', 'osfstorage',
+                                     file_names=['page1.txt'])
+    sized = store._files_url + '?page%5Bsize%5D=1000'
+    pages = {sized: FakeResponse(200, json),
+             sized + '&next_token=token1': FakeResponse(200, last),
+             store._files_url + '?page%5Bsize%5D=50': FakeResponse(200, last)}
+
+    with patch.object(OSFCore, '_get', side_effect=lambda url: pages[url]):
+        names = [f.name async for f in store.files]
+        # the page size of a single listing
+        names50 = [f.name async for f in store._iter_children(
+            store._files_url, 'file', File, page_size=50)]
+
+    assert names == ['page0.txt', 'page1.txt']
+    assert names50 == ['page1.txt']
+
+
+@pytest.mark.asyncio
+async def test_iterate_files_page_size_rejected():
+    store = Storage({})
+    store._files_url = 'https://files.osf.io/v1/resources/f3szh/providers/osfstorage/'
+    store.session.page_size = 25
+    json = fake_responses.files_node('f3szh', 'osfstorage',
+                                     file_names=['hello.txt'])
+    pages = {store._files_url + '?page%5Bsize%5D=25': FakeResponse(400, None),
+             store._files_url: FakeResponse(200, json)}
+
+    with patch.object(OSFCore, '_get',
+                      side_effect=lambda url: pages[url]) as mock_osf_get:
+        names = [f.name async for f in store.files]
+        # the server's default is used for the host from now on
+        names += [f.name async for f in store.files]
+
+    assert names == ['hello.txt', 'hello.txt']
+    assert mock_osf_get.call_count == 3
+    assert store.session.page_size_rejected == {'files.osf.io'}
+
+
+@pytest.mark.asyncio
+async def test_iterate_files_bad_request_keeps_page_size():
+    # a 400 that is not about the page size does not turn sizes off
+    store = Storage({})
+    store._files_url = 'https://files.osf.io/v1/resources/f3szh/providers/osfstorage/'
+    store.session.page_size = 25
+    pages = {store._files_url + '?page%5Bsize%5D=25': FakeResponse(400, None),
+             store._files_url: FakeResponse(400, None)}
+
+    with patch.object(OSFCore, '_get', side_effect=lambda url: pages[url]):
+        with pytest.raises(RuntimeError):
+            [f async for f in store.files]
+
+    assert store.session.page_size_rejected == set()
+
+
+@pytest.mark.asyncio
+async def test_walk_page_size():
+    store = Storage({})
+    store._files_url = 'https://api.osf.io/v2/nodes/f3szh/files/osfstorage'
+    json = fake_responses.files_node('f3szh', 'osfstorage',
+                                     file_names=['hello.txt'])
+    pages = {store._files_url + '?page%5Bsize%5D=50': FakeResponse(200, json)}
+
+    with patch.object(OSFCore, '_get', side_effect=lambda url: pages[url]):
+        names = [f.name async for f in store.walk(page_size=50)]
+
+    assert names == ['hello.txt']
+
+
+@pytest.mark.asyncio
+async def test_iterate_files_streamed():
+    store = Storage({})
+    store._files_url = 'https://files.osf.io/v1/resources/f3szh/providers/osfstorage/'
+    store.session.stream_listings = True
+    store.session.page_size = 25
+    json = fake_responses.files_node('f3szh', 'osfstorage',
+                                     file_names=['hello.txt'])
+    json['next_token'] = 'token1'
+    last = fake_responses.files_node('f3szh', 'osfstorage',
+                                     file_names=['bye.txt'])
+    pages = {
+        store._files_url + '?page%5Bsize%5D=25': httpx.Response(400),
+        store._files_url: httpx.Response(200, json=json),
+        store._files_url + '?next_token=token1': httpx.Response(200, json=last),
+    }
+    requested = []
+
+    def handler(request):
+        requested.append(str(request.url))
+        return pages[str(request.url)]
+    store.session._transport = httpx.MockTransport(handler)
+    limiter = AdaptiveLimiter(initial=1)
+    store.session.limiters = {'metadata': limiter}
+
+    names = [f.name async for f in store.files]
+
+    assert names == ['hello.txt', 'bye.txt']
+    # streamed listings are limited like other listings
+    assert limiter.limit > 1 and limiter.in_flight == 0
+    assert requested == [store._files_url + '?page%5Bsize%5D=25',
+                         store._files_url,
+                         store._files_url + '?next_token=token1']
+    assert store.session.page_size_rejected == {'files.osf.io'}
+
+
+@pytest.mark.asyncio
+async def test_iterate_paginated_files():
+    store = Storage({})
+    store._files_url = 'https://api.osf.io/v2/nodes/f3szh/files/osfstorage'
+    pages = _paged_responses(store._files_url, 3)
+
+    with patch.object(OSFCore, '_get',
+                      side_effect=lambda url: pages[url]) as mock_osf_get:
+        names = [f.name async for f in store.files]
+
+    assert names == ['page0.txt', 'page1.txt', 'page2.txt']
+    assert mock_osf_get.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_iterate_paginated_files_read_ahead():
+    store = Storage({})
+    store._files_url = 'https://api.osf.io/v2/nodes/f3szh/files/osfstorage'
+    store.session.prefetch_pages = 1
+    pages = _paged_responses(store._files_url, 3)
+
+    with patch.object(OSFCore, '_get',
+                      side_effect=lambda url: pages[url]) as mock_osf_get:
+        names = []
+        async for f in store.files:
+            # wait for the read ahead to happen
+            await asyncio.sleep(0.01)
+            names.append(f.name)
+            if len(names) == 1:
+                # the second page was requested while the first one is
+                # consumed, the third one only after the second one
+                assert mock_osf_get.call_count == 2
+
+    assert names == ['page0.txt', 'page1.txt', 'page2.txt']
+    assert mock_osf_get.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_iterate_paginated_files_read_ahead_stop_early():
+    store = Storage({})
+    store._files_url = 'https://api.osf.io/v2/nodes/f3szh/files/osfstorage'
+    store.session.prefetch_pages = 1
+    pages = _paged_responses(store._files_url, 3)
+
+    with patch.object(OSFCore, '_get',
+                      side_effect=lambda url: pages[url]) as mock_osf_get:
+        files = store.files
+        async for f in files:
+            await asyncio.sleep(0.01)
+            break
+        await files.aclose()
+        await asyncio.sleep(0.01)
+
+    assert f.name == 'page0.txt'
+    # the third page is never requested
+    assert mock_osf_get.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_iterate_paginated_files_read_ahead_error():
+    store = Storage({})
+    store._files_url = 'https://api.osf.io/v2/nodes/f3szh/files/osfstorage'
+    store.session.prefetch_pages = 2
+    pages = _paged_responses(store._files_url, 2)
+    pages[store._files_url + '?next_token=token1'] = FakeResponse(500, None)
+
+    names = []
+    with patch.object(OSFCore, '_get', side_effect=lambda url: pages[url]):
+        with pytest.raises(RuntimeError):
+            async for f in store.files:
+                names.append(f.name)
+
+    assert names == ['page0.txt']
+
+
+def _tree_responses(store):
+    # osfstorage/
+    #   hello.txt
+    #   foo/
+    #     foo.txt
+    root_json = fake_responses.files_node('f3szh', 'osfstorage',
+                                          file_names=['hello.txt'],
+                                          folder_names=['foo'])
+    foo_json = fake_responses.files_node('f3szh', 'osfstorage',
+                                         file_names=['foo/foo.txt'])
+    return {
+        store._files_url: FakeResponse(200, root_json),
+        'https://files.osf.io/v1/resources/9zpcy/providers/osfstorage/foo123/':
+            FakeResponse(200, foo_json),
+    }
+
+
+@pytest.mark.asyncio
+async def test_find_by_path_uses_path_index():
+    store = Storage({})
+    store._files_url = 'https://api.osf.io/v2/nodes/f3szh/files/osfstorage'
+    responses = _tree_responses(store)
+
+    with patch.object(OSFCore, '_get',
+                      side_effect=lambda url: responses[url]) as mock_osf_get:
+        file_ = await find_by_path(store, 'foo/foo.txt')
+        assert file_.path == '/foo/foo.txt'
+        assert mock_osf_get.call_count == 2
+
+        # repeated and missing lookups in listed folders are answered
+        # from the index
+        assert (await find_by_path(store, 'foo/foo.txt')) is file_
+        assert (await find_by_path(store, 'hello.txt')).path == '/hello.txt'
+        assert (await find_by_path(store, 'foo')).path == '/foo/'
+        assert (await find_by_path(store, 'foo/missing.txt')) is None
+        assert (await find_by_path(store, 'missing/missing.txt')) is None
+        assert (await find_by_path(store, 'hello.txt/foo')) is None
+        assert mock_osf_get.call_count == 2
+
+        # entries found via the index know their storage
+        folder = await find_ancestral_folder(store, 'foo/new/new.txt')
+        assert folder.path == '/foo/'
+        assert folder._storage is store
+        assert mock_osf_get.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_path_index_updated_in_place():
+    store = Storage({})
+    store._files_url = 'https://api.osf.io/v2/nodes/f3szh/files/osfstorage'
+    responses = _tree_responses(store)
+
+    with patch.object(OSFCore, '_get',
+                      side_effect=lambda url: responses[url]) as mock_osf_get:
+        foo = await find_by_path(store, 'foo')
+        foo_txt = await find_by_path(store, 'foo/foo.txt')
+        assert mock_osf_get.call_count == 2
+
+        # a new folder is known to be empty
+        foo._put = MagicMock(return_value=FutureFakeResponse(
+            201, {'data': fake_responses._folder('bar123', 'foo/bar')}))
+        bar = await foo.create_folder('bar')
+        assert (await find_by_path(store, 'foo/bar')) is bar
+        assert (await find_by_path(store, 'foo/bar/baz.txt')) is None
+
+        foo_txt._delete = MagicMock(return_value=FutureFakeResponse(204, None))
+        await foo_txt.remove()
+        assert (await find_by_path(store, 'foo/foo.txt')) is None
+        assert mock_osf_get.call_count == 2
+
+        # the target of a move is listed again
+        hello = await find_by_path(store, 'hello.txt')
+        hello._post = MagicMock(return_value=FutureFakeResponse(201, None))
+        await hello.move_to('osfstorage', foo)
+        assert (await find_by_path(store, 'hello.txt')) is None
+        assert mock_osf_get.call_count == 2
+        await find_by_path(store, 'foo/foo.txt')
+        assert mock_osf_get.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_path_index_disabled():
+    store = Storage({})
+    store._files_url = 'https://api.osf.io/v2/nodes/f3szh/files/osfstorage'
+    store.session.path_index = None
+    responses = _tree_responses(store)
+
+    with patch.object(OSFCore, '_get',
+                      side_effect=lambda url: responses[url]) as mock_osf_get:
+        assert (await find_by_path(store, 'foo/foo.txt')).path == '/foo/foo.txt'
+        assert (await find_by_path(store, 'foo/foo.txt')).path == '/foo/foo.txt'
+
+    assert mock_osf_get.call_count == 4
+
+
+@pytest.mark.asyncio
+async def test_create_folder_created_since_listing():
+    # a 409 lists the folder again instead of trusting the index
+    store = Storage({})
+    store._files_url = 'https://api.osf.io/v2/nodes/f3szh/files/osfstorage'
+    store._new_folder_url = ('https://files.osf.io/v1/resources/9zpcy/'
+                             'providers/osfstorage/?kind=folder')
+    responses = _tree_responses(store)
+
+    with patch.object(OSFCore, '_get',
+                      side_effect=lambda url: responses[url]) as mock_osf_get:
+        assert (await find_by_path(store, 'bar')) is None
+        responses[store._files_url] = FakeResponse(
+            200, fake_responses.files_node('f3szh', 'osfstorage',
+                                           folder_names=['foo', 'bar']))
+        with patch.object(OSFCore, '_put',
+                          return_value=FakeResponse(409, None)):
+            bar = await store.create_folder('bar', exist_ok=True)
+
+    assert bar.path == '/bar/'
+    assert mock_osf_get.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_update_file_created_since_listing():
+    store = Storage({})
+    store._files_url = 'https://api.osf.io/v2/nodes/f3szh/files/osfstorage'
+    store._new_file_url = ('https://files.osf.io/v1/resources/9zpcy/'
+                           'providers/osfstorage/')
+    responses = _tree_responses(store)
+    content = b'hello world'
+    json = fake_responses.files_node('f3szh', 'osfstorage',
+                                     file_names=['hello.txt', 'new.txt'])
+    json['data'][1]['attributes']['extra']['hashes']['md5'] = \
+        hashlib.md5(content).hexdigest()
+
+    with patch.object(OSFCore, '_get',
+                      side_effect=lambda url: responses[url]):
+        assert (await find_by_path(store, 'new.txt')) is None
+        responses[store._files_url] = FakeResponse(200, json)
+        with patch.object(OSFCore, '_put',
+                          return_value=FakeResponse(409, None)), \
+                patch('osfclient.models.storage.checksum_fp',
+                      return_value=hashlib.md5(content).hexdigest()):
+            uploaded = await store.create_file(
+                'new.txt', MockStream('new.txt', 'rb'), update=True)
+
+    assert uploaded is False
+
+
+@pytest.mark.asyncio
+async def test_create_file_resolves_folders_once():
+    # concurrent uploads into a new folder create it exactly once, later
+    # uploads do not try to create it again
+    store = Storage({})
+    store._files_url = 'https://api.osf.io/v2/nodes/f3szh/files/osfstorage'
+    store._new_folder_url = ('https://files.osf.io/v1/resources/9zpcy/'
+                             'providers/osfstorage/?kind=folder')
+    store._new_file_url = ('https://files.osf.io/v1/resources/9zpcy/'
+                           'providers/osfstorage/')
+    folders = {
+        (store._new_folder_url, 'a'): fake_responses._folder('a123', 'a'),
+        ('https://files.osf.io/v1/resources/9zpcy/providers/osfstorage/'
+         'a123/?kind=folder', 'b'): fake_responses._folder('b123', 'a/b'),
+    }
+    puts = []
+
+    async def fake_put(url, params=None, content=None):
+        puts.append((url, params['name']))
+        await asyncio.sleep(0)
+        if (url, params['name']) in folders:
+            return FakeResponse(201, {'data': folders[(url,
+                                                        params['name'])]})
+        return FakeResponse(201, None)
+
+    with patch.object(OSFCore, '_put', side_effect=fake_put):
+        await asyncio.gather(
+            store.create_file('a/b/x.txt', MockStream('x.txt', 'rb')),
+            store.create_file('a/b/y.txt', MockStream('y.txt', 'rb')),
+        )
+        await store.create_file('a/b/z.txt', MockStream('z.txt', 'rb'))
+
+    folder_puts = [put for put in puts if put in folders]
+    assert folder_puts == list(folders)
+    assert sorted(name for url, name in puts if (url, name) not in folders) \
+        == ['x.txt', 'y.txt', 'z.txt']
+
+
+@pytest.mark.asyncio
+async def test_update_existing_file_hashes_data_sent(tmp_path):
+    # the file is compared by the hash of the data sent with the first
+    # attempt, not read again
+    new_file_url = ('https://files.osf.io/v1/resources/9zpcy/providers/' +
+                    'osfstorage/foo123/')
+    store = Storage({})
+    store._new_file_url = new_file_url
+    store._files_url = 'https://api.osf.io/v2/nodes/f3szh/files/osfstorage'
+    content = b'hello world'
+    json = fake_responses.files_node('f3szh', 'osfstorage',
+                                     file_names=['foo.txt'])
+    json['data'][0]['attributes']['extra']['hashes']['md5'] = \
+        hashlib.md5(content).hexdigest()
+    sent = []
+
+    async def fake_put(url, params=None, content=None):
+        sent.extend([bytes(chunk) async for chunk in content])
+        return FakeResponse(409, None)
+
+    path = tmp_path / 'foo.txt'
+    path.write_bytes(content)
+    with patch.object(OSFCore, '_put', side_effect=fake_put) as put, \
+            patch.object(OSFCore, '_get',
+                         return_value=FakeResponse(200, json)), \
+            patch('osfclient.models.storage.checksum_fp',
+                  side_effect=AssertionError('file read again')):
+        async with aiofiles.open(str(path), 'rb') as fp:
+            uploaded = await store.create_file('foo.txt', fp, update=True)
+
+    assert uploaded is False
+    assert b''.join(sent) == content
+    assert put.call_count == 1
@@ -4,15 +4,20 @@ import mock
 from mock import call
 from mock import patch
 from mock import mock_open
+from mock import MagicMock
 
 import pytest
 
 from osfclient import OSF
-from osfclient.cli import upload
+from osfclient.cli import _remote_manifest, upload
+from osfclient.models import OSFCore, Storage
+from osfclient.tests import fake_responses
 
 from osfclient.tests.mocks import MockArgs
 from osfclient.tests.mocks import MockProject
 from osfclient.tests.mocks import mock_async_open, MockStream
+from osfclient.tests.mocks import AsyncIterator, FutureWrapper, MockFile
+from osfclient.tests.mocks import FakeResponse
 
 
 @pytest.mark.asyncio
@@ -183,3 +188,163 @@ async def test_recursive_upload_with_subdir(OSF_project):
         ])
     # two directories with two files each -> four calls
     assert len(fake_storage.mock_calls) == 4
+
+
+@pytest.mark.asyncio
+@patch.object(OSF, 'project', return_value=MockProject('1234'))
+async def test_recursive_upload_collects_failures(OSF_project, capsys):
+    # a failed file does not stop the other uploads
+    args = MockArgs(project='1234',
+                    source='foobar/',
+                    recursive=True,
+                    update=True,
+                    destination='BAR/')
+
+    def simple_getenv(key, default=None):
+        if key == 'OSF_TOKEN':
+            return 'secret'
+        return default
+
+    async def create_file(name, fp, force, update):
+        if name == 'BAR/./bar.txt':
+            raise RuntimeError('upload failed')
+        if name == 'BAR/./abc.txt':
+            return False
+        return True
+
+    fake_open = mock_async_open()
+    fake_storage = await OSF_project.return_value.storage.return_value
+    fake_storage.create_file.side_effect = create_file
+
+    dir_contents = [('foobar/', None, ['bar.txt', 'abc.txt']),
+                    ('foobar/baz', None, ['bar.txt', 'abc.txt'])
+                    ]
+
+    with patch('osfclient.cli.aiofiles.open', fake_open):
+        with patch('os.walk', return_value=iter(dir_contents)):
+            with patch('osfclient.cli.os.getenv', side_effect=simple_getenv):
+                with patch('osfclient.cli.os.path.isdir', return_value=True):
+                    with pytest.raises(SystemExit) as e:
+                        await upload(args)
+
+    assert len(fake_storage.create_file.mock_calls) == 4
+    assert '1 files could not be uploaded' in e.value.args[0]
+    out, err = capsys.readouterr()
+    assert 'Uploaded 2 files, skipped 1 unchanged files, 1 files failed.' in out
+    assert 'foobar/bar.txt: upload failed' in err
+
+
+@pytest.mark.asyncio
+@patch.object(OSF, 'project', return_value=MockProject('1234'))
+async def test_recursive_upload_invalid_jobs(OSF_project):
+    args = MockArgs(project='1234',
+                    source='foobar/',
+                    recursive=True,
+                    destination='BAR/',
+                    jobs=0)
+
+    def simple_getenv(key, default=None):
+        if key == 'OSF_TOKEN':
+            return 'secret'
+        return default
+
+    with patch('osfclient.cli.os.getenv', side_effect=simple_getenv):
+        with patch('osfclient.cli.os.path.isdir', return_value=True):
+            with pytest.raises(SystemExit) as e:
+                await upload(args)
+
+    assert 'at least 1' in e.value.args[0]
+
+
+@pytest.mark.asyncio
+@patch.object(OSF, 'project', return_value=MockProject('1234'))
+async def test_recursive_upload_update_uses_manifest(OSF_project, capsys):
+    # existing remote files are found in one listing and updated directly
+    args = MockArgs(project='1234',
+                    source='foobar',
+                    recursive=True,
+                    update=True,
+                    destination='BAR/')
+
+    def simple_getenv(key, default=None):
+        if key == 'OSF_TOKEN':
+            return 'secret'
+        return default
+
+    def remote_file(path, size):
+        file_ = MockFile(path, size=size)
+        # MagicMocks have every attribute, this one is not a folder
+        del file_.files
+        file_.update = MagicMock(return_value=FutureWrapper())
+        return file_
+
+    same = remote_file('/BAR/foobar/same.txt', 1024)
+    changed = remote_file('/BAR/foobar/changed.txt', 1024)
+    resized = remote_file('/BAR/foobar/resized.txt', 1)
+    remote_folder = MagicMock()
+
+    fake_open = mock_async_open()
+    fake_storage = await OSF_project.return_value.storage.return_value
+
+    async def checksum_fp(fp):
+        if 'foobar/same.txt' in repr(fp):
+            return '0' * 32
+        return '1' * 32
+
+    dir_contents = [('foobar', None, ['same.txt', 'changed.txt',
+                                      'resized.txt', 'new.txt'])]
+
+    with patch('osfclient.cli.aiofiles.open', fake_open), \
+            patch('os.walk', return_value=iter(dir_contents)), \
+            patch('osfclient.cli.os.getenv', side_effect=simple_getenv), \
+            patch('osfclient.cli.os.path.isdir', return_value=True), \
+            patch('osfclient.cli.os.path.getsize', return_value=1024), \
+            patch('osfclient.cli.checksum_fp', side_effect=checksum_fp), \
+            patch('osfclient.cli.find_by_path',
+                  return_value=remote_folder) as find, \
+            patch('osfclient.cli.walk',
+                  return_value=AsyncIterator([same, changed, resized])):
+        await upload(args)
+
+    find.assert_called_once_with(fake_storage, 'BAR/foobar')
+    assert not same.update.called
+    assert changed.update.called
+    assert resized.update.called
+    # only the new file is created
+    fake_storage.create_file.assert_called_once_with(
+        'BAR/foobar/./new.txt', mock.ANY, force=False, update=True)
+    out, err = capsys.readouterr()
+    assert 'Uploaded 3 files, skipped 1 unchanged files' in out
+
+
+@pytest.mark.asyncio
+async def test_remote_manifest_fills_path_index():
+    # uploads into folders the manifest listed do not create them again
+    store = Storage({})
+    store._files_url = 'https://api.osf.io/v2/nodes/f3szh/files/osfstorage'
+    store._new_folder_url = ('https://files.osf.io/v1/resources/9zpcy/'
+                             'providers/osfstorage/?kind=folder')
+    responses = {
+        store._files_url: FakeResponse(200, fake_responses.files_node(
+            'f3szh', 'osfstorage', file_names=['hello.txt'],
+            folder_names=['foo'])),
+        'https://files.osf.io/v1/resources/9zpcy/providers/osfstorage/foo123/':
+            FakeResponse(200, fake_responses.files_node(
+                'f3szh', 'osfstorage', file_names=['foo/foo.txt'])),
+    }
+    puts = []
+
+    async def fake_put(url, params=None, content=None):
+        puts.append((url, params['name']))
+        return FakeResponse(201, None)
+
+    with patch.object(OSFCore, '_get',
+                      side_effect=lambda url: responses[url]) as mock_get, \
+            patch.object(OSFCore, '_put', side_effect=fake_put):
+        manifest = await _remote_manifest(store, '')
+        await store.create_file('foo/new.txt', MockStream('new.txt', 'rb'))
+
+    assert sorted(manifest) == ['foo', 'foo/foo.txt', 'hello.txt']
+    assert mock_get.call_count == 2
+    # the file is uploaded into the existing folder, no folder is created
+    assert [name for url, name in puts] == ['new.txt']
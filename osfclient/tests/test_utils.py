@@ -1,3 +1,9 @@
+import asyncio
+import hashlib
+import io
+import os
+import time
+
 import pytest
 from mock import call, patch, Mock
 
@@ -5,6 +11,18 @@ from osfclient.utils import file_empty
 from osfclient.utils import norm_remote_path
 from osfclient.utils import makedirs
 from osfclient.utils import split_storage
+from osfclient.utils import walk
+from osfclient.utils import parse_size
+from osfclient.utils import parse_rate_limits
+from osfclient.utils import parse_page_size
+from osfclient.utils import ByteBudget
+from osfclient.utils import TokenBucket
+from osfclient.utils import ChecksumCache
+from osfclient.utils import checksum_fp
+from osfclient.utils import checksum_path
+from osfclient.utils import checksums_path
+from osfclient.utils import hash_fd
+from osfclient.utils import set_checksum_cache
 from osfclient.tests.mocks import MockStream
 
 
@@ -169,3 +187,363 @@ async def test_empty_file():
     assert expected == fake_fp.mock_calls
     # mocks and calls on mocks always return True, so this should be False
     assert not empty
+
+
+def test_hash_fd_blocks(tmp_path):
+    # the file spans several blocks and is read once for both hashes
+    content = os.urandom(10000)
+    path = str(tmp_path / 'file.bin')
+    with open(path, 'wb') as fp:
+        fp.write(content)
+
+    with open(path, 'rb') as fp:
+        fp.seek(123)
+        checksums = hash_fd(fp.fileno(), ('md5', 'sha256'), block_size=4096)
+        assert fp.tell() == 123
+
+    assert checksums == {'md5': hashlib.md5(content).hexdigest(),
+                         'sha256': hashlib.sha256(content).hexdigest()}
+
+
+@pytest.mark.asyncio
+async def test_checksums_path(tmp_path):
+    path = str(tmp_path / 'file.bin')
+    with open(path, 'wb') as fp:
+        fp.write(b'')
+
+    checksums = await checksums_path(path)
+
+    assert checksums == {'md5': hashlib.md5(b'').hexdigest(),
+                         'sha256': hashlib.sha256(b'').hexdigest()}
+
+
+@pytest.mark.asyncio
+async def test_checksum_invalid_hash_type(tmp_path):
+    path = str(tmp_path / 'file.bin')
+    with open(path, 'wb') as fp:
+        fp.write(b'hello world')
+
+    with pytest.raises(ValueError):
+        await checksum_path(path, 'sha1')
+
+
+@pytest.mark.asyncio
+async def test_checksum_fp_without_fileno():
+    # file-like objects that are not backed by a file are read in blocks
+    content = b'no newlines here ' * 100
+    fp = io.BytesIO(content)
+    reader = Mock()
+    reader.fileno.side_effect = io.UnsupportedOperation
+
+    async def read(size):
+        return fp.read(size)
+
+    async def seek(pos):
+        return fp.seek(pos)
+
+    reader.read = Mock(side_effect=read)
+    reader.seek = seek
+
+    checksum = await checksum_fp(reader, block_size=256)
+
+    assert checksum == hashlib.md5(content).hexdigest()
+    assert reader.read.call_args_list[0] == call(256)
+
+
+class FakeEntry(object):
+    def __init__(self, path):
+        self.path = path
+
+
+class FakeFolder(FakeEntry):
+    # records how many listings are in flight at the same time
+    in_flight = 0
+    max_in_flight = 0
+
+    def __init__(self, path, entries=()):
+        super(FakeFolder, self).__init__(path)
+        self.entries = list(entries)
+        self.files = [e for e in self.entries if not isinstance(e, FakeFolder)]
+        self.listed = False
+
+    @property
+    async def children(self):
+        FakeFolder.in_flight += 1
+        FakeFolder.max_in_flight = max(FakeFolder.max_in_flight,
+                                       FakeFolder.in_flight)
+        try:
+            # deeper folders answer faster, so completion order differs
+            # from depth-first order
+            await asyncio.sleep(0.01 / (self.path.count('/') + 1))
+        finally:
+            FakeFolder.in_flight -= 1
+        self.listed = True
+        for entry in self.entries:
+            yield entry
+
+
+def _fake_tree():
+    FakeFolder.in_flight = 0
+    FakeFolder.max_in_flight = 0
+    return FakeFolder('/', [
+        FakeFolder('/a', [
+            FakeEntry('/a/1'),
+            FakeFolder('/a/b', [FakeEntry('/a/b/2')]),
+            FakeFolder('/a/c', [FakeEntry('/a/c/3')]),
+        ]),
+        FakeEntry('/4'),
+        FakeFolder('/d', [FakeFolder('/d/e', [FakeEntry('/d/e/5')])]),
+    ])
+
+
+@pytest.mark.asyncio
+async def test_walk_ordered():
+    paths = [entry.path async for entry in walk(_fake_tree(), concurrency=4)]
+
+    assert paths == ['/a', '/a/1', '/a/b', '/a/b/2', '/a/c', '/a/c/3',
+                     '/4', '/d', '/d/e', '/d/e/5']
+    assert FakeFolder.max_in_flight > 1
+
+
+@pytest.mark.asyncio
+async def test_walk_unordered():
+    paths = [entry.path
+             async for entry in walk(_fake_tree(), concurrency=4,
+                                     ordered=False)]
+
+    assert sorted(paths) == sorted(['/a', '/a/1', '/a/b', '/a/b/2', '/a/c',
+                                    '/a/c/3', '/4', '/d', '/d/e', '/d/e/5'])
+    # parents are always listed before their children
+    assert paths.index('/a') < paths.index('/a/b') < paths.index('/a/b/2')
+
+
+@pytest.mark.asyncio
+async def test_walk_bounded_concurrency():
+    paths = [entry.path async for entry in walk(_fake_tree(), concurrency=1)]
+
+    assert len(paths) == 10
+    assert FakeFolder.max_in_flight == 1
+
+
+@pytest.mark.asyncio
+async def test_walk_stop_early():
+    tree = _fake_tree()
+    entries = walk(tree, concurrency=2)
+    async for entry in entries:
+        break
+    await entries.aclose()
+
+    assert entry.path == '/a'
+    # pending listings were cancelled
+    assert FakeFolder.in_flight == 0
+    assert not tree.entries[2].entries[0].listed
+
+
+@pytest.mark.asyncio
+async def test_walk_bounded_lookahead():
+    tree = FakeFolder('/', [
+        FakeFolder('/%d' % i, [FakeFolder('/%d/%d' % (i, j))
+                               for j in range(10)])
+        for i in range(50)])
+    FakeFolder.in_flight = FakeFolder.max_in_flight = 0
+    entries = walk(tree, concurrency=2)
+    async for entry in entries:
+        # a slow consumer
+        await asyncio.sleep(0.2)
+        break
+    listed = sum(folder.listed for parent in tree.entries
+                 for folder in [parent] + parent.entries)
+    await entries.aclose()
+
+    # only up to 4 * concurrency listings are requested ahead
+    assert 1 <= listed <= 8
+
+
+def test_walk_invalid_concurrency():
+    with pytest.raises(ValueError):
+        walk(_fake_tree(), concurrency=0)
+
+
+def test_parse_size():
+    assert parse_size('1024') == 1024
+    assert parse_size('200M') == 200 * 1024 ** 2
+    assert parse_size('1.5g') == int(1.5 * 1024 ** 3)
+    assert parse_size('10KB') == 10 * 1024
+
+    with pytest.raises(ValueError):
+        parse_size('ten megabytes')
+
+
+def test_parse_page_size():
+    assert parse_page_size('max') == 'max'
+    assert parse_page_size('default') is None
+    assert parse_page_size('250') == 250
+
+    with pytest.raises(ValueError):
+        parse_page_size('0')
+
+
+def test_parse_rate_limits():
+    assert parse_rate_limits('200M') == (200 * 1024 ** 2, 200 * 1024 ** 2)
+    assert parse_rate_limits('2M:1M') == (2 * 1024 ** 2, 1024 ** 2)
+    assert parse_rate_limits(':50K') == (None, 50 * 1024)
+    assert parse_rate_limits('1K:0') == (1024, None)
+
+    with pytest.raises(ValueError):
+        parse_rate_limits('fast')
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_waits_for_refill():
+    clock = Mock(return_value=100.0)
+    with patch('osfclient.utils.time.monotonic', clock), \
+            patch('osfclient.utils.asyncio.sleep') as mock_sleep:
+        bucket = TokenBucket(rate=10)
+        # the first second worth of bytes is sent right away
+        await bucket.consume(10)
+        assert not mock_sleep.called
+
+        # chunks larger than the bucket wait out their debt, and so do
+        # the callers after them
+        await bucket.consume(20)
+        await bucket.consume(5)
+        assert mock_sleep.call_args_list == [call(2.0), call(2.5)]
+
+        clock.return_value = 110.0
+        mock_sleep.reset_mock()
+        await bucket.consume(10)
+        assert not mock_sleep.called
+
+
+def test_token_bucket_invalid_rate():
+    with pytest.raises(ValueError):
+        TokenBucket(0)
+
+
+@pytest.mark.asyncio
+async def test_byte_budget_small_overtakes_large():
+    budget = ByteBudget(100)
+    order = []
+
+    async def transfer(name, nbytes):
+        async with budget.reserve(nbytes):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(transfer('first', 60), transfer('large', 1000),
+                         transfer('small', 30))
+
+    # the large transfer is clamped to the budget and has to wait for
+    # everything else, the small one fits next to the first one
+    assert order == ['first', 'small', 'large']
+    assert budget.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_byte_budget_large_takes_its_share():
+    budget = ByteBudget(100, max_reservation=25)
+    started = []
+
+    async def transfer(name, nbytes, duration):
+        async with budget.reserve(nbytes):
+            started.append((name, budget.in_flight))
+            await asyncio.sleep(duration)
+
+    # a transfer larger than the whole budget does not hold up small ones
+    await asyncio.gather(transfer('large', 5000, 0.05),
+                         transfer('small', 10, 0.01),
+                         transfer('small', 10, 0.01))
+
+    assert started == [('large', 25), ('small', 35), ('small', 45)]
+    assert budget.in_flight == 0
+
+
+@pytest.fixture
+def checksum_cache():
+    cache = ChecksumCache(':memory:')
+    previous = set_checksum_cache(cache)
+    yield cache
+    set_checksum_cache(previous)
+    cache.close()
+
+
+def _old_file(path, content):
+    with open(path, 'wb') as fp:
+        fp.write(content)
+    an_hour_ago = time.time() - 3600
+    os.utime(path, (an_hour_ago, an_hour_ago))
+
+
+@pytest.mark.asyncio
+async def test_checksum_cache_skips_unchanged_files(tmp_path, checksum_cache):
+    path = str(tmp_path / 'file.txt')
+    _old_file(path, b'hello world')
+    md5 = hashlib.md5(b'hello world').hexdigest()
+
+    assert await checksum_path(path) == md5
+    assert checksum_cache.get(os.stat(path), 'md5') == md5
+
+    with patch.object(hashlib, 'md5',
+                      side_effect=AssertionError('file hashed again')):
+        assert await checksum_path(path) == md5
+
+
+@pytest.mark.asyncio
+async def test_checksum_cache_modified_file(tmp_path, checksum_cache):
+    path = str(tmp_path / 'file.txt')
+    _old_file(path, b'hello world')
+    await checksum_path(path)
+
+    _old_file(path, b'hello there')
+    os.utime(path, (time.time() - 60, time.time() - 60))
+
+    assert (await checksum_path(path) ==
+            hashlib.md5(b'hello there').hexdigest())
+
+
+@pytest.mark.asyncio
+async def test_checksum_cache_ignores_recent_files(tmp_path, checksum_cache):
+    # a file modified just now might change again within the same mtime
+    path = str(tmp_path / 'file.txt')
+    with open(path, 'wb') as fp:
+        fp.write(b'hello world')
+
+    await checksum_path(path)
+
+    assert checksum_cache.get(os.stat(path), 'md5') is None
+
+
+def test_checksum_cache_persists(tmp_path):
+    path = str(tmp_path / 'cache' / 'checksums.sqlite')
+    stat = os.stat(__file__)
+    cache = ChecksumCache(path)
+    cache.set(stat, 'md5', '0' * 32)
+    cache.set(stat, 'sha256', '1' * 64)
+    cache.close()
+
+    cache = ChecksumCache(path)
+    assert cache.get(stat, 'md5') == '0' * 32
+    assert cache.get(stat, 'sha256') == '1' * 64
+    cache.close()
+
+
+def test_checksum_cache_opened_on_first_use(tmp_path):
+    path = str(tmp_path / 'cache' / 'checksums.sqlite')
+    cache = ChecksumCache(path)
+    assert not os.path.exists(path)
+
+    assert cache.get(os.stat(__file__), 'md5') is None
+    assert os.path.exists(path)
+    cache.close()
+    # closing twice is harmless
+    cache.close()
+
+
+def test_checksum_cache_unusable(tmp_path):
+    blocker = tmp_path / 'cache'
+    blocker.write_bytes(b'')
+    cache = ChecksumCache(str(blocker / 'checksums.sqlite'))
+    stat = os.stat(__file__)
+
+    cache.set(stat, 'md5', '0' * 32)
+    assert cache.get(stat, 'md5') is None
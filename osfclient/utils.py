@@ -3,10 +3,18 @@
 Helpers and other assorted functions.
 """
 
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
 import hashlib
+import logging
 import os
+import posixpath
+import re
+import sqlite3
+import threading
+import time
 import six
-import aiofiles
 
 
 KNOWN_PROVIDERS = [
@@ -17,6 +25,15 @@ KNOWN_PROVIDERS = [
     's3compatb3', 's3compatinstitutions', 'swift', 'weko'
 ]
 
+logger = logging.getLogger(__name__)
+
+# number of folder listings that `walk` keeps in flight at the same time
+DEFAULT_WALK_CONCURRENCY = 8
+# hashes computed for local files, and the size of the blocks they are
+# read in
+HASH_TYPES = ('md5', 'sha256')
+HASH_BLOCK_SIZE = 1024 * 1024
+
 
 def norm_remote_path(path: str) -> str:
     """Normalize `path`.
@@ -55,6 +72,53 @@ def split_storage(path, default='osfstorage', normalize=True):
     return (default, path)
 
 
+_SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+               'T': 1024 ** 4}
+
+
+def parse_size(size):
+    """Convert a human readable size like `200M` or `1.5G` to bytes.
+
+    Suffixes are binary multiples, an optional trailing `B` is ignored.
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$', str(size),
+                     re.IGNORECASE)
+    if match is None:
+        raise ValueError("{} is not a valid size.".format(size))
+    number, unit = match.groups()
+    return int(float(number) * _SIZE_UNITS[unit.upper()])
+
+
+def parse_page_size(value):
+    """Convert a listing page size, a number of entries, `max` for the
+    largest the server allows or `default` for the server's default."""
+    value = str(value).strip().lower()
+    if value == 'max':
+        return 'max'
+    if value == 'default':
+        return None
+    page_size = int(value)
+    if page_size < 1:
+        raise ValueError("page size has to be at least 1, "
+                         "not {}.".format(page_size))
+    return page_size
+
+
+def parse_rate_limits(value):
+    """Convert `RATE` or `DOWNLOAD:UPLOAD` to a pair of download and upload
+    rates in bytes per second.
+
+    A single rate applies to both directions, an empty or zero rate means
+    no limit, so `:50M` only limits uploads.
+    """
+    download, sep, upload = str(value).partition(':')
+    if not sep:
+        upload = download
+    rates = tuple(parse_size(rate) if rate.strip() else 0
+                  for rate in (download, upload))
+    return tuple(rate or None for rate in rates)
+
+
 def makedirs(path, mode=511, exist_ok=False):
     # mode 0777 is 511 in decimal
     if six.PY3:
@@ -77,44 +141,400 @@ async def file_empty(fp):
     return pos == 0
 
 
-async def checksum_path(file_path, hash_type='md5', block_size=65536):
-    """Returns either the md5 or sha256 hash of a file at `file_path`.
+class ChecksumCache(object):
+    """Remember the hashes of local files between runs.
 
-    md5 is the default hash_type as it is faster than sha256
+    Entries are stored in the SQLite database at `path` and keyed by the
+    device and inode of a file. They are only used while the size and
+    modification time of the file are unchanged.
 
-    The default block size is 64 kb, which appears to be one of a few command
-    choices according to https://stackoverflow.com/a/44873382/2680. The code
-    below is an extension of the example presented in that post.
+    The database is opened when it is first used. If it can not be opened
+    a warning is logged and nothing is cached.
     """
-    async with aiofiles.open(file_path, 'rb') as f:
-        return await checksum_fp(f, hash_type, block_size)
 
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+        self._failed = False
+
+    def _connect(self):
+        # call with the lock held
+        if self._db is None and not self._failed:
+            try:
+                if self.path != ':memory:':
+                    makedirs(os.path.dirname(os.path.abspath(self.path)),
+                             exist_ok=True)
+                db = sqlite3.connect(self.path, check_same_thread=False)
+                with db:
+                    db.execute(
+                        "CREATE TABLE IF NOT EXISTS checksums ("
+                        "dev INTEGER, ino INTEGER, size INTEGER, "
+                        "mtime_ns INTEGER, md5 TEXT, sha256 TEXT, "
+                        "PRIMARY KEY (dev, ino))"
+                    )
+            except (OSError, sqlite3.Error) as e:
+                logger.warning("Not using the checksum cache: %s", e)
+                self._failed = True
+            else:
+                self._db = db
+        return self._db
+
+    @staticmethod
+    def default_path():
+        """Return the location of the cache in the user's cache directory."""
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+            os.path.expanduser('~'), '.cache')
+        return os.path.join(cache_home, 'osfclient', 'checksums.sqlite')
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def get(self, stat, hash_type):
+        """Return the cached `hash_type` hash of the file with `stat`."""
+        if hash_type not in HASH_TYPES:
+            return None
+        with self._lock:
+            db = self._connect()
+            if db is None:
+                return None
+            row = db.execute(
+                "SELECT {} FROM checksums WHERE dev = ? AND ino = ? AND "
+                "size = ? AND mtime_ns = ?".format(hash_type),
+                (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def set(self, stat, hash_type, checksum):
+        """Remember the `hash_type` hash of the file with `stat`."""
+        if hash_type not in HASH_TYPES:
+            return
+        key = (stat.st_dev, stat.st_ino)
+        identity = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            db = self._connect()
+            if db is None:
+                return
+            with db:
+                row = db.execute(
+                    "SELECT size, mtime_ns FROM checksums WHERE dev = ? AND "
+                    "ino = ?", key
+                ).fetchone()
+                if row is not None and tuple(row) == identity:
+                    db.execute(
+                        "UPDATE checksums SET {} = ? WHERE dev = ? AND "
+                        "ino = ?".format(hash_type), (checksum,) + key
+                    )
+                else:
+                    db.execute(
+                        "INSERT OR REPLACE INTO checksums (dev, ino, size, "
+                        "mtime_ns, {}) VALUES (?, ?, ?, ?, ?)".format(
+                            hash_type),
+                        key + identity + (checksum,)
+                    )
+
+
+# cache used by `checksum_path` and `checksum_fp`, see `set_checksum_cache`
+_checksum_cache = None
+# files modified less than this many seconds before they were hashed are
+# not cached, they might still change within the same mtime tick
+RACY_SECONDS = 2
+
+
+def set_checksum_cache(cache):
+    """Use the `ChecksumCache` `cache` for hashing local files.
+
+    Pass None to always read the files. Returns the previous cache.
+    """
+    global _checksum_cache
+    previous, _checksum_cache = _checksum_cache, cache
+    return previous
 
-async def checksum_fp(fp, hash_type='md5', block_size=65536):
-    """Returns either the md5 or sha256 hash of a file indicated by file pointer `fp`.
 
-    md5 is the default hash_type as it is faster than sha256
+def _stat_path(file_path):
+    if _checksum_cache is None or not isinstance(file_path, str):
+        return None
+    try:
+        return os.stat(file_path)
+    except OSError:
+        return None
+
+
+def cache_checksums(file_path, hashes):
+    """Record the known `hashes` of the local file at `file_path`."""
+    stat = _stat_path(file_path)
+    if stat is None:
+        return
+    for hash_type, checksum in hashes.items():
+        if checksum:
+            _checksum_cache.set(stat, hash_type, checksum)
 
-    The default block size is 64 kb, which appears to be one of a few command
-    choices according to https://stackoverflow.com/a/44873382/2680. The code
-    below is an extension of the example presented in that post.
+
+# called with the phase, start and end time of timed work, see `timed`
+_phase_recorder = None
+
+
+def set_phase_recorder(recorder):
+    """Call `recorder(phase, start, end)` with the `time.monotonic` start
+    and end of the work timed with `timed`, None to stop.
+
+    Returns the previous recorder.
     """
-    if hash_type == 'md5':
-        hash_ = hashlib.md5()
-    elif hash_type == 'sha256':
-        hash_ = hashlib.sha256()
-    else:
+    global _phase_recorder
+    previous, _phase_recorder = _phase_recorder, recorder
+    return previous
+
+
+@contextmanager
+def timed(phase):
+    """Report how long the block took to the phase recorder, if any."""
+    recorder = _phase_recorder
+    if recorder is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        recorder(phase, start, time.monotonic())
+
+
+def _check_hash_type(hash_type):
+    if hash_type not in HASH_TYPES:
         raise ValueError(
             "{} is an invalid hash_type. Expected 'md5' or 'sha256'."
             .format(hash_type)
         )
 
-    await fp.seek(0)
-    async for block in fp:
-        hash_.update(block)
+
+def _new_hash(hash_type):
+    _check_hash_type(hash_type)
+    if hash_type == 'md5':
+        return hashlib.md5()
+    return hashlib.sha256()
+
+
+def hash_fd(fd, hash_types=HASH_TYPES, block_size=HASH_BLOCK_SIZE):
+    """Return the hashes of the file open as `fd` in a dict by hash type.
+
+    The file is read from its start in blocks of `block_size` bytes into a
+    single reused buffer, each block updates all hashes, so the file is
+    read once however many hashes are computed. The position of `fd` is
+    not changed. This blocks, `checksums_fd` runs it in a worker thread.
+    """
+    hashes = [_new_hash(hash_type) for hash_type in hash_types]
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    offset = 0
+    while True:
+        if hasattr(os, 'preadv'):
+            n = os.preadv(fd, [buf], offset)
+        else:
+            data = os.pread(fd, block_size, offset)
+            n = len(data)
+            view[:n] = data
+        if not n:
+            break
+        block = view[:n]
+        for hash_ in hashes:
+            hash_.update(block)
+        offset += n
+    return {hash_type: hash_.hexdigest()
+            for hash_type, hash_ in zip(hash_types, hashes)}
+
+
+async def checksums_fd(fd, hash_types=HASH_TYPES, block_size=HASH_BLOCK_SIZE):
+    """Return the hashes of the file open as `fd` in a dict by hash type.
+
+    Hashes of files that have not changed since they were last hashed are
+    taken from the checksum cache, see `set_checksum_cache`. The others
+    are computed by `hash_fd` in a single call in a worker thread.
+    """
+    for hash_type in hash_types:
+        _check_hash_type(hash_type)
+
+    stat = os.fstat(fd) if _checksum_cache is not None else None
+    checksums = {}
+    if stat is not None:
+        for hash_type in hash_types:
+            checksum = _checksum_cache.get(stat, hash_type)
+            if checksum is not None:
+                checksums[hash_type] = checksum
+    missing = tuple(hash_type for hash_type in hash_types
+                    if hash_type not in checksums)
+    if not missing:
+        return checksums
+
+    loop = asyncio.get_event_loop()
+    with timed('hashing'):
+        computed = await loop.run_in_executor(None, hash_fd, fd, missing,
+                                              block_size)
+    checksums.update(computed)
+    if stat is not None and _unchanged(stat, os.fstat(fd)):
+        for hash_type, checksum in computed.items():
+            _checksum_cache.set(stat, hash_type, checksum)
+    return checksums
+
+
+async def checksums_path(file_path, hash_types=HASH_TYPES,
+                         block_size=HASH_BLOCK_SIZE):
+    """Return the hashes of the file at `file_path` in a dict by hash type.
+
+    See `checksums_fd`.
+    """
+    fd = os.open(file_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        return await checksums_fd(fd, hash_types, block_size)
+    finally:
+        os.close(fd)
+
+
+async def checksum_path(file_path, hash_type='md5',
+                        block_size=HASH_BLOCK_SIZE):
+    """Returns either the md5 or sha256 hash of a file at `file_path`.
+
+    md5 is the default hash_type as it is faster than sha256. Files that
+    have not changed since they were last hashed are not read again if a
+    checksum cache is set, see `set_checksum_cache`.
+    """
+    checksums = await checksums_path(file_path, (hash_type,), block_size)
+    return checksums[hash_type]
+
+
+async def checksum_fp(fp, hash_type='md5', block_size=HASH_BLOCK_SIZE):
+    """Returns either the md5 or sha256 hash of a file indicated by file pointer `fp`.
+
+    md5 is the default hash_type as it is faster than sha256
+
+    Files on disk are hashed by their file descriptor with
+    `checksums_fd`, other file-like objects are read in blocks of
+    `block_size` bytes.
+    """
+    fd = _fileno(fp)
+    if fd is not None:
+        try:
+            checksums = await checksums_fd(fd, (hash_type,), block_size)
+            return checksums[hash_type]
+        except OSError:
+            # not a regular file, e.g. a pipe
+            pass
+
+    hash_ = _new_hash(hash_type)
+    with timed('hashing'):
+        await fp.seek(0)
+        while True:
+            block = await fp.read(block_size)
+            if not block:
+                break
+            hash_.update(block)
     return hash_.hexdigest()
 
 
+def _fileno(fp):
+    try:
+        fd = fp.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+    return fd if isinstance(fd, int) else None
+
+
+def _unchanged(before, after):
+    """Check that a file was not modified while it was hashed."""
+    if after is None or time.time() - after.st_mtime < RACY_SECONDS:
+        return False
+    return ((before.st_dev, before.st_ino, before.st_size,
+             before.st_mtime_ns) ==
+            (after.st_dev, after.st_ino, after.st_size, after.st_mtime_ns))
+
+
+class ByteBudget(object):
+    """Limit the number of bytes that are in flight at the same time.
+
+    A reservation larger than `max_reservation`, the whole budget by
+    default, is clamped to it. With a smaller `max_reservation` a large
+    transfer only takes its share of the budget and small ones keep
+    running next to it. Waiting reservations are not served in order: a
+    small reservation that fits may overtake a large one that is still
+    waiting for enough bytes to be released.
+    """
+    def __init__(self, capacity, max_reservation=None):
+        if capacity < 1:
+            raise ValueError("capacity has to be at least 1 byte, "
+                             "not {}.".format(capacity))
+        self.capacity = capacity
+        if max_reservation is None:
+            max_reservation = capacity
+        self.max_reservation = max(1, min(max_reservation, capacity))
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def reserve(self, nbytes):
+        nbytes = min(nbytes or 0, self.max_reservation)
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self.in_flight + nbytes <= self.capacity
+            )
+            self.in_flight += nbytes
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.in_flight -= nbytes
+                self._condition.notify_all()
+
+
+class TokenBucket(object):
+    """Limit a stream of bytes to `rate` bytes per second on average.
+
+    The bucket holds up to `burst` bytes, one second worth of `rate` by
+    default. `consume` takes bytes out of it and waits until they have been
+    refilled if there were not enough. Taking more than the bucket holds
+    leaves it in debt, which later calls wait out, so chunks may be larger
+    than the bucket. Concurrent callers share the rate and get their turn
+    in the order they called `consume`.
+    """
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate has to be more than 0 bytes per second, "
+                             "not {}.".format(rate))
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    async def consume(self, nbytes):
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= nbytes
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+# shared by all transfers of the process, see `set_rate_limits`
+_rate_limits = {'download': None, 'upload': None}
+
+
+def set_rate_limits(download=None, upload=None):
+    """Limit all downloads and all uploads of the process together to this
+    many bytes per second, None for no limit."""
+    _rate_limits['download'] = TokenBucket(download) if download else None
+    _rate_limits['upload'] = TokenBucket(upload) if upload else None
+
+
+async def throttle(direction, nbytes):
+    """Wait until `nbytes` may be transferred in `direction`, either
+    'download' or 'upload'."""
+    bucket = _rate_limits[direction]
+    if bucket is not None:
+        await bucket.consume(nbytes)
+
+
 def get_local_file_size(fp):
     """Get file size from file pointer"""
     # one-liner to get file size from file pointer explained at
@@ -153,19 +573,292 @@ def is_folder(file_or_folder):
     return hasattr(file_or_folder, 'files')
 
 
-async def flatten(store):
-    async for file_ in store.children:
-        yield file_
-        if not is_folder(file_):
-            continue
-        async for child in flatten(file_):
+class _TreeWalker(object):
+    """Crawl a remote folder tree with a bounded number of concurrent listings.
+
+    In depth-first order the listings of sub-folders are requested ahead of
+    the consumer, but at most `lookahead` of them wait to be consumed at any
+    time. Without order folders wait in a frontier until one of the
+    `concurrency` listings is free. Either way the memory a crawl holds
+    does not grow with the number of folders in the tree.
+    """
+    def __init__(self, concurrency, lookahead=None, page_size=None):
+        if concurrency < 1:
+            raise ValueError("concurrency has to be at least 1, "
+                             "not {}.".format(concurrency))
+        self._concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        if lookahead is None:
+            lookahead = 4 * concurrency
+        self._lookahead = lookahead
+        self._page_size = page_size
+        # listings requested ahead of the consumer, by id of the folder
+        self._ahead = {}
+        self._tasks = set()
+
+    def _schedule(self, folder):
+        task = asyncio.ensure_future(self._list(folder))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _list(self, folder):
+        if self._page_size is None:
+            children = folder.children
+        else:
+            children = folder.list_children(page_size=self._page_size)
+        async with self._semaphore:
+            return [child async for child in children]
+
+    def _schedule_ahead(self, children):
+        for child in children:
+            if len(self._ahead) >= self._lookahead:
+                return
+            if is_folder(child) and id(child) not in self._ahead:
+                task = self._schedule(child)
+                task.add_done_callback(self._listed_ahead)
+                self._ahead[id(child)] = child, task
+
+    def _listed_ahead(self, task):
+        if not task.cancelled() and task.exception() is None:
+            self._schedule_ahead(task.result())
+
+    async def _ordered(self, folder):
+        ahead = self._ahead.pop(id(folder), None)
+        task = self._schedule(folder) if ahead is None else ahead[1]
+        children = await task
+        self._schedule_ahead(children)
+        for child in children:
             yield child
+            if is_folder(child):
+                async for entry in self._ordered(child):
+                    yield entry
+
+    async def _unordered(self, store):
+        frontier = [store]
+        pending = set()
+        while frontier or pending:
+            while frontier and len(pending) < self._concurrency:
+                # deepest folders first, which keeps the frontier short
+                pending.add(self._schedule(frontier.pop()))
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                for child in task.result():
+                    if is_folder(child):
+                        frontier.append(child)
+                    yield child
+
+    async def walk(self, store, ordered=True):
+        if ordered:
+            entries = self._ordered(store)
+        else:
+            entries = self._unordered(store)
+        try:
+            async for entry in entries:
+                yield entry
+        finally:
+            await entries.aclose()
+            # the consumer stopped early or a listing failed, do not leave
+            # any listings running in the background
+            self._ahead.clear()
+            tasks = list(self._tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def walk(store, concurrency=DEFAULT_WALK_CONCURRENCY, ordered=True,
+         page_size=None):
+    """Iterate over all files and folders below `store`.
+
+    Up to `concurrency` folder listings are requested at the same time.
+    With `ordered=True` entries are yielded in the same depth-first order
+    a sequential traversal would produce, otherwise they are yielded as
+    soon as the listing of their parent folder arrives. Folders are listed
+    in pages of `page_size` entries, by default the page size of the
+    session of `store`.
+    """
+    return _TreeWalker(concurrency, page_size=page_size).walk(
+        store, ordered=ordered)
+
+
+def flatten(store, concurrency=DEFAULT_WALK_CONCURRENCY, ordered=True,
+            page_size=None):
+    return walk(store, concurrency=concurrency, ordered=ordered,
+                page_size=page_size)
+
+
+class PathIndex(object):
+    """Index of the remote folder listings seen during a session.
+
+    Listings are keyed by a `root` identifying the storage and the
+    normalized path of the folder (`''` for the root of the storage). Once
+    the listing of a folder is known, looking up one of its entries, or
+    finding that it does not exist, does not need another request. Models
+    that create, remove or move entries update the index in place.
+
+    The index also remembers the folders that `folder` resolved, so that
+    uploads into the same folder do not create it again and again.
+    """
+    def __init__(self):
+        self._listings = {}
+        self._folders = {}
+        self._resolving = {}
+
+    def clear(self):
+        self._listings.clear()
+        self._folders.clear()
+
+    def listing(self, root, path):
+        """Return the entries of folder `path` keyed by path, or None."""
+        return self._listings.get((root, path))
+
+    def set_listing(self, root, path, entries):
+        listing = dict((norm_remote_path(entry.path), entry)
+                       for entry in entries)
+        self._listings[(root, path)] = listing
+        return listing
+
+    def add(self, root, entry, listed=False):
+        """Add `entry` to the listing of its parent folder.
+
+        Set `listed=True` for a folder that was just created, which is known
+        to be empty.
+        """
+        path = norm_remote_path(entry.path)
+        listing = self._listings.get((root, posixpath.dirname(path)))
+        if listing is not None:
+            listing[path] = entry
+        if listed:
+            self._listings[(root, path)] = {}
+
+    def discard(self, root, path):
+        """Remove `path` and everything below it from the index."""
+        listing = self._listings.get((root, posixpath.dirname(path)))
+        if listing is not None:
+            listing.pop(path, None)
+        prefix = path + '/' if path else ''
+        for mapping in (self._listings, self._folders):
+            for key in list(mapping):
+                if key[0] == root and (key[1] == path or
+                                       key[1].startswith(prefix)):
+                    del mapping[key]
+
+    def invalidate(self, root, path):
+        """Forget the listing of folder `path`, it is listed again when
+        it is needed next."""
+        self._listings.pop((root, path), None)
+
+    async def _list(self, root, folder, path):
+        listing = self._listings.get((root, path))
+        if listing is None:
+            entries = [entry async for entry in folder.children]
+            listing = self.set_listing(root, path, entries)
+        return listing
+
+    async def find(self, root, container, container_path, path):
+        """Find the entry at `path` below `container`.
+
+        Only folders whose listing is not indexed yet are listed. Returns
+        None if there is no such entry.
+        """
+        if path == container_path:
+            return None
+        if container_path and not path.startswith(container_path + '/'):
+            return None
+        listing = self._listings.get((root, posixpath.dirname(path)))
+        if listing is not None:
+            return listing.get(path)
+
+        folder, folder_path = container, container_path
+        while True:
+            listing = await self._list(root, folder, folder_path)
+            if posixpath.dirname(path) == folder_path:
+                return listing.get(path)
+            # descend into the sub-folder that contains `path`
+            rest = path[len(folder_path):].lstrip('/')
+            folder_path = posixpath.join(folder_path, rest.split('/')[0])
+            folder = listing.get(folder_path)
+            if folder is None or not is_folder(folder):
+                return None
+
+    async def folder(self, root, container, container_path, path):
+        """Return the folder at `path` below `container`, creating it and
+        its parents if they do not exist.
+
+        Resolved folders are remembered and concurrent calls for the same
+        folder wait for a single resolution, so that each folder is looked
+        up or created only once.
+        """
+        if path == container_path:
+            return container
+        key = (root, path)
+        folder = self._folders.get(key)
+        if folder is not None:
+            return folder
+        task = self._resolving.get(key)
+        if task is None:
+            task = asyncio.ensure_future(
+                self._resolve_folder(root, container, container_path, path)
+            )
+            self._resolving[key] = task
+            task.add_done_callback(partial(self._resolved, key))
+        # a cancelled caller does not cancel the resolution for the others
+        return await asyncio.shield(task)
+
+    def _resolved(self, key, task):
+        self._resolving.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self._folders[key] = task.result()
+
+    async def _resolve_folder(self, root, container, container_path, path):
+        parent_path = posixpath.dirname(path)
+        parent = await self.folder(root, container, container_path,
+                                   parent_path)
+        listing = self._listings.get((root, parent_path))
+        if listing is not None:
+            entry = listing.get(path)
+            if entry is not None and is_folder(entry):
+                return entry
+        folder = await parent.create_folder(posixpath.basename(path),
+                                            exist_ok=True)
+        if folder is None or not is_folder(folder):
+            raise RuntimeError("Could not create folder {}, a file with "
+                               "that name exists.".format(path))
+        return folder
+
+
+def path_index(container):
+    """Return the `PathIndex` and the key of `container` in it.
+
+    Returns `(None, None)` if `container` does not take part in indexing.
+    """
+    index = getattr(getattr(container, 'session', None), 'path_index', None)
+    if not isinstance(index, PathIndex):
+        return None, None
+    key = container._index_key()
+    if key is None:
+        return None, None
+    return index, key
 
 
 async def find_ancestral_folder(store, target_file_path):
     file_path_segs = target_file_path.split('/')
     if(len(file_path_segs) <= 1):
         return None
+    index, key = path_index(store)
+    if index is not None:
+        root, container_path = key
+        folder = None
+        for i in range(1, len(file_path_segs)):
+            path = '/'.join(file_path_segs[:i])
+            folder_ = await index.find(root, store, container_path, path)
+            if folder_ is None or not is_folder(folder_):
+                break
+            folder = folder_
+        return folder
     folder = store
     path = ''
     i = 0
@@ -187,6 +880,11 @@ async def find_ancestral_folder(store, target_file_path):
 async def find_by_path(store, target_file_path):
     if target_file_path is None:
         return None
+    index, key = path_index(store)
+    if index is not None:
+        root, container_path = key
+        return await index.find(root, store, container_path,
+                                norm_remote_path(target_file_path))
     file_path_segs = target_file_path.split('/')
     if(len(file_path_segs) == 1):
         async for file_ in store.children:
@@ -206,14 +904,17 @@ async def find_by_path(store, target_file_path):
             return None
 
 
-async def filter_by_path_pattern(store, target_file_path):
-    async for file_ in _filter_by_path_pattern(store, target_file_path, 0):
+async def filter_by_path_pattern(store, target_file_path,
+                                 concurrency=DEFAULT_WALK_CONCURRENCY):
+    async for file_ in _filter_by_path_pattern(store, target_file_path, 0,
+                                               concurrency):
         yield file_
 
 
-async def _filter_by_path_pattern(store, target_file_path, depth):
+async def _filter_by_path_pattern(store, target_file_path, depth,
+                                  concurrency):
     if target_file_path is None or target_file_path == '/':
-        async for file_ in flatten(store):
+        async for file_ in walk(store, concurrency=concurrency):
             yield file_
         return
     file_path_segs = target_file_path.split('/')
@@ -230,11 +931,12 @@ async def _filter_by_path_pattern(store, target_file_path, depth):
                 continue
             if depth > 0:
                 continue
-            async for child in flatten(file_):
+            async for child in walk(file_, concurrency=concurrency):
                 yield child
     else:
         parent_target_file_path = '/' + '/'.join(file_path_segs[:-1]) + '/'
-        async for rf_ in _filter_by_path_pattern(store, parent_target_file_path, depth + 1):
+        async for rf_ in _filter_by_path_pattern(store, parent_target_file_path,
+                                                 depth + 1, concurrency):
             if not is_folder(rf_):
                 continue
             async for file_ in rf_.files:
@@ -245,5 +947,5 @@ async def _filter_by_path_pattern(store, target_file_path, depth):
                     continue
                 if depth > 0:
                     continue
-                async for child in flatten(file_):
+                async for child in walk(file_, concurrency=concurrency):
                     yield child
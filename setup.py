@@ -70,6 +70,12 @@ setup(
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=required,
 
+    # HTTP/2 support is optional: pip install osfclient[http2]
+    extras_require={
+        'http2': ['httpx[http2]'],
+        'fast': ['orjson'],
+    },
+
     # To provide executable scripts, use entry points in preference to the
     # "scripts" keyword. Entry points provide cross-platform support and allow
     # pip to create the appropriate form of executable for the target platform.